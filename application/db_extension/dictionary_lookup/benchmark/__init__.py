@@ -0,0 +1,24 @@
+"""
+Offline benchmark of the dictionary lookup engine
+
+Builds the lookup dictionary from a synthetic (or recorded) set of
+domain_dictionary rows without Postgres, then reports build time, memory,
+lookups/sec and latency percentiles for short product names and long review
+sentences, with fuzzy matching off and on, as JSON:
+
+    python -m application.db_extension.dictionary_lookup.benchmark \
+        --size 50000 before.json
+
+Record the rows of a real database once (needs the application config) and
+benchmark them offline afterwards:
+
+    python -m application.db_extension.dictionary_lookup.benchmark --record rows.json
+    python -m application.db_extension.dictionary_lookup.benchmark --rows rows.json real.json
+"""
+from .runner import run_benchmark
+from .synthetic import (
+    dump_rows,
+    generate_product_names,
+    generate_review_sentences,
+    generate_rows,
+    load_rows)
@@ -0,0 +1,77 @@
+import argparse
+import json
+
+from application.logging import logger
+
+from .runner import run_benchmark
+from .synthetic import (
+    dump_rows,
+    generate_product_names,
+    generate_review_sentences,
+    generate_rows,
+    load_rows)
+
+
+def record_rows(path):
+    """Save the domain_dictionary rows of the default category to path"""
+    from application import create_app
+    app = create_app()
+    with app.app_context():
+        from application.db_extension.dictionary_lookup.postgres_functions import (
+            get_dict_items_from_sql)
+        from application.db_extension.routines import get_default_category_id
+        rows = get_dict_items_from_sql(get_default_category_id())
+        dump_rows(rows, path)
+    print(f'{len(rows)} rows saved to {path}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m application.db_extension.dictionary_lookup.benchmark',
+        description='Benchmark the dictionary lookup engine without a database')
+    parser.add_argument('--size', type=int, default=20000,
+                        help='rows of the synthetic dictionary')
+    parser.add_argument('--rows',
+                        help='use rows recorded with --record instead')
+    parser.add_argument('--record', metavar='PATH',
+                        help='save the database rows to PATH and exit')
+    parser.add_argument('--queries', type=int, default=1000,
+                        help='queries of each kind')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--use-cache', action='store_true',
+                        help='go through the lookup result cache')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='application log level during the run (debug '
+                             'logging of every lookup skews the timings)')
+    parser.add_argument('output', nargs='?',
+                        help='JSON report path (required unless --record)')
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record_rows(args.record)
+        return
+    if not args.output:
+        # not stdout: importing the lookup config prints the environment there
+        parser.error('the report path is required')
+
+    logger.setLevel(args.log_level.upper())
+    if args.rows:
+        rows = load_rows(args.rows)
+    else:
+        rows = generate_rows(args.size, seed=args.seed)
+    query_sets = {
+        'product_names': generate_product_names(
+            rows, args.queries, seed=args.seed + 1),
+        'review_sentences': generate_review_sentences(
+            rows, args.queries, seed=args.seed + 2),
+    }
+    report = run_benchmark(rows, query_sets, use_cache=args.use_cache)
+    report['dictionary'] = args.rows or 'synthetic'
+    report['seed'] = args.seed
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import gc
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+from flask import Flask
+
+from application.db_extension.dictionary_lookup.normalizer import (
+    normalize_text)
+
+PERCENTILES = (50, 95, 99)
+
+
+def _max_rss_mb():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    # kilobytes on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+
+def build(dictionary_lookup, rows):
+    """
+    Build the dictionary from rows, publish it and time the snapshot round trip
+    :return: build report
+    """
+    from application.db_extension.dictionary_lookup.lookup import (
+        build_dictionary)
+    from application.db_extension.dictionary_lookup.snapshot import (
+        read_snapshot, write_snapshot)
+
+    gc.collect()
+    tracemalloc.start()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    dictionary, entities_text_id_dict, cutoff_idf = build_dictionary(
+        list(rows), log_function=lambda *args: None)
+    build_seconds = time.perf_counter() - start_time
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'dictionary.snapshot')
+        start_time = time.perf_counter()
+        write_snapshot(dictionary, entities_text_id_dict, path,
+                       category_id=0, fingerprint=(0, 0, 0),
+                       cutoff_idf=float(cutoff_idf), delta_rows=0)
+        write_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        read_snapshot(path)
+        load_seconds = time.perf_counter() - start_time
+        snapshot_mb = os.path.getsize(path) / 2 ** 20
+
+    dictionary_lookup.publish_dictionary(dictionary, entities_text_id_dict)
+    dictionary_lookup.cutoff_idf = float(cutoff_idf)
+    dictionary_lookup.result_cache.clear()
+    return {
+        'rows': len(rows),
+        'entities': len(dictionary),
+        'vocabulary': len(dictionary.words),
+        'build_seconds': build_seconds,
+        'build_memory_mb': (current_memory - start_memory) / 2 ** 20,
+        'build_peak_memory_mb': (peak_memory - start_memory) / 2 ** 20,
+        'snapshot_mb': snapshot_mb,
+        'snapshot_write_seconds': write_seconds,
+        'snapshot_load_seconds': load_seconds,
+    }
+
+
+def time_lookups(dictionary_lookup, queries, use_cache=False, warmup=20,
+                 **kwargs):
+    """
+    Look up each query and report throughput and latency percentiles
+    :param queries: normalized queries
+    :param use_cache: go through lookup() and its result cache instead of
+        lookup_uncached()
+    :param kwargs: lookup() arguments
+    """
+    lookup = dictionary_lookup.lookup if use_cache else \
+        dictionary_lookup.lookup_uncached
+    for query in queries[:warmup]:
+        lookup(0, query, **kwargs)
+    dictionary_lookup.result_cache.clear()
+
+    latencies = np.empty(len(queries))
+    matched = 0
+    start_time = time.perf_counter()
+    for i, query in enumerate(queries):
+        query_start = time.perf_counter()
+        attributes, _, _ = lookup(0, query, **kwargs)
+        latencies[i] = time.perf_counter() - query_start
+        matched += len(attributes)
+    total_seconds = time.perf_counter() - start_time
+    report = {
+        'queries': len(queries),
+        'lookups_per_second': len(queries) / total_seconds
+        if total_seconds else None,
+        'matched_attributes': matched,
+        'mean_ms': float(latencies.mean() * 1000) if len(queries) else None,
+    }
+    for percentile in PERCENTILES:
+        report['p%d_ms' % percentile] = float(
+            np.percentile(latencies, percentile) * 1000) \
+            if len(queries) else None
+    return report
+
+
+def run_benchmark(rows, query_sets, use_cache=False, category_id=1):
+    """
+    Build the dictionary from rows and time lookups of each query set with
+    fuzzy matching off and on. Runs without the database: the dictionary is
+    built in memory and the lookups only need an application context for
+    the default category id.
+    :param rows: domain_dictionary rows (see get_dict_items_from_sql())
+    :param query_sets: {name: list of raw queries}
+    :return: report (JSON serializable)
+    """
+    from application.db_extension.dictionary_lookup.lookup import (
+        dictionary_lookup)
+
+    app = Flask(__name__)
+    app.config['DEFAULT_CATEGORY_ID'] = category_id
+    with app.app_context():
+        report = {
+            'created': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'use_cache': use_cache,
+            'build': build(dictionary_lookup, rows),
+            'lookups': {},
+        }
+        for name, queries in sorted(query_sets.items()):
+            # like attribute_lookup(): clean and remove stopwords first
+            normalized = [normalize_text(query).without_stopwords
+                          for query in queries]
+            normalized = [query for query in normalized if query]
+            report['lookups'][name] = {
+                'fuzzy_off': time_lookups(dictionary_lookup, normalized,
+                                          use_cache=use_cache),
+                'fuzzy_on': time_lookups(dictionary_lookup, normalized,
+                                         use_cache=use_cache,
+                                         is_allow_fuzzy=True),
+            }
+    report['max_rss_mb'] = _max_rss_mb()
+    return report
@@ -0,0 +1,189 @@
+"""
+Synthetic wine dictionary and queries for the lookup benchmark
+
+Names are built from a pseudo-word vocabulary drawn with a skewed
+distribution, so, as in domain_dictionary, a few words ("chateau", common
+syllable words) are in many entities and most are in one or two.
+"""
+import json
+import random
+
+FIELDNAMES = ('id', 'category_id', 'attribute_id', 'entity_id', 'text_value',
+              'base_value', 'attribute_code')
+
+
+class DictionaryRow(tuple):
+    """Stands in for a get_dict_items_from_sql() row: indexable by column name"""
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = FIELDNAMES.index(key)
+        return tuple.__getitem__(self, key)
+
+
+SYLLABLES = ['ca', 'ber', 'net', 'sau', 'vi', 'gnon', 'mer', 'lot', 'pi',
+             'not', 'noir', 'char', 'don', 'nay', 'ro', 'sa', 'ma', 'la',
+             'ri', 'ne', 'tor', 'val', 'ley', 'mon', 'te', 'sta', 'bel', 'lo',
+             'zin', 'fan', 'del', 'bor', 'deaux', 'na', 'pa', 'so', 'bec',
+             'syr', 'ah', 'gre', 'nache', 'tem', 'pra', 'nil', 'chi', 'an']
+BRAND_PATTERNS = ['{0}', '{0} {1}', 'Chateau {0}', 'Domaine {0}',
+                  '{0} Vineyards', '{0} {1} Winery', '{0} Estate',
+                  "{0}'s {1}", 'Clos du {0}', '{0} & {1}', 'St. {0}']
+REGION_PATTERNS = ['{0}', '{0} Valley', '{0} Coast', 'Cote de {0}',
+                   '{0} {1}', 'Central {0}', '{0} Hills']
+VARIETALS = ['Cabernet Sauvignon', 'Sauvignon Blanc', 'Pinot Noir',
+             'Pinot Grigio', 'Chardonnay', 'Merlot', 'Malbec', 'Syrah',
+             'Shiraz', 'Zinfandel', 'Riesling', 'Grenache', 'Tempranillo',
+             'Sangiovese', 'Nebbiolo', 'Chenin Blanc', 'Gewurztraminer',
+             'Viognier', 'Petite Sirah', 'Cabernet Franc', 'Red Blend',
+             'White Blend', 'Rose']
+ATTRIBUTES = {
+    'wine_type': ['Red Wine', 'White Wine', 'Rose Wine', 'Sparkling Wine',
+                  'Dessert Wine', 'Port', 'Champagne'],
+    'body': ['Full Bodied', 'Medium Bodied', 'Light Bodied'],
+    'styles': ['Dry', 'Off Dry', 'Sweet', 'Oaky', 'Fruity', 'Earthy',
+               'Crisp', 'Buttery', 'Tannic', 'Jammy'],
+    'foods': ['Steak', 'Lamb', 'Salmon', 'Oysters', 'Pasta', 'Pizza',
+              'Cheese', 'Chocolate', 'Chicken', 'Barbecue', 'Sushi'],
+}
+# share of the generated rows of each open ended attribute
+ENTITY_MIX = (('brand', 0.75), ('region', 0.2), ('varietals', 0.05))
+REVIEW_WORDS = ['this', 'wine', 'shows', 'notes', 'of', 'dark', 'cherry',
+                'plum', 'with', 'a', 'long', 'finish', 'and', 'hints', 'oak',
+                'vanilla', 'on', 'the', 'palate', 'nose', 'is', 'bright',
+                'ripe', 'fruit', 'firm', 'tannins', 'drink', 'now', 'through',
+                'lovely', 'structure', 'from', 'vintage', 'it', 'pairs',
+                'well', 'spice', 'tobacco', 'leather', 'silky', 'texture']
+SIZES = ['750ML', '1.5L', '375ML', '750 ml', '']
+
+
+def _word(rng):
+    return ''.join(rng.choice(SYLLABLES)
+                   for _ in range(rng.choice((1, 2, 2, 3))))
+
+
+def _skewed_choice(rng, words):
+    # the first words of the list are drawn much more often than the last ones
+    return words[int(len(words) * rng.random() ** 3)]
+
+
+def generate_rows(size=20000, seed=0, category_id=1):
+    """
+    Generate domain_dictionary rows (same fields as get_dict_items_from_sql())
+    :param size: approximate number of rows
+    :return: list of DictionaryRow
+    """
+    rng = random.Random(seed)
+    vocabulary = sorted({_word(rng).capitalize()
+                         for _ in range(max(size // 2, 100))})
+    rng.shuffle(vocabulary)
+    codes = [code for code, _ in ENTITY_MIX] + sorted(ATTRIBUTES)
+    attribute_ids = {code: i + 1 for i, code in enumerate(codes)}
+    rows = []
+
+    def add(code, text, base_value=None):
+        row_id = len(rows) + 1
+        # a few entities have more than one text (aliases)
+        entity_id = row_id if rng.random() < 0.95 or not rows else \
+            rows[-1][3]
+        rows.append(DictionaryRow((row_id, category_id, attribute_ids[code],
+                                   entity_id, text, base_value, code)))
+
+    for code, values in sorted(ATTRIBUTES.items()):
+        for value in values:
+            add(code, value, value)
+    for varietal in VARIETALS:
+        add('varietals', varietal, varietal)
+    patterns = {'brand': BRAND_PATTERNS, 'region': REGION_PATTERNS,
+                'varietals': ['{0}', '{0} {1}']}
+    generated = max(size - len(rows), 0)
+    for code, share in ENTITY_MIX:
+        for _ in range(int(generated * share)):
+            pattern = rng.choice(patterns[code])
+            text = pattern.format(_skewed_choice(rng, vocabulary),
+                                  _skewed_choice(rng, vocabulary))
+            add(code, text)
+    return rows
+
+
+def _typo(rng, word):
+    if len(word) < 5:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    return rng.choice((word[:i] + word[i + 1:],
+                       word[:i] + word[i + 1] + word[i] + word[i + 2:],
+                       word[:i] + rng.choice('aeiou') + word[i:]))
+
+
+def _texts_by_code(rows):
+    # None: all texts, for codes a recorded dictionary doesn't have
+    texts = {None: []}
+    for row in rows:
+        texts.setdefault(row[6], []).append(row[4])
+        texts[None].append(row[4])
+    return texts
+
+
+def _mention(rng, texts, code, typo_rate):
+    words = rng.choice(texts.get(code) or texts[None]).split()
+    return ' '.join(_typo(rng, word) if rng.random() < typo_rate else word
+                    for word in words)
+
+
+def generate_product_names(rows, count=1000, seed=1, typo_rate=0.1):
+    """
+    Short product names, e.g. "Chateau Bermon Merlot Napa Valley 2015 750ML"
+    """
+    rng = random.Random(seed)
+    texts = _texts_by_code(rows)
+    names = []
+    for _ in range(count):
+        parts = [_mention(rng, texts, 'brand', typo_rate)]
+        if rng.random() < 0.8:
+            parts.append(_mention(rng, texts, 'varietals', typo_rate))
+        if rng.random() < 0.4:
+            parts.append(_mention(rng, texts, 'region', typo_rate))
+        if rng.random() < 0.7:
+            parts.append(str(rng.randrange(1990, 2021)))
+        parts.append(rng.choice(SIZES))
+        names.append(' '.join(part for part in parts if part))
+    return names
+
+
+def generate_review_sentences(rows, count=1000, seed=2, typo_rate=0.05):
+    """
+    Long review sentences (20 to 40 words) mentioning a few entities
+    """
+    rng = random.Random(seed)
+    texts = _texts_by_code(rows)
+    codes = sorted(code for code in texts if code)
+    sentences = []
+    for _ in range(count):
+        words = [rng.choice(REVIEW_WORDS)
+                 for _ in range(rng.randrange(16, 32))]
+        for _ in range(rng.randrange(1, 5)):
+            words.insert(rng.randrange(len(words) + 1),
+                         _mention(rng, texts, rng.choice(codes), typo_rate))
+        sentence = ' '.join(words)
+        sentences.append(sentence[0].upper() + sentence[1:] + '.')
+    return sentences
+
+
+def load_rows(path):
+    """
+    Load rows recorded with dump_rows() (a JSON list of rows, as lists in
+    FIELDNAMES order or as objects keyed by field name)
+    """
+    with open(path) as f:
+        data = json.load(f)
+    return [DictionaryRow(row[field] for field in FIELDNAMES)
+            if isinstance(row, dict) else DictionaryRow(row) for row in data]
+
+
+def dump_rows(rows, path):
+    """
+    :param rows: rows of get_dict_items_from_sql() (columns in FIELDNAMES order)
+    """
+    with open(path, 'w') as f:
+        json.dump([list(row) for row in rows], f)
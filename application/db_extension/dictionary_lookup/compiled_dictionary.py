@@ -0,0 +1,394 @@
+import array
+
+import numpy as np
+
+UNKNOWN_TOKEN = -1  # token id for query words that are not in the vocabulary
+
+
+def pack_strings(strings):
+    """
+    Pack strings into one UTF-8 buffer
+    :return: (uint8 data, int64 offsets) where string i is data[offsets[i]:offsets[i + 1]]
+    """
+    encoded = [s.encode('utf8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def unpack_strings(data, offsets):
+    text = data.tobytes()
+    bounds = offsets.tolist()
+    return [text[bounds[i]:bounds[i + 1]].decode('utf8')
+            for i in range(len(bounds) - 1)]
+
+
+class StringColumn:
+    """
+    Read-only column of (optional) strings packed into one UTF-8 buffer
+
+    Values are decoded on access, so the column costs no per-string objects.
+    """
+
+    def __init__(self, data, offsets, nulls=None):
+        self.data = data
+        self.offsets = offsets
+        self.nulls = nulls
+
+    @classmethod
+    def from_strings(cls, strings):
+        nulls = np.array([s is None for s in strings], dtype=np.uint8)
+        data, offsets = pack_strings([s or '' for s in strings])
+        return cls(data, offsets, nulls)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.data[
+               self.offsets.item(i):self.offsets.item(i + 1)
+               ].tobytes().decode('utf8')
+
+
+class PostingLists:
+    """
+    Ragged lists of int32 rows keyed by string (e.g., chr ngram -> entity rows)
+    """
+
+    def __init__(self, keys, offsets, rows):
+        self.keys = keys
+        self.offsets = offsets
+        self.rows = rows
+        self._index = {key: i for i, key in enumerate(keys)}
+
+    @classmethod
+    def from_lists(cls, lists):
+        keys = list(lists)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(lists[k]) for k in keys], out=offsets[1:])
+        rows = np.concatenate(
+            [np.asarray(lists[key], dtype=np.int32) for key in keys] or
+            [np.zeros(0, dtype=np.int32)])
+        return cls(keys, offsets, rows)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        if i is None:
+            return default
+        return self.rows[self.offsets.item(i):self.offsets.item(i + 1)]
+
+
+def code_postings_key(code_idx, chr_ngram):
+    """Key of the rows of attribute code index code_idx in code_postings"""
+    return f'{code_idx}:{chr_ngram}'
+
+
+def partition_postings(postings, attribute_code_idx):
+    """
+    Split each posting list by the attribute code of its rows
+    :return: PostingLists keyed by code_postings_key(), rows still sorted
+    """
+    lists = {}
+    for chr_ngram in postings.keys:
+        rows = postings.get(chr_ngram)
+        codes = attribute_code_idx[rows]
+        order = np.argsort(codes, kind='stable')
+        rows = rows[order]
+        codes = codes[order].tolist()
+        start = 0
+        for end in range(1, len(codes) + 1):
+            if end == len(codes) or codes[end] != codes[start]:
+                lists[code_postings_key(codes[start], chr_ngram)] = \
+                    rows[start:end]
+                start = end
+    return PostingLists.from_lists(lists)
+
+
+class CompiledDictionary:
+    """
+    Integer-token, array-backed form of the lookup dictionary
+
+    Every word is mapped to an id in ``vocabulary``. Entities are stored as
+    rows (in descending max_idf order) of parallel NumPy columns, and the
+    words of row ``r`` are ``word_tokens[word_offsets[r]:word_offsets[r + 1]]``.
+    Trigram postings hold sorted, distinct row numbers (not domain_dictionary
+    ids) and already leave out the rows the trigram is insufficient for (see
+    score_entity()), so lookups use them as they are. ``code_postings`` holds
+    the same rows split by attribute code, for lookups restricted to some
+    codes.
+
+    All columns are plain arrays, so they can be written to (and memory
+    mapped from) a dictionary snapshot.
+    """
+
+    def __init__(self, words, idf, ids, entity_ids, attribute_ids,
+                 attribute_codes, attribute_code_idx, word_offsets,
+                 word_tokens, max_idf, original_text, base_values,
+                 ngram_postings, insufficient_postings, row_hashes=None,
+                 id_order=None, word_rows=None, token_initials=None,
+                 code_postings=None):
+        self.words = words
+        self.vocabulary = {word: i for i, word in enumerate(words)}
+        self.idf = idf
+        self.ids = ids
+        self.entity_ids = entity_ids
+        self.attribute_ids = attribute_ids
+        self.attribute_codes = attribute_codes
+        self.attribute_code_idx = attribute_code_idx
+        self.word_offsets = word_offsets
+        self.word_tokens = word_tokens
+        self.max_idf = max_idf
+        self.original_text = original_text
+        self.base_values = base_values
+        self.ngram_postings = ngram_postings
+        self.insufficient_postings = insufficient_postings
+        # Hash of the domain_dictionary row each entity was built from (see get_dict_item_hashes())
+        if row_hashes is None:
+            row_hashes = np.zeros(len(ids), dtype=np.int32)
+        self.row_hashes = row_hashes
+
+        # Derived columns. They are stored in snapshots so loading doesn't recompute them
+        if id_order is None:
+            id_order = np.argsort(ids, kind='stable')
+        if word_rows is None:
+            word_rows = np.repeat(np.arange(len(ids), dtype=np.int32),
+                                  np.diff(word_offsets))
+        if token_initials is None:
+            token_initials = np.array(
+                [ord(word[0]) if word else 0 for word in words],
+                dtype=np.uint32)
+        if code_postings is None:
+            code_postings = partition_postings(ngram_postings,
+                                               attribute_code_idx)
+        self.id_order = id_order
+        self.word_rows = word_rows
+        self.token_initials = token_initials
+        self.code_postings = code_postings
+        self._sorted_ids = ids[id_order]
+        self.max_word_count = int(np.diff(word_offsets).max()) if len(ids) \
+            else 0
+        self._fuzzy_index = None
+        self._idf_square_sums = None
+        self._initial_postings = None
+        self._token_postings = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_entities(cls, idf_dict, ordered_entities, inverted_index):
+        """
+        Compile the per-entity dicts produced by process_dictionary()
+        :param idf_dict: word -> idf
+        :param ordered_entities: entities sorted by max_idf (values of the ordered entities dict)
+        :param inverted_index: chr ngram -> list of domain_dictionary ids (in
+            any order, duplicates are fine)
+        :return: CompiledDictionary
+        """
+        vocabulary = {}
+        for word in idf_dict:
+            vocabulary.setdefault(word, len(vocabulary))
+        for entity in ordered_entities:
+            for word in entity['words']:
+                vocabulary.setdefault(word, len(vocabulary))
+        words = list(vocabulary)
+        idf = np.zeros(len(words), dtype=np.float64)
+        for word, value in idf_dict.items():
+            idf[vocabulary[word]] = value
+
+        attribute_codes = []
+        code_idx = {}
+        word_offsets = array.array('q', [0])
+        word_tokens = array.array('i')
+        insufficient_postings = {}
+        for row, entity in enumerate(ordered_entities):
+            code = entity['attribute_code']
+            if code not in code_idx:
+                code_idx[code] = len(attribute_codes)
+                attribute_codes.append(code)
+            word_tokens.extend(vocabulary[word] for word in entity['words'])
+            word_offsets.append(len(word_tokens))
+            for chr_ngram in entity['insufficient_ngrams']:
+                insufficient_postings.setdefault(chr_ngram, []).append(row)
+
+        ids = np.array([e['id'] for e in ordered_entities], dtype=np.int64)
+        id_order = np.argsort(ids, kind='stable')
+        sorted_ids = ids[id_order]
+        ngram_postings = {}
+        for chr_ngram, ids_list in inverted_index.items():
+            rows = np.unique(id_order[np.searchsorted(sorted_ids, ids_list)])
+            insufficient = insufficient_postings.get(chr_ngram)
+            if insufficient is not None:
+                rows = np.setdiff1d(rows, insufficient, assume_unique=True)
+            ngram_postings[chr_ngram] = rows
+
+        return cls(
+            words=words,
+            idf=idf,
+            ids=ids,
+            entity_ids=np.array([e['entity_id'] for e in ordered_entities],
+                                dtype=np.int64),
+            attribute_ids=np.array(
+                [e['attribute_id'] for e in ordered_entities], dtype=np.int64),
+            attribute_codes=attribute_codes,
+            attribute_code_idx=np.array(
+                [code_idx[e['attribute_code']] for e in ordered_entities],
+                dtype=np.int16),
+            word_offsets=np.frombuffer(word_offsets, dtype=np.int64),
+            word_tokens=np.frombuffer(word_tokens, dtype=np.int32),
+            max_idf=np.array([e['max_idf'] for e in ordered_entities],
+                             dtype=np.float64),
+            original_text=StringColumn.from_strings(
+                [e['original_text_value'] for e in ordered_entities]),
+            base_values=StringColumn.from_strings(
+                [e['base_value'] for e in ordered_entities]),
+            ngram_postings=PostingLists.from_lists(ngram_postings),
+            insufficient_postings=PostingLists.from_lists(
+                insufficient_postings),
+            row_hashes=np.array([e.get('row_hash', 0) for e in ordered_entities],
+                                dtype=np.int32),
+            id_order=id_order)
+
+    def to_entities(self):
+        """
+        Inverse of from_entities(): entity dicts in row order, used to apply
+        changes to the dictionary without reading all rows from the database
+        """
+        insufficient_ngrams = [set() for _ in range(len(self))]
+        for chr_ngram in self.insufficient_postings.keys:
+            for row in self.insufficient_postings.get(chr_ngram).tolist():
+                insufficient_ngrams[row].add(chr_ngram)
+
+        entities = []
+        for row in range(len(self)):
+            words = self.entity_words(row)
+            entities.append({'id': self.id(row),
+                             'entity_id': self.entity_id(row),
+                             'attribute_id': self.attribute_id(row),
+                             'attribute_code': self.attribute_code(row),
+                             'text_value': ' '.join(words),
+                             'original_text_value': self.original_text[row],
+                             'base_value': self.base_values[row],
+                             'words': words,
+                             'word_count': len(words),
+                             'insufficient_ngrams': insufficient_ngrams[row],
+                             'max_idf': self.max_idf.item(row),
+                             'row_hash': self.row_hashes.item(row)})
+        return entities
+
+    @property
+    def fuzzy_index(self):
+        # Built on first fuzzy lookup, most processes never need it
+        if self._fuzzy_index is None:
+            from application.db_extension.dictionary_lookup.fuzzy_index import (
+                FuzzyIndex)
+            self._fuzzy_index = FuzzyIndex(self)
+        return self._fuzzy_index
+
+    @property
+    def idf_square_sums(self):
+        """Sum of squared idf of the words of each row (an entity can't score more than that per word)"""
+        if self._idf_square_sums is None:
+            self._idf_square_sums = np.bincount(
+                self.word_rows, weights=self.idf[self.word_tokens] ** 2,
+                minlength=len(self.ids))
+        return self._idf_square_sums
+
+    def build_lazy_indexes(self):
+        """
+        Build the indexes that are otherwise built on first use (fuzzy index,
+        initial and token postings). A process that loads the dictionary and
+        then forks workers calls this first, so the workers share one copy
+        instead of each building its own.
+        """
+        self.fuzzy_index
+        self.idf_square_sums
+        self.rows_with_initial('')
+        self.rows_with_tokens([])
+
+    def row_for_id(self, entity_id):
+        """Row of the entity with domain_dictionary id ``entity_id`` (or None)"""
+        i = np.searchsorted(self._sorted_ids, entity_id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == entity_id:
+            return self.id_order.item(i)
+        return None
+
+    def encode(self, words):
+        """Convert query words to token ids (UNKNOWN_TOKEN if not in vocabulary)"""
+        vocabulary = self.vocabulary
+        return [vocabulary.get(word, UNKNOWN_TOKEN) for word in words]
+
+    def token_idf(self, token):
+        return self.idf.item(token) if token >= 0 else 0.0
+
+    def word_idf(self, word):
+        token = self.vocabulary.get(word)
+        return self.idf.item(token) if token is not None else 0.0
+
+    def entity_tokens(self, row):
+        return self.word_tokens[
+               self.word_offsets.item(row):self.word_offsets.item(row + 1)
+               ].tolist()
+
+    def entity_words(self, row):
+        return [self.words[token] for token in self.entity_tokens(row)]
+
+    def attribute_code(self, row):
+        return self.attribute_codes[self.attribute_code_idx.item(row)]
+
+    def attribute_code_indexes(self, attr_codes):
+        return [i for i, code in enumerate(self.attribute_codes)
+                if code in attr_codes]
+
+    def id(self, row):
+        return self.ids.item(row)
+
+    def entity_id(self, row):
+        return self.entity_ids.item(row)
+
+    def attribute_id(self, row):
+        return self.attribute_ids.item(row)
+
+    def word_count(self, row):
+        return self.word_offsets.item(row + 1) - self.word_offsets.item(row)
+
+    def rows_with_initial(self, initial):
+        """Sorted rows that have at least one word starting with ``initial``"""
+        if self._initial_postings is None:
+            # Built on the first query with only unknown ngrams: (initial, row) pairs, grouped by initial
+            pairs = np.unique(
+                self.token_initials[self.word_tokens].astype(np.int64) *
+                max(len(self), 1) + self.word_rows)
+            initials, rows = np.divmod(pairs, max(len(self), 1))
+            keys, starts = np.unique(initials, return_index=True)
+            offsets = np.append(starts, len(rows))
+            self._initial_postings = PostingLists(
+                [chr(key) for key in keys.tolist()], offsets,
+                rows.astype(np.int32))
+        rows = self._initial_postings.get(initial)
+        if rows is None:
+            return np.zeros(0, dtype=np.int32)
+        return rows
+
+    def rows_with_tokens(self, tokens):
+        """Sorted rows that have at least one of the (known) ``tokens``"""
+        if self._token_postings is None:
+            # Built on first use: rows of each token (in row order, the sort is stable)
+            order = np.argsort(self.word_tokens, kind='stable')
+            offsets = np.searchsorted(self.word_tokens[order],
+                                      np.arange(len(self.words) + 1))
+            self._token_postings = (offsets, self.word_rows[order])
+        offsets, rows = self._token_postings
+        found = [rows[offsets.item(token):offsets.item(token + 1)]
+                 for token in tokens]
+        if not found:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate(found))
@@ -158,9 +158,36 @@ LOOKUP_LOCAL_STOPWORDS = {'i', 'me', 'my', 'myself', 'we', 'our', 'ours', 'ourse
 LOOKUP_COMMON_WORDS = {'a', 'and', 'the', 'an', 'du', 'del', 'do', 'da', 'le', 'la', 'i', 'co',
                        'company', 'inc', 'no', 'not', 'or'}
 LOOKUP_COMMON_PENALTY = 0.90
+# Claim exact dictionary entries found in the query before scoring candidates (see find_exact_spans()).
+# Off by default: a claimed span can beat a better scored fuzzy or longer match of the same words
+LOOKUP_EXACT_SPANS = bool(int(getenv('LOOKUP_EXACT_SPANS', 0)))
+LOOKUP_EXACT_SPAN_MIN_WORDS = 2  # single words are left to the candidate scoring
 LOOKUP_STOPWORDS = list(LOOKUP_COMMON_WORDS)
+# Max candidate rows of a query whose chr ngrams are all unknown (see get_fallback_rows())
+LOOKUP_FALLBACK_MAX_ROWS = int(getenv('LOOKUP_FALLBACK_MAX_ROWS', 5000))
 
 
+# How often a process reads nlp_synonyms (and the nlp ngrams) again to see if its compiled rewriters are stale
+NLP_TABLES_CHECK_SECONDS = int(getenv('NLP_TABLES_CHECK_SECONDS', 300))
+
+# Max number of lookup() results cached in process (0 disables the cache)
+LOOKUP_CACHE_SIZE = int(getenv('LOOKUP_CACHE_SIZE', 10000))
+
+# Share of the lookups whose per-stage timings are recorded (0 disables, see lookup_stats.py)
+LOOKUP_STATS_SAMPLE_RATE = float(getenv('LOOKUP_STATS_SAMPLE_RATE', 0))
+# Log the timing histograms every n sampled lookups (0: only through the /lookup_stats API)
+LOOKUP_STATS_LOG_EVERY = int(getenv('LOOKUP_STATS_LOG_EVERY', 0))
+
+# How often a process checks for a newer pipeline run of a source than the one its brand set was built from
+SOURCE_BRANDS_CHECK_SECONDS = int(getenv('SOURCE_BRANDS_CHECK_SECONDS', 300))
+
+# How often a process checks for a newer pipeline run than the one its master products were read after
+MASTER_PRODUCTS_CHECK_SECONDS = int(getenv('MASTER_PRODUCTS_CHECK_SECONDS', 300))
+
+# attribute_lookup() engine: 'postgres' (attribute_lookup2 stored procedure, dictionary
+# lookup when it finds nothing) or 'memory' (in-memory dictionary lookup only)
+ATTRIBUTE_LOOKUP_ENGINE = getenv('ATTRIBUTE_LOOKUP_ENGINE', 'postgres')
+
 SCHEDULE_TIMEOUT_PIPELINE = int(getenv('SCHEDULE_TIMEOUT_PIPELINE', 0))
 SCHEDULE_TIMEOUT_LOOKUP = int(getenv('SCHEDULE_TIMEOUT_LOOKUP', 0))
 
@@ -169,3 +196,14 @@ SCHEDULE_TIMEOUT_LOOKUP = int(getenv('SCHEDULE_TIMEOUT_LOOKUP', 0))
 #
 REFRESH_DICTS_ON_START = bool(int(getenv('REFRESH_DICTS_ON_START', 1)))
 DICTONARY_UPDATE_TIMEOUT = int(getenv('DICTONARY_UPDATE_TIMEOUT', 60*15))
+
+#
+#   Dictionary snapshot settings
+#
+DICTIONARY_SNAPSHOT_DIR = getenv('DICTIONARY_SNAPSHOT_DIR', '/tmp/.dictionary_lookup')
+# Rebuild everything (and refit idf) once more than this share of rows changed since the last full build
+DICTIONARY_MAX_DELTA_RATIO = float(getenv('DICTIONARY_MAX_DELTA_RATIO', 0.02))
+# Processes normalizing the rows of a full build (0: one per CPU, 1: no process pool)
+DICTIONARY_BUILD_PROCESSES = int(getenv('DICTIONARY_BUILD_PROCESSES', 0))
+# Rows normalized per batch (the unit of work sent to a build process)
+DICTIONARY_BUILD_BATCH_SIZE = int(getenv('DICTIONARY_BUILD_BATCH_SIZE', 5000))
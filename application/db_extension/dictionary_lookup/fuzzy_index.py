@@ -0,0 +1,78 @@
+import threading
+
+from fuzzywuzzy import fuzz
+
+from application.db_extension.dictionary_lookup import config
+
+FUZZY_CACHE_SIZE = 100000  # max number of query words to keep probe results for
+
+
+class FuzzyIndex:
+    """
+    Finds the vocabulary words a query word fuzzy matches
+
+    A fuzzy match needs the same first char and at most 1 char length
+    difference, so the vocabulary is bucketed by (first char, length) and a
+    probe only scores the words of 3 buckets. The result of a probe is cached
+    per query word, so candidate entities only check membership.
+
+    The buckets are not modified after the index is built. The probe cache
+    is shared by the lookups of every thread, so it is only changed under a
+    lock.
+    """
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self.buckets = {}
+        for token, word in enumerate(dictionary.words):
+            if word:
+                self.buckets.setdefault((word[0], len(word)), []).append(
+                    (token, word))
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+
+    def matches(self, query_word, query_token):
+        """
+        :param query_word:
+        :param query_token: token id of query_word
+        :return: {token: fuzzy score} of the vocabulary words query_word fuzzy
+            matches, scored the same way get_matched_unmatched_words() does
+        """
+        found = self._cache.get(query_word)
+        if found is None:
+            # probing doesn't need the lock, two threads may just probe the same word
+            found = self._probe(query_word, query_token)
+            with self._cache_lock:
+                if len(self._cache) >= FUZZY_CACHE_SIZE:
+                    self._cache.clear()
+                self._cache[query_word] = found
+        return found
+
+    def _probe(self, qw, qt):
+        found = {}
+        if not qw:
+            return found
+        min_length = config.LOOKUP_MIN_FUZZY_WORD_LENGTH
+        # If the qw exists in dictionary, then make penalty a bit worse because we'd lke to
+        # favor the entity with the matching word instead of the entity that has almost the matching word
+        penalty = (100 * config.LOOKUP_FUZZY_PENALTY) \
+            if self.dictionary.token_idf(qt) else 0
+
+        # query and candidate words have to be within 1 characters in length for safety
+        for length in (len(qw) - 1, len(qw), len(qw) + 1):
+            for et, ew in self.buckets.get((qw[0], length), ()):
+                if len(qw) >= min_length and len(ew) >= min_length:
+                    fuzzy_score = fuzz.ratio(qw, ew)
+                # special logic for very short words - only support an ending 's' difference (e.g., cab vs cabs)
+                elif len(qw) == min_length - 1 or len(ew) == min_length - 1:
+                    if qw + 's' == ew or ew + 's' == qw:
+                        fuzzy_score = fuzz.ratio(qw, ew)
+                    else:
+                        continue
+                else:
+                    continue
+                if penalty:
+                    fuzzy_score -= penalty
+                if fuzzy_score > config.LOOKUP_FUZZY_THRESHOLD:
+                    found[et] = fuzzy_score
+        return found
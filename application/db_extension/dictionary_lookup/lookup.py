@@ -1,24 +1,86 @@
+import heapq
+import threading
+from contextlib import contextmanager
 from datetime import datetime
+from operator import itemgetter
 
+import numpy as np
 
 from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.compiled_dictionary import (
+    UNKNOWN_TOKEN,
+    CompiledDictionary,
+    code_postings_key)
+from application.db_extension.dictionary_lookup.lookup_cache import (
+    LookupResultCache)
+from application.db_extension.dictionary_lookup.lookup_stats import (
+    NO_TIMINGS,
+    LookupStats,
+    LookupTimings)
+from application.db_extension.dictionary_lookup.master_products import (
+    MasterProducts)
+from application.db_extension.dictionary_lookup.source_brands import (
+    BrandBitset,
+    SourceBrands)
+from application.db_extension.dictionary_lookup.snapshot import (
+    read_snapshot,
+    read_snapshot_header,
+    snapshot_lock,
+    snapshot_path,
+    write_snapshot)
 from application.logging import logger
 
 from application.db_extension.dictionary_lookup.postgres_functions import (
-    lookup_master_products)
+    fingerprint_from_hashes,
+    get_dict_item_hashes,
+    get_dict_items_fingerprint,
+    iter_dict_items_from_sql)
 from application.db_extension.dictionary_lookup.process_dictionary import (
+    apply_dictionary_delta,
     get_dict_items_from_sql,
+    convert_and_index,
     convert_to_dict_lookup,
-    create_ngrams,
     process_dictionary)
+from application.db_extension.dictionary_lookup.normalizer import (
+    NormalizedQuery,
+    normalize_query)
 from application.db_extension.dictionary_lookup.utils import (
-    remove_stopwords,
     get_starting_chr_bigrams,
 )
-from fuzzywuzzy import fuzz
 
 MIN_SCORE = 0  # minimum score to accept entity
 UNMATCHABLE = '*********'  # unmatchable token
+_WORD_FEATURES = itemgetter('score', 'idf', 'query_indx', 'cand_indx')
+SCORE_BOUND_MARGIN = 1e-9  # relative safety margin for float rounding of score upper bounds
+
+
+def build_dictionary(data, hashes=None, log_function=logger.info,
+                     timings=NO_TIMINGS):
+    """
+    Build the lookup dictionary from domain_dictionary rows (no database
+    access other than reading data)
+    :param data: iterable of rows of get_dict_items_from_sql(), e.g. streamed
+        by iter_dict_items_from_sql()
+    :param hashes: {id: row hash} of get_dict_item_hashes()
+    :param timings: LookupTimings the duration of each build phase is added to
+    :return: (CompiledDictionary, exact match dict, cutoff_idf)
+    """
+    if hashes is None:
+        hashes = {}
+    data, document_frequencies, inverted_index = convert_and_index(
+        data, log_function=log_function, timings=timings)
+    for entity in data:
+        entity['row_hash'] = hashes.get(entity['id'], 0)
+    log_function('processing dictionary')
+    res = process_dictionary(data, log_function=log_function,
+                             document_frequencies=document_frequencies,
+                             timings=timings)
+    (idf_dict, ordered_entities_dict, entities_text_id_dict, cutoff_idf) = res
+    log_function('compiling dictionary')
+    with timings.stage('compile'):
+        dictionary = CompiledDictionary.from_entities(
+            idf_dict, list(ordered_entities_dict.values()), inverted_index)
+    return dictionary, entities_text_id_dict, cutoff_idf
 
 
 class Singleton(type):
@@ -31,6 +93,263 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class LookupContext:
+    """
+    State of one lookup: the dictionary it runs against and the per-query
+    data. A query keeps the dictionary it started with, even if another
+    thread publishes a new one in the meantime.
+    """
+
+    def __init__(self, dictionary, entities_text_id_dict):
+        self.dictionary = dictionary
+        self.entities_text_id_dict = entities_text_id_dict
+        self.word_lemmas = {}
+        self.timings = NO_TIMINGS  # LookupTimings of a sampled lookup
+
+
+class RankKey:
+    """
+    order_key of a candidate and the step of get_all_matches_from_query() it
+    was set in. After each step the candidates that weren't rescored have the
+    order_key (-final_score, order_key before the step); their key is only
+    extended this way when it is compared with the key of a later step.
+    """
+    __slots__ = ('key', 'step')
+
+    def __init__(self, key, step):
+        self.key = key
+        self.step = step
+
+    def at_step(self, step):
+        key = self.key
+        for _ in range(step - self.step):
+            key = (key[0], key)
+        return key
+
+    def __lt__(self, other):
+        if self.key[0] != other.key[0]:
+            return self.key[0] < other.key[0]
+        step = max(self.step, other.step)
+        return self.at_step(step) < other.at_step(step)
+
+
+class RankedCandidates:
+    """
+    Scored candidates of a query, best first (by order_key), in a heap with
+    an index of the query positions they matched. Consuming positions only
+    touches the candidates that matched them.
+    """
+
+    def __init__(self, candidates=()):
+        self.heap = []
+        self.live = {}  # id(cand): (cand, RankKey)
+        self.by_position = {}  # query position: ids of the candidates matching it
+        self.step = 0
+        self.pushed = 0  # tie breaker for heap entries of the same candidate
+        for cand in candidates:
+            self.push(cand)
+
+    def __len__(self):
+        return len(self.live)
+
+    def __iter__(self):
+        """Candidates in no particular order"""
+        return iter([cand for cand, _ in self.live.values()])
+
+    def push(self, cand):
+        """Add a candidate scored in the current step (if its score is high enough)"""
+        if cand['final_score'] <= MIN_SCORE:
+            return
+        key = RankKey(cand['order_key'], self.step)
+        self.live[id(cand)] = (cand, key)
+        for word in cand['matched_words']:
+            self.by_position.setdefault(word['query_indx'], set()).add(
+                id(cand))
+        heapq.heappush(self.heap, (key, self.pushed, cand))
+        self.pushed += 1
+
+    def best(self, n=None):
+        """
+        :return: the n best candidates (all if None), best first
+        """
+        popped = []
+        while self.heap and (n is None or len(popped) < n):
+            entry = heapq.heappop(self.heap)
+            live = self.live.get(id(entry[2]))
+            # skip the entries of removed candidates
+            if live is not None and live[1] is entry[0]:
+                popped.append(entry)
+        for entry in popped:
+            heapq.heappush(self.heap, entry)
+        return [entry[2] for entry in popped]
+
+    def remove(self, cand):
+        del self.live[id(cand)]
+
+    def consume(self, positions):
+        """
+        Start a new step: drop the candidates that only matched positions
+        in ``positions`` and remove the ones that matched some of them
+        :return: removed candidates, to be rescored and pushed again
+            (their order_key is set to the one before the step)
+        """
+        positions = set(positions)
+        ids = set()
+        for position in positions:
+            # a consumed position can't be matched again
+            ids.update(self.by_position.pop(position, ()))
+        overlapping = []
+        for i in ids:
+            cand, key = self.live.get(i, (None, None))
+            if cand is None:
+                continue
+            cand_positions = {word['query_indx']
+                              for word in cand['matched_words']}
+            # ids of removed candidates can be reused by new ones
+            if positions.isdisjoint(cand_positions):
+                continue
+            del self.live[i]
+            if not positions.issuperset(cand_positions):
+                cand['order_key'] = key.at_step(self.step)
+                overlapping.append(cand)
+        self.step += 1
+        return overlapping
+
+
+class CandidateQueue:
+    """
+    Candidate entity rows of a query that haven't been scored yet, in
+    descending order of their score upper bound (MaxScore style)
+
+    get_all_matches_from_query() only ever looks at the 2 best candidates, so
+    candidates are scored until none of the remaining ones can beat the 2nd
+    best. Scoring a candidate late replays the rescoring steps done since the
+    query started, so the ranking is the same as scoring every candidate
+    upfront. Ties are ordered by ``order_key``: the candidate's score after
+    each step, then its position in the original candidate list.
+    """
+
+    MIN_BATCH_SIZE = 8
+    MAX_BATCH_SIZE = 512
+
+    def __init__(self, lookup, rows, bounds, words_in_query, query_tokens,
+                 cats, disallow_brand, is_allow_fuzzy, all_match_words,
+                 source_brand_list, is_human):
+        self.lookup = lookup
+        order = np.argsort(-bounds, kind='stable')
+        self.rows = [rows[i] for i in order.tolist()]
+        self.positions = order.tolist()
+        self.bounds = (bounds[order] * (1 + SCORE_BOUND_MARGIN)).tolist()
+        self.next = 0
+        self.words_in_query = words_in_query
+        self.query_tokens = query_tokens
+        self.fuzzy_matches = lookup.get_fuzzy_matches(
+            words_in_query, query_tokens, is_allow_fuzzy)
+        self.cats = cats
+        self.disallow_brand = disallow_brand
+        self.all_match_words = all_match_words
+        self.source_brand_list = source_brand_list
+        self.is_human = is_human
+        self.steps = []
+
+    def __len__(self):
+        return len(self.rows) - self.next
+
+    def add_step(self, top_words_indexes, words_in_query, query_tokens,
+                 disallow_brand, remove_brands):
+        """Record an extracted entity (one iteration of get_all_matches_from_query())"""
+        self.steps.append({'top_words_indexes': top_words_indexes,
+                           'words_in_query': words_in_query,
+                           'query_tokens': query_tokens,
+                           'disallow_brand': disallow_brand,
+                           'remove_brands': remove_brands})
+
+    def fill(self, ranked, top_n=2):
+        """
+        Score queued candidates until none of the remaining ones can rank in
+        the top_n of ranked (all of them if top_n is None). Candidates are
+        scored in growing batches, so score_candidates() sees many at once;
+        scoring a few more than needed doesn't change the ranking.
+        :param ranked: RankedCandidates of the scored candidates
+        """
+        batch_size = self.MIN_BATCH_SIZE
+        while self.next < len(self.rows):
+            end = len(self.rows) if top_n is None else \
+                min(self.next + batch_size, len(self.rows))
+            best = ranked.best(top_n) if top_n is not None else []
+            if top_n is not None and len(best) >= top_n:
+                threshold = best[-1]['final_score']
+                if self.bounds[self.next] < threshold:
+                    break
+                while self.bounds[end - 1] < threshold:
+                    end -= 1
+            for cand in self.score(self.next, end):
+                ranked.push(cand)
+            self.next = end
+            batch_size = min(batch_size * 2, self.MAX_BATCH_SIZE)
+
+    def score(self, start, end):
+        """
+        Score the queued candidates start to end and replay the steps done
+        since the query started
+        :return: candidates still in the running
+        """
+        lookup = self.lookup
+        timings = lookup.timings
+        candidates = []
+        positions = {}
+        with timings.stage('get_candidate_entities'):
+            for row, position in zip(self.rows[start:end],
+                                     self.positions[start:end]):
+                cand = lookup.get_row_candidate(self.words_in_query,
+                                                self.query_tokens, row,
+                                                self.source_brand_list,
+                                                self.disallow_brand,
+                                                self.fuzzy_matches,
+                                                self.is_human)
+                if cand:
+                    candidates.append(cand)
+                    positions[id(cand)] = position
+        timings.count('scored_candidates', len(candidates))
+        with timings.stage('score_candidates'):
+            scored = lookup.score_candidates(self.words_in_query, candidates,
+                                             self.cats, self.all_match_words,
+                                             self.source_brand_list)
+        for cand in scored:
+            cand['order_key'] = (-cand['final_score'], positions[id(cand)])
+        for step in self.steps:
+            remaining = []
+            overlapping = []
+            for cand in scored:
+                if cand['final_score'] <= MIN_SCORE:
+                    continue
+                if step['remove_brands'] and \
+                        lookup.dictionary.attribute_code(cand['row']) == 'brand':
+                    continue
+                ent_words_indexes = [w['query_indx']
+                                     for w in cand['matched_words']]
+                if set(ent_words_indexes).issubset(step['top_words_indexes']):
+                    continue
+                elif set(ent_words_indexes).intersection(
+                        step['top_words_indexes']):
+                    overlapping.append(cand)
+                else:
+                    remaining.append(cand)
+            rescored = lookup.rescore_rows([cand['row'] for cand in overlapping],
+                                           step['words_in_query'],
+                                           step['query_tokens'],
+                                           step['disallow_brand'],
+                                           self.all_match_words)
+            for cand, new_cand in zip(overlapping, rescored):
+                if new_cand:
+                    new_cand['order_key'] = cand['order_key']
+                    remaining.append(new_cand)
+            for cand in remaining:
+                cand['order_key'] = (-cand['final_score'], cand['order_key'])
+            scored = remaining
+        return [cand for cand in scored if cand['final_score'] > MIN_SCORE]
+
+
 class DictionaryLookupClass(metaclass=Singleton):
     """
     Implements dictionary lookup logic
@@ -44,14 +363,75 @@ class DictionaryLookupClass(metaclass=Singleton):
         """
         Load dictionary data
         """
-        self.word_idf_dict = None
-        self.ngram_inverted_index = None
-        self.entities_text_id_dict = None
-        self.entities_dict = None
+        # (CompiledDictionary, exact match dict), replaced as a whole and never modified
+        self._index = (None, None)
+        # active LookupContext of each thread (or greenlet, when gevent patched threading)
+        self._local = threading.local()
         self._updated = False
         self._files = []
-        self.word_lemma_dictionary_for_query = {}
         self.last_time_dictionary_updated = None
+        self.dictionary_version = None
+        self.dictionary_fingerprint = None
+        self.cutoff_idf = None
+        self.delta_rows = 0  # rows changed incrementally since the last full build
+        self.result_cache = LookupResultCache(config.LOOKUP_CACHE_SIZE)
+        self.stats = LookupStats(config.LOOKUP_STATS_SAMPLE_RATE,
+                                 config.LOOKUP_STATS_LOG_EVERY, logger.info)
+        self.source_brands = SourceBrands()
+        self.master_products = MasterProducts()
+
+    @property
+    def context(self):
+        return getattr(self._local, 'context', None)
+
+    @contextmanager
+    def query_context(self):
+        """
+        Run a query in its own LookupContext. Contexts nest: an inner one
+        keeps the dictionary and the timings of the outer one.
+        """
+        outer = self.context
+        self._local.context = LookupContext(self.dictionary,
+                                            self.entities_text_id_dict)
+        if outer:
+            self._local.context.timings = outer.timings
+        try:
+            yield self._local.context
+        finally:
+            self._local.context = outer
+
+    @property
+    def dictionary(self):
+        context = self.context
+        return context.dictionary if context else self._index[0]
+
+    @property
+    def timings(self):
+        """LookupTimings of the current lookup (NO_TIMINGS if it isn't sampled)"""
+        context = self.context
+        return context.timings if context else NO_TIMINGS
+
+    @dictionary.setter
+    def dictionary(self, dictionary):
+        self._index = (dictionary, self._index[1])
+
+    @property
+    def entities_text_id_dict(self):
+        context = self.context
+        return context.entities_text_id_dict if context else self._index[1]
+
+    @entities_text_id_dict.setter
+    def entities_text_id_dict(self, entities_text_id_dict):
+        self._index = (self._index[0], entities_text_id_dict)
+
+    def publish_dictionary(self, dictionary, entities_text_id_dict):
+        """Make a new dictionary visible to the lookups started from now on"""
+        self._index = (dictionary, entities_text_id_dict)
+
+    @property
+    def word_lemma_dictionary_for_query(self):
+        context = self.context
+        return context.word_lemmas if context else {}
 
     def get_dict_entity_for_str(self, s):
         return self.entities_text_id_dict.get(s, None)
@@ -64,7 +444,8 @@ class DictionaryLookupClass(metaclass=Singleton):
 
         for code in ordered_codes:
             for i in found:
-                if self.entities_dict[i]['attribute_code'] == code:
+                row = self.dictionary.row_for_id(i)
+                if self.dictionary.attribute_code(row) == code:
                     return i
         # Code should always be found if code list is passed in, but if empty then just return the first id
         return found[0]
@@ -86,56 +467,121 @@ class DictionaryLookupClass(metaclass=Singleton):
 
         return max_run
 
-    def get_bigram_lists(self, bigrams, attr_codes):
-        all_entities = []
+    def get_ngram_rows(self, chr_ngram, code_idx=None):
+        """
+        Sorted rows of the entities indexed under chr_ngram (only those of
+        attribute code index code_idx if given), except those for which it is
+        too common to count as a match on its own (filtered when the
+        dictionary is compiled)
+        """
+        dictionary = self.dictionary
+        if code_idx is None:
+            rows = dictionary.ngram_postings.get(chr_ngram)
+        else:
+            rows = dictionary.code_postings.get(
+                code_postings_key(code_idx, chr_ngram))
+        if rows is None:
+            return np.zeros(0, dtype=np.int32)
+        return rows
+
+    def get_bigram_lists(self, bigrams, attr_codes, ngram_rows=None,
+                         words_in_query=None, query_tokens=None,
+                         is_allow_fuzzy=False):
+        """
+        Rows of the candidate entities of the query chr ngrams. A lookup
+        restricted to attr_codes only reads the postings of those codes.
+        :param ngram_rows: optional (chr ngram, code index) -> rows cache shared by the queries of a batch
+        :param words_in_query: query words (and their tokens) to bound the
+            rows of a query with only unknown ngrams, see get_fallback_rows()
+        """
+        dictionary = self.dictionary
+        # Constrain attributes to optional constrained list in attr_codes
+        is_restricted = bool(attr_codes and len(attr_codes) > 0)
+        code_indexes = dictionary.attribute_code_indexes(attr_codes) \
+            if is_restricted else [None]
+        found = []
         for chr_ngram in bigrams:
-            if chr_ngram in self.ngram_inverted_index:
-                ids_to_add = [i for i in self.ngram_inverted_index[chr_ngram]
-                              if chr_ngram not in self.entities_dict[i][
-                                  'insufficient_ngrams']]
-                all_entities.extend(ids_to_add)
+            for code_idx in code_indexes:
+                if ngram_rows is None:
+                    rows = self.get_ngram_rows(chr_ngram, code_idx)
+                else:
+                    rows = ngram_rows.get((chr_ngram, code_idx))
+                    if rows is None:
+                        rows = ngram_rows[chr_ngram, code_idx] = \
+                            self.get_ngram_rows(chr_ngram, code_idx)
+                if len(rows):
+                    found.append(rows)
+        # Each posting list is sorted and distinct already
+        if len(found) == 1:
+            all_entities = found[0]
+        elif found:
+            all_entities = np.unique(np.concatenate(found))
+        else:
+            all_entities = np.zeros(0, dtype=np.int32)
 
         # If the query contains only unknown ngrams (e.g., 'rred' will be 'rre' which doesn't match anything)
         # then we will include all entities that have same first letter as first ngram. This will be slow but
         # better than missing word.
         # DO WE NEED TO MODIFY THIS TO LOOK AT ALL INPUT BIGRAMS INSTEAD OF JUST FIRST ONE?
-        if len(all_entities) == 0 and len(bigrams) > 0:
-            for i, (k, v) in enumerate(self.entities_dict.items()):
-                if bigrams[0][0] in [word[0] for word in
-                                     v['text_value'].split()]:
-                    all_entities.append(k)
-
-        # Constrain attributes to optional constrained list in attr_codes
-        if attr_codes and len(attr_codes) > 0:
-            all_entities = [entity for entity in all_entities if
-                            self.entities_dict[entity][
-                                'attribute_code'] in attr_codes]
-
-        return set(all_entities)
-
-    @staticmethod
-    def product_lookup2(brand_node_id, source_id, category_id, orig_sentence):
-        product_objs = lookup_master_products(source_id, category_id,
-                                              brand_node_id,
-                                              orig_sentence.split())
-        prod_words = []
-        for prod in product_objs:
-            # Convert null to empty string for later processing
-            prod['non_attribute_words'] = prod['non_attribute_words'] if prod[
-                'non_attribute_words'] else ''
-            prod_words.extend(prod['non_attribute_words'].split())
-
-        # remove any products that don't have any overlapping non_attribute_words
-        products = [product for product in product_objs if
-                    len(set(
-                        product['non_attribute_words'].split()).intersection(
-                        set(orig_sentence.split()))) > 0]
-        return products
+        # (a restricted lookup only falls back if the ngrams are unknown for every attribute code)
+        if len(all_entities) == 0 and len(bigrams) > 0 and (
+                not is_restricted or not any(
+                    len(self.get_ngram_rows(chr_ngram))
+                    for chr_ngram in bigrams)):
+            all_entities = self.get_fallback_rows(
+                bigrams[0][0], code_indexes if is_restricted else None,
+                words_in_query, query_tokens, is_allow_fuzzy)
+
+        # Rows are in dictionary (max_idf) order, which also makes score ties
+        # resolve deterministically
+        return list(all_entities)
+
+    def get_fallback_rows(self, initial, code_indexes, words_in_query,
+                          query_tokens, is_allow_fuzzy):
+        """
+        Rows of a query none of whose chr ngrams is indexed: the entities with
+        a word starting with initial. Given the query words, only those that
+        have one of the query words or a word one of them fuzzy matches,
+        since the others can't become candidates. Capped at
+        LOOKUP_FALLBACK_MAX_ROWS rows (the first ones, i.e. highest max_idf).
+        :param code_indexes: attribute code indexes to restrict the rows to
+        """
+        dictionary = self.dictionary
+        timings = self.timings
+        with timings.stage('get_fallback_rows'):
+            rows = dictionary.rows_with_initial(initial)
+            if words_in_query is not None:
+                tokens = {token for token in query_tokens if token >= 0}
+                fuzzy_matches = self.get_fuzzy_matches(
+                    words_in_query, query_tokens, is_allow_fuzzy)
+                for matches in fuzzy_matches or ():
+                    tokens.update(matches)
+                rows = np.intersect1d(
+                    rows, dictionary.rows_with_tokens(sorted(tokens)),
+                    assume_unique=True)
+            if code_indexes is not None:
+                rows = rows[np.isin(dictionary.attribute_code_idx[rows],
+                                    code_indexes)]
+            timings.count('fallback_rows', len(rows))
+            if len(rows) > config.LOOKUP_FALLBACK_MAX_ROWS:
+                logger.debug(f'{len(rows)} fallback rows for initial '
+                             f'"{initial}", keeping '
+                             f'{config.LOOKUP_FALLBACK_MAX_ROWS}')
+                rows = rows[:config.LOOKUP_FALLBACK_MAX_ROWS]
+        return rows
+
+    def product_lookup2(self, brand_node_id, source_id, category_id, words):
+        """
+        Master products of the brand that share one of the query words,
+        those of source_id first
+        """
+        return self.master_products.get(category_id).match(
+            brand_node_id, source_id, words)
 
     def format_as_predicate_syntax(self, entities):
         attribs = []
         for entity in entities:
-            value = self.entities_dict[entity['id']]['base_value']
+            value = self.dictionary.base_values[entity['row']]
             value = entity['text'] if not value else value
             obj = {'code': entity['attribute_code'],
                    'value': value,
@@ -154,48 +600,44 @@ class DictionaryLookupClass(metaclass=Singleton):
             attribs.append(obj)
         return attribs
 
-    def get_matched_unmatched_words(self, words_in_query, words_in_entity,
-                                    is_allow_fuzzy, is_brand):
+    def get_fuzzy_matches(self, words_in_query, query_tokens, is_allow_fuzzy):
+        """
+        :return: for each query word {token: fuzzy score} of the vocabulary words it fuzzy matches
+            (or None if fuzzy matching is not allowed)
+        """
+        if not is_allow_fuzzy:
+            return None
+        fuzzy_index = self.dictionary.fuzzy_index
+        return [fuzzy_index.matches(qw, qt)
+                for qw, qt in zip(words_in_query, query_tokens)]
+
+    def get_matched_unmatched_words(self, words_in_query, query_tokens,
+                                    entity_tokens, fuzzy_matches, is_brand):
+        # Words are compared by token id; fuzzy_matches holds the precomputed fuzzy matches of each query word
+        dictionary = self.dictionary
         matched_words = []
         unmatched_words = []
         indices_matched = []
         lemmas = self.word_lemma_dictionary_for_query
-        for ei, ew in enumerate(words_in_entity):
-            # if ew not in self.word_idf_dict: # skip if not in dictionary
-            #    continue
+        for ei, et in enumerate(entity_tokens):
+            ew = dictionary.words[et]
             match_found = False
-            for qi, qw in enumerate(words_in_query):
+            for qi, qt in enumerate(query_tokens):
+                if qi in indices_matched:
+                    continue
+                qw = words_in_query[qi]
                 # if exact match, add as is
-                if ew == qw and qi not in indices_matched:
-                    idf = self.word_idf_dict.get(ew, 0)
+                if et == qt:
+                    idf = dictionary.token_idf(et)
                     matched_words.append(
                         {'query_indx': qi, 'cand_indx': ei, 'score': 1.0,
                          'token': ew, 'query_token': qw, 'idf': idf})
                     match_found = True
                     indices_matched.append(qi)
                     break
-                # Do fuzzy check if not exact (must have same first char)
-                elif qw[0] == ew[0] and is_allow_fuzzy:
-
-                    if len(qw) >= config.LOOKUP_MIN_FUZZY_WORD_LENGTH and len(
-                            ew) >= config.LOOKUP_MIN_FUZZY_WORD_LENGTH:
-                        fuzzy_score = fuzz.ratio(qw, ew)
-                    # special logic for very short words - only support an ending 's' difference (e.g., cab vs cabs and not brand)
-                    elif len(
-                            qw) == config.LOOKUP_MIN_FUZZY_WORD_LENGTH - 1 or len(
-                        ew) == config.LOOKUP_MIN_FUZZY_WORD_LENGTH - 1:
-
-                        # if is_brand and (qw + 's' == ew or ew + 's' == qw):
-                        if qw + 's' == ew or ew + 's' == qw:
-                            fuzzy_score = fuzz.ratio(qw, ew)
-                        else:
-                            continue
-                    else:
-                        continue
-                    # If the qw exists in dictionary, then make penalty a bit worse because we'd lke to
-                    # favor the entity with the matching word instead of the entity that has almost the matching word
-                    if self.word_idf_dict.get(qw, None):
-                        fuzzy_score -= (100 * config.LOOKUP_FUZZY_PENALTY)
+                # Do fuzzy check if not exact (same first char, length and score rules are applied by the index)
+                elif fuzzy_matches is not None and et in fuzzy_matches[qi]:
+                    fuzzy_score = fuzzy_matches[qi][et]
 
                     # idf is minimum of qw, ew and cutoff value.
                     # Also check against lemma and use that if we have it and its idf is lower than query word
@@ -206,13 +648,13 @@ class DictionaryLookupClass(metaclass=Singleton):
                         logger.warning(f'Lemma for word not found: "{qw}"')
                         logger.warning(f'Lemmas are: {lemmas}')
                         logger.warning(f'words_in_query: {words_in_query}, '
-                                       f'words_in_entity: {words_in_entity}, '
-                                       f'is_allow_fuzzy: {is_allow_fuzzy}')
+                                       f'words_in_entity: {[dictionary.words[t] for t in entity_tokens]}, '
+                                       f'is_allow_fuzzy: True')
                         lemma = qw
                         # raise e
-                    query_lemma_idf = self.word_idf_dict.get(lemma, 0)
-                    query_word_idf = self.word_idf_dict.get(qw, 0)
-                    entity_word_idf = self.word_idf_dict.get(ew, 0)
+                    query_lemma_idf = dictionary.word_idf(lemma)
+                    query_word_idf = dictionary.token_idf(qt)
+                    entity_word_idf = dictionary.token_idf(et)
                     if query_lemma_idf > 0 and (
                             query_lemma_idf < query_word_idf or query_word_idf == 0):
                         idf = min(query_lemma_idf, entity_word_idf,
@@ -224,50 +666,49 @@ class DictionaryLookupClass(metaclass=Singleton):
                         idf = min(entity_word_idf,
                                   config.LOOKUP_HIGHER_IDF_CUTOFF)
 
-                    # query and candidate words have to be within 1 characters in length for safety
-                    max_length_diff = 1
-                    length_diff = abs(len(qw) - len(ew))
-                    if fuzzy_score > config.LOOKUP_FUZZY_THRESHOLD and length_diff <= max_length_diff and qi not in indices_matched:
-                        matched_words.append(
-                            {'query_indx': qi, 'cand_indx': ei,
-                             'score': fuzzy_score / 100.0,
-                             'token': ew, 'query_token': qw, 'idf': idf})
-                        match_found = True
-                        indices_matched.append(qi)
-                        break
+                    matched_words.append(
+                        {'query_indx': qi, 'cand_indx': ei,
+                         'score': fuzzy_score / 100.0,
+                         'token': ew, 'query_token': qw, 'idf': idf})
+                    match_found = True
+                    indices_matched.append(qi)
+                    break
             # Don't count common word as unmatched
             if match_found is False:
                 # Calculate idf for unmatched word which will be minimum of query word and high cutoff
                 # We use the high cutoff because if we don't even find query word we still want to penalize
                 # idf = min(self.word_idf_dict.get(qw,999), config.LOOKUP_HIGHER_IDF_CUTOFF)
-                idf = self.word_idf_dict.get(ew, 0)
+                idf = dictionary.token_idf(et)
                 unmatched_words.append(
                     {'query_indx': qi, 'cand_indx': -1, 'score': 0.0,
                      'token': ew, 'idf': idf})
 
         return matched_words, unmatched_words
 
-    def get_candidate(self, query, entity_id, disallow_brand,
-                      is_allow_fuzzy) -> dict:
+    def get_candidate(self, words_in_query, query_tokens, row, disallow_brand,
+                      is_allow_fuzzy, fuzzy_matches=None) -> dict:
         """
         Get candidate for the query
-        :param query:
-        :param entity_id:
+        :param words_in_query:
+        :param query_tokens: token ids of words_in_query
+        :param row: dictionary row of the entity
         :param disallow_brand:
         :param is_allow_fuzzy:
+        :param fuzzy_matches: get_fuzzy_matches() of the query, if already known
         :return: bool
         """
-        entity_obj = self.entities_dict.get(entity_id, None)
-        if not entity_obj:
-            return {}
-        is_brand = entity_obj['attribute_code'] == 'brand'
+        dictionary = self.dictionary
+        is_brand = dictionary.attribute_code(row) == 'brand'
         if disallow_brand and is_brand:
             return {}
 
         matched_words, unmatched_words = self.get_matched_unmatched_words(
-            query.split(),
-            entity_obj['words'],
-            is_allow_fuzzy,
+            words_in_query,
+            query_tokens,
+            dictionary.entity_tokens(row),
+            fuzzy_matches if fuzzy_matches is not None else
+            self.get_fuzzy_matches(words_in_query, query_tokens,
+                                   is_allow_fuzzy),
             is_brand)
         if not matched_words:
             return {}
@@ -279,266 +720,354 @@ class DictionaryLookupClass(metaclass=Singleton):
                 if any([word for word in matched_words if
                         word['score'] < 1.0]):
                     return {}
-        return {'id': entity_id,
-                'text': entity_obj['original_text_value'],
+        return self._make_candidate(row, matched_words, unmatched_words)
+
+    def _make_candidate(self, row, matched_words, unmatched_words):
+        dictionary = self.dictionary
+        return {'id': dictionary.id(row),
+                'row': row,
+                'text': dictionary.original_text[row],
                 'matched_words': matched_words,
-                'is_require_all_words': entity_obj.get('is_require_all_words'),
                 'unmatched_words': unmatched_words,
-                'word_count': entity_obj['word_count'],
-                'entity_id': entity_obj['entity_id']}
+                'word_count': dictionary.word_count(row),
+                'entity_id': dictionary.entity_id(row)}
 
-    def get_candidate_entities(self, words_in_query, entities_ids,
+    def get_candidate_entities(self, words_in_query, query_tokens, rows,
                                source_brand_list, disallow_brand,
                                is_allow_fuzzy, is_human):
         candidates = []
+        fuzzy_matches = self.get_fuzzy_matches(words_in_query, query_tokens,
+                                               is_allow_fuzzy)
 
-        for ent in entities_ids:
-            # TODO use check_candidate here
-            entity_obj = self.entities_dict.get(ent, None)
-            if not entity_obj:
-                continue
-            is_brand = entity_obj['attribute_code'] == 'brand'
-            # Skip over brand entity if we are disallowed to have brand
-            if disallow_brand and is_brand:
-                continue
+        for row in rows:
+            cand = self.get_row_candidate(words_in_query, query_tokens, row,
+                                          source_brand_list, disallow_brand,
+                                          fuzzy_matches, is_human)
+            if cand:
+                candidates.append(cand)
 
-            matched_words, unmatched_words = self.get_matched_unmatched_words(
-                words_in_query,
-                entity_obj['words'],
-                is_allow_fuzzy,
-                is_brand)
-            if matched_words:
-                # Do a check on brand. If we have a brand and that brand is not sold by the current source, then we require that
-                # all of the matched words for the brand must be spelled correctly (although we don't necessarily require all words)
-                # So if we had the brand "Manya" but not sold by the store, and our input was "many", that would not match
-                # But we only restrict for human interacions ... we can be more flexible for pipeline processing because
-                # we should assume that the vast majority of times the brand names will be legal
-                if is_brand and is_human:
-                    if entity_obj['entity_id'] not in source_brand_list:
-
-                        less_than_two_words = len(entity_obj['words']) < 2
-
-                        missing_words = sorted(entity_obj['words']) != sorted(
-                            [w['token'] for w in matched_words]
-                        )
-                        
-                        fuzzy_match = any([w for w in matched_words if
-                                           w['score'] < 1.0])
-
-                        if less_than_two_words or missing_words or fuzzy_match:
-                            continue
-
-                candidates.append(
-                    {'id': ent,
-                     'text': entity_obj['original_text_value'],
-                     'matched_words': matched_words,
-                     'is_require_all_words': entity_obj.get(
-                         'is_require_all_words'),
-                     'unmatched_words': unmatched_words,
-                     'word_count': entity_obj['word_count'],
-                     'entity_id': entity_obj['entity_id']}
+        return candidates
+
+    def get_row_candidate(self, words_in_query, query_tokens, row,
+                          source_brand_list, disallow_brand, fuzzy_matches,
+                          is_human):
+        dictionary = self.dictionary
+        # TODO use check_candidate here
+        is_brand = dictionary.attribute_code(row) == 'brand'
+        # Skip over brand entity if we are disallowed to have brand
+        if disallow_brand and is_brand:
+            return None
+
+        entity_tokens = dictionary.entity_tokens(row)
+        matched_words, unmatched_words = self.get_matched_unmatched_words(
+            words_in_query,
+            query_tokens,
+            entity_tokens,
+            fuzzy_matches,
+            is_brand)
+        if not matched_words:
+            return None
+        # Do a check on brand. If we have a brand and that brand is not sold by the current source, then we require that
+        # all of the matched words for the brand must be spelled correctly (although we don't necessarily require all words)
+        # So if we had the brand "Manya" but not sold by the store, and our input was "many", that would not match
+        # But we only restrict for human interacions ... we can be more flexible for pipeline processing because
+        # we should assume that the vast majority of times the brand names will be legal
+        if is_brand and is_human:
+            if dictionary.entity_id(row) not in source_brand_list:
+
+                less_than_two_words = len(entity_tokens) < 2
+
+                missing_words = sorted(
+                    dictionary.entity_words(row)
+                ) != sorted(
+                    [w['token'] for w in matched_words]
                 )
 
-        return candidates
+                fuzzy_match = any([w for w in matched_words if
+                                   w['score'] < 1.0])
 
-    def score_candidates(self, words_in_query, candidates, cats,
-                         all_match_words, source_brand_list):
-        curr_max_score = -1
-        scored_candidates = []
-        for cand in candidates:
-            matched_score = 0
-            unmatched_score = 0
-            # found_fuzzy_match = False
-            try:
-                attr_code = self.entities_dict[cand['id']]['attribute_code']
-            except BaseException:
-                raise
-            matched_words = cand['matched_words']
-            unmatched_words = cand['unmatched_words']
-            matched_word_count = len(matched_words)
-            unmatched_word_count = len(unmatched_words)
+                if less_than_two_words or missing_words or fuzzy_match:
+                    return None
 
-            # If brand and only one word attribute, must match exactly if < X chars
-            min_word_letters = 5
-            if attr_code == 'brand' \
-                    and cand['word_count'] == 1 \
-                    and matched_word_count == 1 \
-                    and matched_words[0]['score'] != 1.0 \
-                    and len(matched_words[0]['token']) <= min_word_letters:
-                cand['final_score'] = -1
-                cand['brand_one_word_needs_correct_spelling'] = True
-                continue
+        return self._make_candidate(row, matched_words, unmatched_words)
+
+    def get_score_bounds(self, rows, words_in_query):
+        """
+        Upper bound of the final score of each entity row for the query (see score_candidates()).
+        Each matched word adds at most idf^2, times the largest ngram and perfect bonuses. Unmatched
+        words only lower the score, except for a brand late in a long query: there the brand position
+        penalty is > 1 and turns a negative score positive.
+        """
+        dictionary = self.dictionary
+        rows = np.asarray(rows, dtype=np.int64)
+        idf_square_sums = dictionary.idf_square_sums[rows]
+        word_counts = np.diff(dictionary.word_offsets)[rows]
+        ngram_bonus = np.where(word_counts > 1,
+                               1.0 + config.LOOKUP_NGRAM_BONUS * word_counts,
+                               1.0)
+        bounds = idf_square_sums * ngram_bonus * config.LOOKUP_PERFECT_BONUS
+        max_brand_pos_penalty = config.LOOKUP_BRAND_PENALTY * (
+                1 + 0.1 * (len(words_in_query) - 1))
+        if max_brand_pos_penalty > 1:
+            is_brand = np.isin(dictionary.attribute_code_idx[rows],
+                               dictionary.attribute_code_indexes(['brand']))
+            brand_bounds = 2 * idf_square_sums * config.LOOKUP_PERFECT_BONUS \
+                * (max_brand_pos_penalty - 1)
+            bounds = np.where(is_brand, np.maximum(bounds, brand_bounds),
+                              bounds)
+        return bounds
+
+    def rescore_candidate(self, row, words_in_query, query_tokens,
+                          disallow_brand, all_match_words):
+        """
+        Score a candidate again after some of the query words were extracted
+        :return: scored candidate or None
+        """
+        return self.rescore_rows([row], words_in_query, query_tokens,
+                                 disallow_brand, all_match_words)[0]
 
+    def rescore_rows(self, rows, words_in_query, query_tokens, disallow_brand,
+                     all_match_words):
+        """
+        rescore_candidate() of several rows, scored together
+        :return: list aligned with rows of scored candidates (or None)
+        """
+        if not rows:
+            return []
+        timings = self.timings
+        with timings.stage('get_candidate_entities'):
+            fuzzy_matches = self.get_fuzzy_matches(
+                words_in_query, query_tokens, is_allow_fuzzy=True)
+            candidates = [self.get_candidate(words_in_query, query_tokens,
+                                             row, disallow_brand,
+                                             is_allow_fuzzy=True,
+                                             fuzzy_matches=fuzzy_matches)
+                          for row in rows]
+        timings.count('rescored_candidates', len(rows))
+        with timings.stage('score_candidates'):
+            scored = self.score_candidates(
+                words_in_query,
+                [cand for cand in candidates if cand],
+                ('wine', 'wines'),
+                all_match_words,
+                []
+            )
+        scored = {id(cand): cand for cand in scored}
+        return [scored.get(id(cand)) for cand in candidates]
+
+    def score_candidates(self, words_in_query, candidates, cats,
+                         all_match_words, source_brand_list, explain=False):
+        """
+        Score candidates and drop the disqualified ones. The word features of
+        all candidates are packed into flat arrays (one entry per matched or
+        unmatched word, with the index of its candidate), so the rules and
+        scores are computed for all candidates at once.
+        :param explain: also mark the candidates with the rule that
+            disqualified them, and the matched/unmatched words with their
+            adjusted_idf (for debugging, slower)
+        :return: scored candidates, best first
+        """
+        n = len(candidates)
+        if not n:
+            return []
+        dictionary = self.dictionary
+        common_words = config.LOOKUP_COMMON_WORDS
+        brand_code_idx = dictionary.attribute_code_indexes(('brand',)) or [-1]
+        is_brand = dictionary.attribute_code_idx[
+            [cand['row'] for cand in candidates]] == brand_code_idx[0]
+        word_count = np.array([cand['word_count'] for cand in candidates],
+                              dtype=np.int64)
+        require_all = np.array([bool(cand.get('is_require_all_words'))
+                                for cand in candidates], dtype=bool)
+        matched_count = np.array([len(cand['matched_words'])
+                                  for cand in candidates], dtype=np.int64)
+        unmatched_count = np.array([len(cand['unmatched_words'])
+                                    for cand in candidates], dtype=np.int64)
+        # matched words of all candidates, candidate by candidate
+        m_words = [word for cand in candidates
+                   for word in cand['matched_words']]
+        m_score, m_idf, m_qi, m_ci = np.array(
+            list(map(_WORD_FEATURES, m_words)), dtype=float).T
+        m_tokens = [word['token'] for word in m_words]
+        m_len = np.array(list(map(len, m_tokens)), dtype=np.int64)
+        m_common = np.array([token in common_words for token in m_tokens],
+                            dtype=bool)
+        m_cat = np.array([token in cats for token in m_tokens], dtype=bool)
+        m_attr_word = np.array([word['token'] in all_match_words or
+                                word['query_token'] in all_match_words
+                                for word in m_words], dtype=bool)
+        m_cand = np.repeat(np.arange(n), matched_count)
+        m_offsets = np.cumsum(matched_count) - matched_count
+        # same for the unmatched words
+        u_words = [word for cand in candidates
+                   for word in cand['unmatched_words']]
+        u_idf = np.array([word['idf'] for word in u_words], dtype=float)
+        u_common = np.array([word['token'] in common_words
+                             for word in u_words], dtype=bool)
+        u_cand = np.repeat(np.arange(n), unmatched_count)
+        u_offsets = np.cumsum(unmatched_count) - unmatched_count
+
+        def count(cand_indexes, mask):
+            return np.bincount(cand_indexes[mask], minlength=n)
+
+        # candidates always have a matched word, so these are their first ones
+        first_score = m_score[m_offsets]
+        first_len = m_len[m_offsets]
+        first_query_indx = m_qi[m_offsets]
+        min_idf_cutoff = config.LOOKUP_MIN_IDF_CUTOFF
+        high_idf_matched = count(m_cand, m_idf > min_idf_cutoff)
+        high_idf_unmatched = count(u_cand, u_idf > min_idf_cutoff)
+        low_idf_unmatched = count(u_cand, u_idf < min_idf_cutoff)
+        has_fuzzy = count(m_cand, m_score < 1.0) > 0
+        has_attr_word = count(m_cand, m_attr_word) > 0
+        longest_matched = np.maximum.reduceat(m_len, m_offsets)
+        has_unmatched = unmatched_count > 0
+        highest_unmatched_idf = np.full(n, -np.inf)
+        if len(u_idf):
+            # empty groups are skipped, so each group ends where the next one starts
+            highest_unmatched_idf[has_unmatched] = np.maximum.reduceat(
+                u_idf, u_offsets[has_unmatched])
+
+        # Disqualification rules, in the order they are checked
+        rules = (
+            # If brand and only one word attribute, must match exactly if < X chars
+            ('brand_one_word_needs_correct_spelling',
+             is_brand & (word_count == 1) & (matched_count == 1) &
+             (first_score != 1.0) & (first_len <= 5)),
             # Special case check if candidate only has low matched idf words, then we require a perfect match
             # (no unmatched words and no fuzzy match)
-            found_higher_idf_words = [word for word in matched_words if word[
-                'idf'] > config.LOOKUP_MIN_IDF_CUTOFF]
-            fuzzy_matched_words = [word for word in matched_words if
-                                   word['score'] < 1.0]
-            found_fuzzy_match = len(fuzzy_matched_words) > 0
-            if (len(found_higher_idf_words) == 0) \
-                    and (
-                    unmatched_word_count > 0 or len(fuzzy_matched_words) > 0):
-                cand['final_score'] = -1
-                cand['all_low_idf_not_all_words_founds'] = True
-                continue
-
+            ('all_low_idf_not_all_words_founds',
+             (high_idf_matched == 0) & (has_unmatched | has_fuzzy)),
             # Special case if term has any unmmatched words > min idf cutoff and no higher matched words
-            found_highest_idf_matched = [word for word in matched_words if
-                                         word[
-                                             'idf'] > config.LOOKUP_MIN_IDF_CUTOFF]
-            found_highest_idf_unmatched = [word for word in unmatched_words if
-                                           word[
-                                               'idf'] > config.LOOKUP_MIN_IDF_CUTOFF]
-            if len(found_highest_idf_matched) == 0 and len(
-                    found_highest_idf_unmatched) > 0:
-                cand['final_score'] = -1
-                cand['found_high_idf_unmatched_in_brand'] = True
-                continue
-
-            # If has requires all words flag, then make sure there
-            # are no unmatched words
-            if cand.get('is_require_all_words') and unmatched_word_count > 0:
-                cand['final_score'] = -1
-                cand['brand_did_not_have_all_required_words'] = True
-                continue
-
+            ('found_high_idf_unmatched_in_brand',
+             (high_idf_matched == 0) & (high_idf_unmatched > 0)),
+            # If has requires all words flag, then make sure there are no unmatched words
+            ('brand_did_not_have_all_required_words',
+             require_all & has_unmatched),
             # If a brand has a word that is an attribute name, require that it includes all lower IDF words
             #  This is to avoid problems like "price vineyards" vs. "price".
-            if attr_code == 'brand' and (
-                    unmatched_word_count > 0 or found_fuzzy_match):
-                found_attr_words = [word for word in matched_words if
-                                    (word['token'] in all_match_words or word[
-                                        'query_token'] in all_match_words)]
-                if found_attr_words:
-                    cand['final_score'] = -1
-                    cand['brand_had_attr_word_and_unmatched_words'] = True
-                    continue
-
+            ('brand_had_attr_word_and_unmatched_words',
+             is_brand & (has_unmatched | has_fuzzy) & has_attr_word),
             # Check to see if matching brand has at least a word of > X chars if there are unmatched_words
-            if attr_code == 'brand' and unmatched_word_count > 0:
-                min_length_to_match = 4
-                if max([len(word['token']) for word in
-                        matched_words]) < min_length_to_match:
-                    cand['final_score'] = -1
-                    cand['brand_has_too_short_word_match'] = True
-                    continue
-
+            ('brand_has_too_short_word_match',
+             is_brand & has_unmatched & (longest_matched < 4)),
             # If we only have one word match and idf of unmatched is high, then skip
-            if matched_word_count == 1 and unmatched_word_count > 0:
-                high_unmatched_idf = max(
-                    [word['idf'] for word in unmatched_words])
-                if high_unmatched_idf > config.LOOKUP_HIGHER_IDF_CUTOFF:
-                    cand['final_score'] = -1
-                    cand['one_word_match_with_high_idf_unmatched'] = True
-                    continue
-
+            ('one_word_match_with_high_idf_unmatched',
+             (matched_count == 1) & has_unmatched &
+             (highest_unmatched_idf > config.LOOKUP_HIGHER_IDF_CUTOFF)),
             # If we only have one word match and at least two words unmatched, then require that the
             # one matching word is spelled correctly
-            if matched_word_count == 1 and unmatched_word_count >= 2:
-                if matched_words[0]['score'] < 1.0:
-                    cand['final_score'] = -1
-                    cand['one_word_match_not_perfect'] = True
-                    continue
-
-            # Special check if matched word includes a category name (e.g., wine or wines) and there
-            # are also unmatched words, then don't give credit for category word
-            found_cat_words = [word for word in matched_words if
-                               word['token'] in cats]
-            if len(found_cat_words) > 0 and unmatched_word_count > 0:
-                for word in found_cat_words:
-                    word['idf'] = 0
-
-            tf = 1  # ignore term frequency
-            for index, word in enumerate(matched_words):
-                # Logic to deal with getting lowest idf of query and candidate word if fuzzy match
-                # if word['score'] < 1.0:
-                #    found_fuzzy_match = True
-
-                word['adjusted_idf'] = word['idf'] * word['idf']
-                # If word is in common list, then we'll reduce penalty
-                common_adjust = (1 - config.LOOKUP_COMMON_PENALTY) if (
-                        word['token'] in config.LOOKUP_COMMON_WORDS) else 1.0
-                tfidf_score = tf * word['adjusted_idf'] * common_adjust
-
-                # Square fuzzy score for more penalty
-                matched_score += (word['score'] * word['score']) * tfidf_score
-
-            for index, word in enumerate(unmatched_words):
-                # we always use idf of candidate term for unmatched words cuz there aren't any matching query words
-                word['adjusted_idf'] = word['idf'] * word['idf']
-                tfidf_score = tf * word['adjusted_idf']
-                # If word is in common list, then we'll reduce penalty
-                common_adjust = (1 - config.LOOKUP_COMMON_PENALTY) if (
-                        word['token'] in config.LOOKUP_COMMON_WORDS) else 1.0
-                unmatched_score += tfidf_score * common_adjust
-
-            # Determine if we have ngram bonus to give
-            # ngram_bonus is a bonus we apply to words in a run (ngram)
-            # But don't include words with zero idf (category words if there are unmatched words)
-            run_length = self.get_run_length(
-                [word for word in matched_words if word['idf'] > 0])
-            ngram_bonus = (1.0 + (
-                    config.LOOKUP_NGRAM_BONUS * run_length)) if run_length > 1 else 1.0
-            matched_score *= ngram_bonus
-
-            # Give extra credit if we cover all words with no typos
-            perfect_bonus = 1.0
-            if not found_fuzzy_match and unmatched_word_count == 0:
-                perfect_bonus = config.LOOKUP_PERFECT_BONUS
-                if len(words_in_query) == cand['word_count']:
-                    cand['is_exact_match'] = True
-            else:
-                # Since not a perfect match, make sure that at least one matching word has a idf that is above
-                # the low (common) threshold we set before. This is to avoid matching something like 'la winery'
-                # just because the word 'winery' is in query. Only apply when > 1 word in candidate
-                # Let's also include the ngram bonus which is our proxy for a real ngram. If we find an ngram_bonus > 1
-                # then let's not disqualify. e.g., 'alexandr valley' --> this would normally get rejected because
-                # alexandr is not perfect match and valley is a common word.
-                # But since we have the two together, it's ok.
-                if len(found_higher_idf_words) == 0 and cand[
-                    'word_count'] > 1 and ngram_bonus == 1:
-                    # make score negative so it won't get included. Also mark all words as unmatched
-                    cand['unmatched_words'].extend(matched_words)
-                    cand['matched_words'] = []
-                    cand['is_low_idf'] = True
-                    matched_score = 0
-                    unmatched_score = 10000
-
-                # If we only have low idf unmatched words, reduce unmatched_score because people often omit these
-                found_low_idf_unmatched_words = [word for word in
-                                                 unmatched_words if
-                                                 word[
-                                                     'idf'] < config.LOOKUP_MIN_IDF_CUTOFF]
-                if len(found_low_idf_unmatched_words) == unmatched_word_count:
-                    unmatched_score *= 0.2
-
-            # Adjust scores
-            matched_factor = 1.0
-            unmatched_factor = 2.0 if attr_code == 'brand' else 1.0
-
-            cand['matched_score'] = matched_score * matched_factor
-            cand['unmatched_score'] = unmatched_score * unmatched_factor
-
-            cand['final_score'] = (cand['matched_score'] - cand[
-                'unmatched_score']) * perfect_bonus
-
-            # Apply special brand logic, but make sure we haven't already disqualified due to low idfs
-            if attr_code == 'brand' and not cand.get('is_low_idf', False):
-                # Penalize if a brand to give preference to non-brands
-                # Increase penalty if first brand word is later in string
-                first_brand_word_pos = matched_words[0]['query_indx']
-                brand_pos_penalty = config.LOOKUP_BRAND_PENALTY * (
-                        1 + 0.1 * first_brand_word_pos)
-                cand['brand_pos_penalty'] = brand_pos_penalty
-                cand['final_score'] *= (1 - brand_pos_penalty)
-
+            ('one_word_match_not_perfect',
+             (matched_count == 1) & (unmatched_count >= 2) &
+             (first_score < 1.0)),
+        )
+        disqualified = np.zeros(n, dtype=bool)
+        for flag, mask in rules:
+            if explain:
+                for i in np.flatnonzero(mask & ~disqualified).tolist():
+                    candidates[i]['final_score'] = -1
+                    candidates[i][flag] = True
+            disqualified |= mask
+
+        # Special check if matched word includes a category name (e.g., wine or wines) and there
+        # are also unmatched words, then don't give credit for category word
+        m_zero_idf = m_cat & has_unmatched[m_cand]
+        m_idf = np.where(m_zero_idf, 0.0, m_idf)
+
+        # If word is in common list, then we'll reduce penalty. Square fuzzy score for more penalty
+        common_adjust = 1 - config.LOOKUP_COMMON_PENALTY
+        m_adjusted_idf = m_idf * m_idf
+        m_weight = (m_score * m_score) * (
+                m_adjusted_idf * np.where(m_common, common_adjust, 1.0))
+        matched_score = np.bincount(m_cand, weights=m_weight, minlength=n)
+        # we always use idf of candidate term for unmatched words cuz there aren't any matching query words
+        u_adjusted_idf = u_idf * u_idf
+        u_weight = u_adjusted_idf * np.where(u_common, common_adjust, 1.0)
+        unmatched_score = np.bincount(u_cand, weights=u_weight, minlength=n)
+
+        # Determine if we have ngram bonus to give
+        # ngram_bonus is a bonus we apply to words in a run (ngram): the length of the last run of
+        # consecutive query and candidate words (see get_run_length()).
+        # But don't include words with zero idf (category words if there are unmatched words)
+        run_words = np.flatnonzero(m_idf > 0)
+        run_cand = m_cand[run_words]
+        run_breaks = np.ones(len(run_words), dtype=bool)
+        run_qi = m_qi[run_words]
+        run_ci = m_ci[run_words]
+        run_breaks[1:] = (run_cand[1:] != run_cand[:-1]) | \
+            (run_qi[1:] - run_qi[:-1] != 1) | (run_ci[1:] - run_ci[:-1] != 1)
+        run_starts = np.maximum.accumulate(
+            np.where(run_breaks, np.arange(len(run_words)), 0))
+        run_counts = np.bincount(run_cand, minlength=n)
+        run_ends = np.cumsum(run_counts) - 1
+        run_length = np.ones(n, dtype=np.int64)
+        has_run = run_counts > 0
+        run_length[has_run] = run_ends[has_run] - run_starts[run_ends[has_run]] + 1
+        ngram_bonus = np.where(run_length > 1,
+                               1.0 + config.LOOKUP_NGRAM_BONUS * run_length,
+                               1.0)
+        matched_score = matched_score * ngram_bonus
+
+        # Give extra credit if we cover all words with no typos
+        is_perfect = ~has_fuzzy & ~has_unmatched
+        perfect_bonus = np.where(is_perfect, config.LOOKUP_PERFECT_BONUS, 1.0)
+        is_exact_match = is_perfect & (word_count == len(words_in_query))
+        # Not a perfect match: at least one matching word must have an idf above the low (common)
+        # threshold, e.g. to avoid matching 'la winery' just because 'winery' is in the query. The
+        # all_low_idf_not_all_words_founds rule above already disqualifies these candidates.
+        # If we only have low idf unmatched words, reduce unmatched_score because people often omit these
+        unmatched_score = np.where(
+            ~is_perfect & (low_idf_unmatched == unmatched_count),
+            unmatched_score * 0.2, unmatched_score)
+
+        # Adjust scores
+        unmatched_score = unmatched_score * np.where(is_brand, 2.0, 1.0)
+        final_score = (matched_score - unmatched_score) * perfect_bonus
+
+        # Penalize if a brand to give preference to non-brands
+        # Increase penalty if first brand word is later in string
+        brand_pos_penalty = config.LOOKUP_BRAND_PENALTY * (
+                1 + 0.1 * first_query_indx)
+        final_score = np.where(is_brand, final_score * (1 - brand_pos_penalty),
+                               final_score)
+
+        kept = np.flatnonzero(~disqualified)
+        # stable, like sorted(reverse=True): ties keep the candidates' order
+        kept = kept[np.argsort(-final_score[kept], kind='stable')].tolist()
+        zero_idf_cands = set(m_cand[m_zero_idf].tolist())
+        matched_score = matched_score.tolist()
+        unmatched_score = unmatched_score.tolist()
+        final_score = final_score.tolist()
+        is_exact_match = is_exact_match.tolist()
+        is_brand = is_brand.tolist()
+        brand_pos_penalty = brand_pos_penalty.tolist()
+        if explain:
+            m_adjusted_idf = m_adjusted_idf.tolist()
+            u_adjusted_idf = u_adjusted_idf.tolist()
+            m_offsets = m_offsets.tolist()
+            u_offsets = u_offsets.tolist()
+        scored_candidates = []
+        for i in kept:
+            cand = candidates[i]
+            if i in zero_idf_cands:
+                for word in cand['matched_words']:
+                    if word['token'] in cats:
+                        word['idf'] = 0
+            cand['matched_score'] = matched_score[i]
+            cand['unmatched_score'] = unmatched_score[i]
+            cand['final_score'] = final_score[i]
+            if is_exact_match[i]:
+                cand['is_exact_match'] = True
+            if is_brand[i]:
+                cand['brand_pos_penalty'] = brand_pos_penalty[i]
+            if explain:
+                for j, word in enumerate(cand['matched_words'],
+                                         m_offsets[i]):
+                    word['adjusted_idf'] = m_adjusted_idf[j]
+                for j, word in enumerate(cand['unmatched_words'],
+                                         u_offsets[i]):
+                    word['adjusted_idf'] = u_adjusted_idf[j]
             scored_candidates.append(cand)
-            curr_max_score = max(curr_max_score, cand['final_score'])
-
-        scored_candidates = sorted(scored_candidates,
-                                   key=lambda x: x['final_score'],
-                                   reverse=True)
         return scored_candidates
 
     @staticmethod
@@ -553,14 +1082,36 @@ class DictionaryLookupClass(metaclass=Singleton):
     def find_matches(self, query, disallow_brand, is_allow_fuzzy, source_id,
                      ordered_codes,
                      category_id, all_match_words, source_brand_list,
-                     attr_codes, is_human):
+                     attr_codes, is_human, ngram_rows=None):
+        """
+        :return: all scored candidates for the query
+        """
+        matched, queue = self.find_candidates(
+            query, disallow_brand, is_allow_fuzzy, source_id, ordered_codes,
+            category_id, all_match_words, source_brand_list, attr_codes,
+            is_human, ngram_rows)
+        if queue is not None:
+            ranked = RankedCandidates(matched)
+            queue.fill(ranked, top_n=None)
+            matched = ranked.best()
+        return self.rescore_candidates(matched)
+
+    def find_candidates(self, query, disallow_brand, is_allow_fuzzy, source_id,
+                        ordered_codes,
+                        category_id, all_match_words, source_brand_list,
+                        attr_codes, is_human, ngram_rows=None):
+        """
+        :return: (scored candidates, CandidateQueue of candidates not scored yet or None)
+        """
         # Search for early exit if query is identical to dictionary entry
-
-        exact_match = self.find_exact_match(query, disallow_brand,
-                                            ordered_codes, attr_codes)
+        timings = self.timings
+        with timings.stage('find_exact_match'):
+            exact_match = self.find_exact_match(query, disallow_brand,
+                                                ordered_codes, attr_codes)
         if exact_match:
             # print("exact match: ", exact_match['text'])
-            return [exact_match]
+            exact_match['order_key'] = (-exact_match['final_score'], 0)
+            return [exact_match], None
 
         # Get the category name(s) - e.g., wine, wines. Because we see this word often in input sentences,
         #  we want to restrict matching when it occurs so we don't match "white wine sauce" to "white wine"
@@ -568,6 +1119,7 @@ class DictionaryLookupClass(metaclass=Singleton):
 
         # modified_query = cleanup_string(query)
         words_in_query = query.split()
+        query_tokens = self.dictionary.encode(words_in_query)
 
         # print(words_in_query)
         # print("get_starting_chr_bigrams", datetime.datetime.now().time())
@@ -575,73 +1127,128 @@ class DictionaryLookupClass(metaclass=Singleton):
         # duplicate bigrams to avoid duplicate lists
         chr_ngrams = list(set(chr_ngrams))
         # print("get_bigram_list", datetime.datetime.now().time())
-        subset_entities_ids = self.get_bigram_lists(chr_ngrams, attr_codes)
-        # print("get_candidate_entities", datetime.datetime.now().time())
-        candidates = self.get_candidate_entities(words_in_query,
-                                                 subset_entities_ids,
-                                                 source_brand_list,
-                                                 disallow_brand,
-                                                 is_allow_fuzzy,
-                                                 is_human)
-        # print("score_candidates", datetime.datetime.now().time())
-        # print('candidate count: ', len(candidates))
-        scored_candidates = self.score_candidates(words_in_query, candidates,
-                                                  cats, all_match_words,
-                                                  source_brand_list)
-        # print("done with find_matches", datetime.datetime.now().time())
-        final_scored_candidates = self.rescore_candidates(scored_candidates)
-
-        return final_scored_candidates
+        with timings.stage('get_bigram_lists'):
+            subset_entity_rows = self.get_bigram_lists(
+                chr_ngrams, attr_codes, ngram_rows, words_in_query,
+                query_tokens, is_allow_fuzzy)
+        timings.count('candidates', len(subset_entity_rows))
+        # Candidates are scored lazily, best upper bound first
+        queue = CandidateQueue(self, subset_entity_rows,
+                               self.get_score_bounds(subset_entity_rows,
+                                                     words_in_query),
+                               words_in_query, query_tokens, cats,
+                               disallow_brand, is_allow_fuzzy, all_match_words,
+                               source_brand_list, is_human)
+        return [], queue
 
     def find_exact_match(self, query, disallow_brand, ordered_codes,
                          attr_codes):
         # This is for simple, fast exact matching of query to one dictionary item
         # Exclude brand if that flag is set and we find brand
+        dictionary = self.dictionary
         found_ids = self.entities_text_id_dict.get(query, None)
         if not found_ids:
             return None
         # In case we have multiple ids
         found_id = found_ids if isinstance(found_ids, int) else found_ids[0]
-        if self.entities_dict[found_id][
-            'attribute_code'] == 'brand' and disallow_brand:
+        found_code = dictionary.attribute_code(dictionary.row_for_id(found_id))
+        if found_code == 'brand' and disallow_brand:
             return None
         # Make sure it's in our allowed attribute code list
-        if len(attr_codes) > 0 and self.entities_dict[found_id][
-            'attribute_code'] not in attr_codes:
+        if len(attr_codes) > 0 and found_code not in attr_codes:
             return None
 
         if isinstance(found_ids, int):
-            found_entity = self.entities_dict[found_ids]
+            found_row = dictionary.row_for_id(found_ids)
         # If we have more than one potential attribute for this key then disambiguate
         elif isinstance(found_ids, list):
             # If we need to limit based on attr_codes
             if len(attr_codes) > 0:
                 found_ids = [i for i in found_ids if
-                             self.entities_dict[found_id][
-                                 'attribute_code'] in attr_codes]
+                             dictionary.attribute_code(
+                                 dictionary.row_for_id(i)) in attr_codes]
 
             found_id = self.disambiguate_multiple_entities(found_ids,
                                                            ordered_codes)
             if not found_id:
                 return None
 
-            found_entity = self.entities_dict[found_id]
+            found_row = dictionary.row_for_id(found_id)
 
         # Format same as if we did normal search.
         # First get maximum idf of matched words
-        max_idf = max(
-            [self.word_idf_dict[word] for word in found_entity['words']])
+        max_idf = max([dictionary.token_idf(token) for token in
+                       dictionary.entity_tokens(found_row)])
 
-        return {'id': found_entity['id'], 'is_exact_match': True,
-                'text': found_entity['original_text_value'],
+        return {'id': dictionary.id(found_row), 'row': found_row,
+                'is_exact_match': True,
+                'text': dictionary.original_text[found_row],
                 'matched_score': 1000.0, 'unmatched_score': 0.0,
                 'final_score': 1000.0,
                 'matched_words': [{'query_indx': 0, 'idf': max_idf},
-                                  {'query_indx': found_entity[
-                                                     'word_count'] - 1,
+                                  {'query_indx': dictionary.word_count(
+                                      found_row) - 1,
                                    'idf': max_idf}],
                 'unmatched_words': []}
 
+    def find_exact_spans(self, words_in_query, query_tokens, disallow_brand,
+                         is_single_brand, attr_codes):
+        """
+        Fast path for queries made of exact dictionary entries (e.g., brand + region + varietal): probe
+        entities_text_id_dict with windows of consecutive query words, longest first. A window is claimed
+        if it is an entry of a single entity and no other entry window of the same or a greater length
+        overlaps it (then the candidate scoring decides).
+        :return: claimed entities (find_exact_match() format, with the query positions of their words)
+        """
+        dictionary = self.dictionary
+        entities_text_id_dict = self.entities_text_id_dict
+        min_words = config.LOOKUP_EXACT_SPAN_MIN_WORDS
+        # words that can't be part of an entry: extracted, stopwords, not in the vocabulary
+        blocked = [token == UNKNOWN_TOKEN or word == UNMATCHABLE
+                   for word, token in zip(words_in_query, query_tokens)]
+        claimed = []
+        brands = 0
+        for length in range(min(dictionary.max_word_count,
+                                len(words_in_query)), min_words - 1, -1):
+            found = []
+            for start in range(len(words_in_query) - length + 1):
+                if any(blocked[start:start + length]):
+                    continue
+                found_ids = entities_text_id_dict.get(
+                    ' '.join(words_in_query[start:start + length]))
+                if found_ids:
+                    found.append((start, found_ids))
+            for i, (start, found_ids) in enumerate(found):
+                is_ambiguous = not isinstance(found_ids, int) or any(
+                    abs(start - other) < length
+                    for j, (other, _) in enumerate(found) if j != i)
+                row = None if is_ambiguous else dictionary.row_for_id(found_ids)
+                code = dictionary.attribute_code(row) if row is not None \
+                    else None
+                if is_ambiguous or (attr_codes and code not in attr_codes) or \
+                        (code == 'brand' and disallow_brand):
+                    continue
+                brands += code == 'brand'
+                claimed.append({
+                    'id': found_ids, 'row': row,
+                    'text': dictionary.original_text[row],
+                    'matched_score': 1000.0, 'unmatched_score': 0.0,
+                    'final_score': 1000.0,
+                    'matched_words': [
+                        {'query_indx': start + k,
+                         'idf': dictionary.token_idf(query_tokens[start + k])}
+                        for k in range(length)],
+                    'unmatched_words': []})
+            # shorter windows can't overlap the ones found at this length
+            for start, _ in found:
+                blocked[start:start + length] = [True] * length
+        if is_single_brand and brands > 1:
+            # the candidate scoring picks one of the brands
+            claimed = [ent for ent in claimed
+                       if dictionary.attribute_code(ent['row']) != 'brand']
+        return sorted(claimed, key=lambda ent: ent['matched_words'][0][
+            'query_indx'])
+
     @staticmethod
     def get_top_entity(matched_entities):
         if matched_entities:
@@ -664,14 +1271,14 @@ class DictionaryLookupClass(metaclass=Singleton):
                         return entity
         return None
 
-    def convert_to_result(self, entity, query):
+    def convert_to_result(self, entity, words_in_query):
         start = entity['matched_words'][0]['query_indx']
         end = entity['matched_words'][-1]['query_indx'] + 1
-        original = ' '.join(query.split()[start:end])
-        dict_entity = self.entities_dict[entity['id']]
-        entity['attribute_id'] = dict_entity['attribute_id']
-        entity['attribute_code'] = dict_entity['attribute_code']
-        entity['entity_id'] = dict_entity['entity_id']
+        original = ' '.join(words_in_query[start:end])
+        row = entity['row']
+        entity['attribute_id'] = self.dictionary.attribute_id(row)
+        entity['attribute_code'] = self.dictionary.attribute_code(row)
+        entity['entity_id'] = self.dictionary.entity_id(row)
         entity['start'] = entity['matched_words'][0]['query_indx']
         entity['end'] = entity['matched_words'][-1]['query_indx']
         # Let's include the maximum matched word idf with result to support any downstream analysis that may
@@ -681,111 +1288,131 @@ class DictionaryLookupClass(metaclass=Singleton):
         entity['original'] = original
         return entity
 
-    def get_all_matches_from_query(self, query, stopword_indexes,
+    def get_all_matches_from_query(self, normalized_query,
                                    is_single_brand, is_disallow_brand,
                                    is_allow_fuzzy,
                                    source_id, category_id, ordered_codes,
                                    all_match_words, source_brand_list,
-                                   attr_codes, orig_sentence,
+                                   attr_codes,
                                    check_for_products,
-                                   is_human):
+                                   is_human, ngram_rows=None):
         products, results = [], []
-        # Need to track the original query so we can track the extracted word positions correctly
-        orig_query_words = query.split()
-        query = ' '.join(
-            [word if i not in stopword_indexes else UNMATCHABLE for i, word in
-             enumerate(query.split())])
-        already_processed = list(stopword_indexes)
-        words_in_query = query.split()
+        # The query words, with UNMATCHABLE at the positions of stopwords and extracted words
+        stopword_indexes = normalized_query.stopword_indexes
+        words_in_query = [word if i not in stopword_indexes else UNMATCHABLE
+                          for i, word in enumerate(normalized_query.words)]
+        query = ' '.join(words_in_query)
         if is_allow_fuzzy:
-            self.word_lemma_dictionary_for_query = dict(
+            self.context.word_lemmas = dict(
                 zip(words_in_query, words_in_query))
         else:
-            self.word_lemma_dictionary_for_query = dict(
+            self.context.word_lemmas = dict(
                 zip(words_in_query, words_in_query))
-        matched = self.find_matches(query, is_disallow_brand, is_allow_fuzzy,
-                                    source_id, ordered_codes, category_id,
-                                    all_match_words, source_brand_list,
-                                    attr_codes, is_human)
-        while query.strip():
-            # Remove any entities below MIN_SCORE
-            matched = [e for e in matched if e['final_score'] > MIN_SCORE]
-            matched = self.check_top_matches(matched, source_brand_list)
-            top = self.get_top_entity(matched)
-            # top =
-            if not top or not top.get('id') or top.get('final_score',
-                                                       -1) < MIN_SCORE:
-                break
-            # extract top entity
-            entity_obj = self.entities_dict.get(top['id'], None)
-            is_brand = entity_obj['attribute_code'] == 'brand'
-            if is_brand:
-                if top['id'] not in source_brand_list:
-                    pass
-            # If the top match is a brand, then we check to see if that brand (id)
-            # is in the source_brand_list. If it is, then we accept it as the selected entity. 
-            # If it's not in the list, then we only accept it as the entity if:
-            # 
-            # All words are included, and
-            # There are no fuzzy matches (only exact matches)
-            # If it fails 1 or 2, then skip that entity and move on to the next one and evaluate that.
-            # 
-            # In other words, if they refer to a brand that is not sold by the store then it has to be an exact match.
-
-            results.append(self.convert_to_result(top, query))
-            # Remove brands if we already got one and we're only supposed to have one
-            if is_single_brand and top['attribute_code'] == 'brand':
-                matched = [e for e in matched if self.entities_dict[e['id']][
-                    'attribute_code'] != 'brand']
-            matched = [e for e in matched if e is not top]
-            # remove the words at matched_words.query_idx from the query string.
-            top_words_indexes = [w['query_indx'] for w in top['matched_words']]
-            already_processed += top_words_indexes
-            query = ' '.join(
-                [w if i not in already_processed else UNMATCHABLE for i, w in
-                 enumerate(orig_query_words)])
-            if top.get('is_exact_match'):
-                query = UNMATCHABLE  # no remaining words
-                break  # exit on exact match
-
-            rescored = []
-            for i, ent in enumerate(matched[:]):
-                ent_words_indexes = [w['query_indx'] for w in
-                                     ent['matched_words']]
-                if set(ent_words_indexes).issubset(top_words_indexes):
-                    pass
-                elif set(ent_words_indexes).intersection(top_words_indexes):
-                    #  re-score this one term using score_candidates()
-                    cand = self.get_candidate(query, ent['id'],
+        query_tokens = self.dictionary.encode(words_in_query)
+        unmatchable_token = self.dictionary.encode([UNMATCHABLE])[0]
+        timings = self.timings
+        if config.LOOKUP_EXACT_SPANS and \
+                query not in self.entities_text_id_dict:
+            with timings.stage('find_exact_spans'):
+                spans = self.find_exact_spans(words_in_query, query_tokens,
                                               is_disallow_brand,
-                                              is_allow_fuzzy=True)
+                                              is_single_brand, attr_codes)
+            for span in spans:
+                results.append(self.convert_to_result(span, words_in_query))
+                for word in span['matched_words']:
+                    words_in_query[word['query_indx']] = UNMATCHABLE
+                    query_tokens[word['query_indx']] = unmatchable_token
+                if span['attribute_code'] == 'brand':
+                    is_disallow_brand = is_disallow_brand or is_single_brand
+                    if check_for_products:
+                        with timings.stage('product_lookup2'):
+                            products = self.product_lookup2(
+                                span['entity_id'], source_id, category_id,
+                                normalized_query.words)
+            query = ' '.join(words_in_query)
+        if any(word != UNMATCHABLE for word in words_in_query):
+            matched, queue = self.find_candidates(query, is_disallow_brand,
+                                                  is_allow_fuzzy, source_id,
+                                                  ordered_codes, category_id,
+                                                  all_match_words,
+                                                  source_brand_list,
+                                                  attr_codes, is_human,
+                                                  ngram_rows)
+        else:
+            matched, queue = [], None  # all words were claimed
+        ranked = RankedCandidates(matched)
+        with timings.stage('extraction'):
+            while words_in_query:
+                # Score the candidates that can still make it to the top
+                if queue is not None:
+                    queue.fill(ranked)
+                matched = self.check_top_matches(ranked.best(2), source_brand_list)
+                top = self.get_top_entity(matched)
+                # top =
+                if not top or not top.get('id') or top.get('final_score',
+                                                           -1) < MIN_SCORE:
+                    break
+                # extract top entity
+                is_brand = self.dictionary.attribute_code(top['row']) == 'brand'
+                if is_brand:
+                    if top['id'] not in source_brand_list:
+                        pass
+                # If the top match is a brand, then we check to see if that brand (id)
+                # is in the source_brand_list. If it is, then we accept it as the selected entity. 
+                # If it's not in the list, then we only accept it as the entity if:
+                # 
+                # All words are included, and
+                # There are no fuzzy matches (only exact matches)
+                # If it fails 1 or 2, then skip that entity and move on to the next one and evaluate that.
+                # 
+                # In other words, if they refer to a brand that is not sold by the store then it has to be an exact match.
+
+                results.append(self.convert_to_result(top, words_in_query))
+                if top.get('is_exact_match'):
+                    words_in_query = []  # no remaining words
+                    break  # exit on exact match
+                # Remove brands if we already got one and we're only supposed to have one
+                remove_brands = is_single_brand and top['attribute_code'] == 'brand'
+                if remove_brands:
+                    for ent in ranked:
+                        if self.dictionary.attribute_code(ent['row']) == 'brand':
+                            ranked.remove(ent)
+                # remove the words at matched_words.query_idx from the query
+                top_words_indexes = [w['query_indx'] for w in top['matched_words']]
+                words_in_query = list(words_in_query)
+                query_tokens = list(query_tokens)
+                for i in top_words_indexes:
+                    words_in_query[i] = UNMATCHABLE
+                    query_tokens[i] = unmatchable_token
+
+                # re-score the candidates that matched some of the extracted words (all at once)
+                overlapping = ranked.consume(top_words_indexes)
+                candidates = self.rescore_rows([ent['row'] for ent in overlapping],
+                                               words_in_query, query_tokens,
+                                               is_disallow_brand, all_match_words)
+                for ent, cand in zip(overlapping, candidates):
                     if cand:
-                        scored_candidate = self.score_candidates(
-                            query.split(),
-                            [cand],
-                            ('wine', 'wines'),
-                            all_match_words,
-                            []
+                        cand['order_key'] = (-cand['final_score'],
+                                             ent['order_key'])
+                        ranked.push(cand)
+                if queue is not None:
+                    queue.add_step(top_words_indexes, words_in_query,
+                                   query_tokens, is_disallow_brand, remove_brands)
+
+                is_brand = top['attribute_code'] == 'brand'
+                # If we have a brand, then check to see if we have any products.
+                is_disallow_brand = is_brand and is_single_brand
+                if is_brand and check_for_products:
+                    with timings.stage('product_lookup2'):
+                        products = self.product_lookup2(
+                            top['entity_id'],
+                            source_id,
+                            category_id,
+                            normalized_query.words
                         )
-                        if scored_candidate:
-                            rescored.append(scored_candidate[0])
-                else:
-                    rescored.append(ent)
-            matched = sorted([e for e in rescored],
-                             key=lambda k: k['final_score'], reverse=True)
-
-            is_brand = top['attribute_code'] == 'brand'
-            # If we have a brand, then check to see if we have any products.
-            is_disallow_brand = is_brand and is_single_brand
-            if is_brand and check_for_products:
-                products = self.product_lookup2(
-                    top['entity_id'],
-                    source_id,
-                    category_id,
-                    orig_sentence
-                )
+        timings.count('entities', len(results))
         product_ids = [p['master_product_id'] for p in products]
-        remaining_words_indexes = [i for i, w in enumerate(query.split()) if
+        remaining_words_indexes = [i for i, w in enumerate(words_in_query) if
                                    w != UNMATCHABLE]
         return results, product_ids, set(remaining_words_indexes)
 
@@ -797,12 +1424,12 @@ class DictionaryLookupClass(metaclass=Singleton):
 
         if len(matched_entities) >= 2:
 
-            print("*** matched entities:", matched_entities[0:10])
+            logger.debug('matched entities: %s', matched_entities[0:2])
 
-            is_brand1 = self.entities_dict[matched_entities[0]['id']][
-                            'attribute_code'] == 'brand'
-            is_brand2 = self.entities_dict[matched_entities[1]['id']][
-                            'attribute_code'] == 'brand'
+            is_brand1 = self.dictionary.attribute_code(
+                matched_entities[0]['row']) == 'brand'
+            is_brand2 = self.dictionary.attribute_code(
+                matched_entities[1]['row']) == 'brand'
             if is_brand1 and is_brand2:
                 min_brand_score = min(matched_entities[0]['final_score'],
                                       matched_entities[1]['final_score'])
@@ -825,9 +1452,64 @@ class DictionaryLookupClass(metaclass=Singleton):
     def lookup(self, source_id, s, is_single_brand=True, is_disallow_brand=False,
                is_allow_fuzzy=False, ordered_codes=None, all_match_words=None,
                source_brand_list=None, attr_codes=None, check_for_products=False,
-               is_human=False):
+               is_human=False, ngram_rows=None):
+        """
+        :param s: cleaned sentence, or the NormalizedQuery of one (see
+            normalize_query())
+        """
+        source_brand_list = self.get_source_brand_list(
+            source_id, source_brand_list, is_human)
+        # The whole lookup (cache included) uses the dictionary published when it started
+        with self.query_context() as context:
+            # Products depend on more than the dictionary, so only cache lookups without them
+            if check_for_products:
+                return self._lookup_uncached(
+                    source_id, s, is_single_brand, is_disallow_brand,
+                    is_allow_fuzzy, ordered_codes, all_match_words,
+                    source_brand_list, attr_codes, check_for_products,
+                    is_human, ngram_rows)
+            key = (source_id,
+                   s.cache_key if isinstance(s, NormalizedQuery) else s,
+                   is_single_brand, is_disallow_brand,
+                   is_allow_fuzzy, tuple(ordered_codes or ()),
+                   tuple(all_match_words or ()),
+                   # a BrandBitset is replaced (not modified) after each pipeline run
+                   source_brand_list if isinstance(source_brand_list,
+                                                   BrandBitset)
+                   else tuple(source_brand_list or ()),
+                   tuple(x for x in attr_codes or () if x), is_human)
+            result = self.result_cache.get(context.dictionary, key)
+            if result is None:
+                result = self._lookup_uncached(
+                    source_id, s, is_single_brand, is_disallow_brand,
+                    is_allow_fuzzy, ordered_codes, all_match_words,
+                    source_brand_list, attr_codes, check_for_products,
+                    is_human, ngram_rows)
+                self.result_cache.put(context.dictionary, key, result)
+            return result
+
+    def lookup_uncached(self, source_id, s, is_single_brand=True,
+                        is_disallow_brand=False, is_allow_fuzzy=False,
+                        ordered_codes=None, all_match_words=None,
+                        source_brand_list=None, attr_codes=None,
+                        check_for_products=False, is_human=False,
+                        ngram_rows=None):
+        return self._lookup_uncached(
+            source_id, s, is_single_brand, is_disallow_brand, is_allow_fuzzy,
+            ordered_codes, all_match_words,
+            self.get_source_brand_list(source_id, source_brand_list,
+                                       is_human),
+            attr_codes, check_for_products, is_human, ngram_rows)
+
+    def _lookup_uncached(self, source_id, s, is_single_brand,
+                         is_disallow_brand, is_allow_fuzzy, ordered_codes,
+                         all_match_words, source_brand_list, attr_codes,
+                         check_for_products, is_human, ngram_rows):
+        """
+        lookup_uncached() once source_brand_list is resolved (see
+        get_source_brand_list())
+        """
         from application.db_extension.routines import get_default_category_id
-        orig_sentence = s
         category_id = get_default_category_id()
         if ordered_codes is None:
             ordered_codes = []
@@ -840,53 +1522,227 @@ class DictionaryLookupClass(metaclass=Singleton):
         attr_codes = [x for x in attr_codes if x]
         attr_codes = [] if not attr_codes else attr_codes
         product_ids = []
-        # the input query will be cleaned, but still may include stopwords. we will send in the original query string
-        # and the stopword positions so we can track what words we're removing
-        _, stopword_indexes = remove_stopwords(s)
-        matched, product_ids, remaining_word_indexes = self.get_all_matches_from_query(
-            query=s,
-            stopword_indexes=stopword_indexes,
-            is_single_brand=is_single_brand,
-            is_disallow_brand=is_disallow_brand,
-            is_allow_fuzzy=is_allow_fuzzy,
-            category_id=category_id,
-            source_id=source_id,
-            ordered_codes=ordered_codes,
-            all_match_words=all_match_words,
-            source_brand_list=source_brand_list,
-            attr_codes=attr_codes,
-            orig_sentence=orig_sentence,
-            check_for_products=check_for_products,
-            is_human=is_human)
-
-        # return found attributes and indexes of not found (or removed via stopword) indexes
-        # Also, return any products we may have
-        return_attrs = self.format_as_predicate_syntax(matched)
-        return_extra_words = remaining_word_indexes.union(stopword_indexes)
-        orig_word_list = s.split()
-        return_extra_words = [orig_word_list[i] for i in return_extra_words]
-        self.word_lemma_dictionary_for_query = {}
+        timings = self.stats.start()
+        with timings.stage('lookup'):
+            # the input query will be cleaned, but still may include stopwords. we will send in the original query words
+            # and the stopword positions so we can track what words we're removing
+            if isinstance(s, NormalizedQuery):
+                query = s
+            else:
+                with timings.stage('remove_stopwords'):
+                    query = NormalizedQuery.from_text(s)
+            # Per-query state lives in the context, so concurrent lookups don't share it
+            with self.query_context() as context:
+                context.timings = timings
+                matched, product_ids, remaining_word_indexes = self.get_all_matches_from_query(
+                    normalized_query=query,
+                    is_single_brand=is_single_brand,
+                    is_disallow_brand=is_disallow_brand,
+                    is_allow_fuzzy=is_allow_fuzzy,
+                    category_id=category_id,
+                    source_id=source_id,
+                    ordered_codes=ordered_codes,
+                    all_match_words=all_match_words,
+                    source_brand_list=source_brand_list,
+                    attr_codes=attr_codes,
+                    check_for_products=check_for_products,
+                    is_human=is_human,
+                    ngram_rows=ngram_rows)
+
+                # return found attributes and indexes of not found (or removed via stopword) indexes
+                # Also, return any products we may have
+                return_attrs = self.format_as_predicate_syntax(matched)
+        self.stats.record(timings)
+        return_extra_words = remaining_word_indexes.union(
+            query.stopword_indexes)
+        return_extra_words = [query.words[i] for i in return_extra_words]
         return return_attrs, product_ids, return_extra_words
 
-    def update_dictionary_lookup_data(self, log_function=logger.info):
+    def get_source_brand_list(self, source_id, source_brand_list, is_human):
+        """
+        :return: source_brand_list, or for a human lookup without one the
+            BrandBitset of the brands source_id sells
+        """
+        if source_brand_list is None and is_human and source_id:
+            return self.source_brands.get(source_id)
+        return source_brand_list
+
+    def lookup_many(self, source_id, sentences, normalize=True, **kwargs):
+        """
+        Look up a batch of sentences (e.g., all sentences of a product's reviews)
+        Identical sentences are only looked up once and the chr ngram candidate
+        rows are shared by the whole batch.
+        :param source_id:
+        :param sentences: list of sentences (str or NormalizedQuery)
+        :param normalize: clean sentences and remove stopwords with normalize_query() first
+        :param kwargs: same as lookup()
+        :return: list of lookup() results aligned with sentences (duplicates share a result)
+        """
+        if normalize:
+            cleaned = {}
+            for sentence in sentences:
+                if sentence not in cleaned:
+                    with self.stats.stage('cleanup_string'):
+                        cleaned[sentence] = normalize_query(sentence)
+            sentences = [cleaned[sentence] for sentence in sentences]
+
+        ngram_rows = {}
+        results = {}
+        # ngram_rows are only valid for one dictionary, so the whole batch uses the same
+        with self.query_context():
+            for sentence in sentences:
+                if sentence not in results:
+                    results[sentence] = self.lookup(source_id, sentence,
+                                                    ngram_rows=ngram_rows,
+                                                    **kwargs)
+        return [results[sentence] for sentence in sentences]
+
+    def update_dictionary_lookup_data(self, log_function=logger.info,
+                                      force=False):
+        """
+        Bring the dictionary up to date with domain_dictionary and save it as
+        a snapshot. Does nothing if the rows didn't change (same fingerprint),
+        applies small changes incrementally and only rebuilds everything when
+        forced or when too many rows changed since the last full build.
+        Processes sharing the snapshot update it one at a time and pick up
+        what the others saved.
+        """
+        from application.db_extension.routines import get_default_category_id
+        category_id = get_default_category_id()
+        with snapshot_lock(snapshot_path(category_id)):
+            if not force:
+                self.attach_snapshot(category_id, log_function=log_function)
+            if not force and self.dictionary is not None:
+                fingerprint = get_dict_items_fingerprint(category_id)
+                if fingerprint == self.dictionary_fingerprint:
+                    log_function('dictionary lookup data is up to date')
+                    return
+                if self.apply_dictionary_changes(category_id,
+                                                 log_function=log_function):
+                    return
+            self.rebuild_dictionary_lookup_data(category_id,
+                                                log_function=log_function)
+
+    def rebuild_dictionary_lookup_data(self, category_id,
+                                       log_function=logger.info):
         log_function('starting dictionary lookup data update')
         start_time = datetime.now()
-        log_function('getting existing index')
-        existing_index = {}
         log_function('getting entities')
-        data = get_dict_items_from_sql()
+        timings = LookupTimings()
+        # Hashes are read first, so a row edited in between is just seen as changed on the next update
+        with timings.stage('hashes'):
+            hashes = get_dict_item_hashes(category_id)
+        data = iter_dict_items_from_sql(category_id)
+        dictionary, entities_text_id_dict, cutoff_idf = build_dictionary(
+            data, hashes, log_function=log_function, timings=timings)
+        with timings.stage('save'):
+            self.save_dictionary(dictionary, entities_text_id_dict,
+                                 category_id,
+                                 fingerprint=fingerprint_from_hashes(hashes),
+                                 cutoff_idf=float(cutoff_idf),
+                                 delta_rows=0)
+        log_function('finished dictionary update in %s (%s)',
+                     datetime.now() - start_time, timings.summary())
+
+    def apply_dictionary_changes(self, category_id, log_function=logger.info):
+        """
+        Apply added, edited and removed domain_dictionary rows to the loaded
+        dictionary
+        :return: False if too many rows changed and a full rebuild is needed
+        """
+        hashes = get_dict_item_hashes(category_id)
+        known_hashes = dict(zip(self.dictionary.ids.tolist(),
+                                self.dictionary.row_hashes.tolist()))
+        changed_ids = [i for i, row_hash in hashes.items()
+                       if known_hashes.get(i) != row_hash]
+        removed_ids = [i for i in known_hashes if i not in hashes]
+        delta_rows = self.delta_rows + len(changed_ids) + len(removed_ids)
+        if delta_rows > config.DICTIONARY_MAX_DELTA_RATIO * len(hashes):
+            log_function(f'{delta_rows} dictionary rows changed since the '
+                         f'last full update, rebuilding')
+            return False
+
+        log_function(f'applying dictionary changes: {len(changed_ids)} '
+                     f'added or edited, {len(removed_ids)} removed')
+        start_time = datetime.now()
+        data = get_dict_items_from_sql(category_id, ids=changed_ids) \
+            if changed_ids else []
         data = convert_to_dict_lookup(data, log_function=log_function)
-        log_function('creating ngram index')
-        self.ngram_inverted_index = create_ngrams(data, existing_index)
-        log_function('processing dictionary')
-        res = process_dictionary(data, log_function=log_function)
-        (idf_dict, ordered_entities_dict, entities_text_id_dict, _) = res
-        self.word_idf_dict = idf_dict
-        self.entities_text_id_dict = entities_text_id_dict
-        self.entities_dict = ordered_entities_dict
-        log_function('finished dictionary update in %s',
+        for entity in data:
+            entity['row_hash'] = hashes[entity['id']]
+        dictionary, entities_text_id_dict = apply_dictionary_delta(
+            self.dictionary, data, removed_ids + changed_ids,
+            self.cutoff_idf, log_function=log_function)
+        self.save_dictionary(dictionary, entities_text_id_dict, category_id,
+                             fingerprint=fingerprint_from_hashes(hashes),
+                             cutoff_idf=self.cutoff_idf,
+                             delta_rows=delta_rows)
+        log_function('applied dictionary changes in %s',
                      datetime.now() - start_time)
+        return True
+
+    def save_dictionary(self, dictionary, entities_text_id_dict, category_id,
+                        fingerprint, cutoff_idf, delta_rows):
+        path = snapshot_path(category_id)
+        try:
+            write_snapshot(dictionary, entities_text_id_dict, path,
+                           category_id=category_id,
+                           fingerprint=fingerprint,
+                           cutoff_idf=cutoff_idf,
+                           delta_rows=delta_rows)
+        except OSError as e:
+            # The in-memory dictionary is still usable, other processes will just rebuild it themselves
+            logger.warning(f'Failed to save dictionary snapshot: {e}')
+        else:
+            # Use the memory mapped copy, so the arrays are shared with the other processes
+            # (and forked children) instead of living in this process' heap
+            self.dictionary_version = None
+            self.attach_snapshot(category_id)
+            return
+
+        self.publish_dictionary(dictionary, entities_text_id_dict)
+        self.dictionary_version = None
+        self.dictionary_fingerprint = tuple(fingerprint)
+        self.cutoff_idf = cutoff_idf
+        self.delta_rows = delta_rows
         self.last_time_dictionary_updated = datetime.now()
 
+    def attach_snapshot(self, category_id, log_function=logger.info):
+        """
+        Memory map the dictionary snapshot if it is newer than the loaded one
+        :return: True if the snapshot was (re)loaded
+        """
+        path = snapshot_path(category_id)
+        try:
+            header = read_snapshot_header(path)
+        except (OSError, ValueError) as e:
+            log_function(f'dictionary snapshot is not available: {e}')
+            return False
+        if header['version'] == self.dictionary_version:
+            return False
+
+        start_time = datetime.now()
+        dictionary, entities_text_id_dict, header = read_snapshot(path)
+        self.publish_dictionary(dictionary, entities_text_id_dict)
+        self.dictionary_version = header['version']
+        self.dictionary_fingerprint = tuple(header['fingerprint'])
+        self.cutoff_idf = header['cutoff_idf']
+        self.delta_rows = header['delta_rows']
+        log_function('loaded dictionary snapshot %s (version %s) in %s',
+                     path, self.dictionary_version,
+                     datetime.now() - start_time)
+        self.last_time_dictionary_updated = datetime.now()
+        return True
+
+    def load_dictionary_lookup_data(self, log_function=logger.info):
+        """
+        Load the dictionary from the snapshot file (memory mapped) if another
+        process saved a newer one, then bring it up to date with the database
+        """
+        from application.db_extension.routines import get_default_category_id
+        self.attach_snapshot(get_default_category_id(),
+                             log_function=log_function)
+        self.update_dictionary_lookup_data(log_function=log_function)
+
 
 dictionary_lookup = DictionaryLookupClass()
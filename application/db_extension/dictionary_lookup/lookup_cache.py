@@ -0,0 +1,61 @@
+import copy
+import threading
+from collections import OrderedDict
+
+
+class LookupResultCache:
+    """
+    Bounded in-process LRU cache of lookup results
+
+    Entries are only valid for the dictionary they were computed with: the
+    cache is stamped with the dictionary object and emptied as soon as it is
+    used with another one (reload, snapshot or delta update). Results are
+    copied in and out, so callers can't modify cached values.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._dictionary = None
+        self._lock = threading.Lock()
+
+    def get(self, dictionary, key):
+        """
+        :return: cached result for key, or None
+        """
+        with self._lock:
+            if dictionary is not self._dictionary:
+                self._entries.clear()
+                self._dictionary = dictionary
+            try:
+                result = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return copy.deepcopy(result)
+
+    def put(self, dictionary, key, result):
+        if self.max_size <= 0:
+            return
+        result = copy.deepcopy(result)
+        with self._lock:
+            if dictionary is not self._dictionary:
+                return
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._entries), 'max_size': self.max_size}
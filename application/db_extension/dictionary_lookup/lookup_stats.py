@@ -0,0 +1,229 @@
+"""
+Sampled per-stage timings of dictionary lookups
+
+A sampled lookup records how long each of its stages took (summed when a
+stage runs more than once) and a few counts, e.g. of candidates. The
+recorded values are aggregated into histograms. Lookups that aren't sampled
+get NO_TIMINGS, whose stages do nothing.
+
+Stages nest: "extraction" includes the candidate and scoring stages of the
+candidates scored lazily, "lookup" is the whole lookup.
+"""
+import bisect
+import json
+import random
+import threading
+import time
+
+# upper bounds of the histogram buckets, the last bucket is open ended
+DURATION_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250,
+                       500, 1000, 2500)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                 10000)
+
+
+class Histogram:
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percentile):
+        """
+        Upper bound of the bucket of the percentile (None if in the last one)
+        """
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None
+
+    def info(self):
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'buckets': [[bound, count] for bound, count in
+                            zip(list(self.bounds) + [None], self.buckets)
+                            if count]}
+
+
+class _Stage:
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        durations = self.timings.durations
+        durations[self.name] = durations.get(self.name, 0) + \
+            time.perf_counter() - self.start
+
+
+class LookupTimings:
+    """Stage durations (seconds) and counts of one sampled lookup"""
+
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+
+    def __bool__(self):
+        return True
+
+    def stage(self, name):
+        """
+        :return: context manager adding the time spent in it to stage name
+        """
+        return _Stage(self, name)
+
+    def count(self, name, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def summary(self):
+        """
+        :return: "stage 12.3ms, ..." in the order the stages first ran
+        """
+        return ', '.join('%s %.1fms' % (name, seconds * 1000)
+                         for name, seconds in self.durations.items())
+
+
+class _NoStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class _NoTimings:
+    """Timings of a lookup that isn't sampled: records nothing"""
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def stage(self, name):
+        return _NO_STAGE
+
+    def count(self, name, value):
+        pass
+
+
+_NO_STAGE = _NoStage()
+NO_TIMINGS = _NoTimings()
+
+
+class LookupStats:
+    """
+    Histograms of the stage durations and counts of a sample of lookups
+    :param sample_rate: share of the lookups to record (0 disables)
+    :param log_every: log the histograms every log_every sampled lookups
+        (0: never)
+    """
+
+    def __init__(self, sample_rate=0.0, log_every=0, log_function=None):
+        self.sample_rate = sample_rate
+        self.log_every = log_every
+        self.log_function = log_function
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self.clear()
+
+    def start(self):
+        """
+        :return: LookupTimings for a sampled lookup, NO_TIMINGS otherwise
+        """
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and
+                                     self._random.random() >= self.sample_rate):
+            return NO_TIMINGS
+        return LookupTimings()
+
+    def stage(self, name):
+        """
+        Time a stage run outside of a lookup (e.g. cleaning sentences before
+        looking them up) as a lookup of its own
+        """
+        timings = self.start()
+        if not timings:
+            return _NO_STAGE
+        return _RecordedStage(self, timings, name)
+
+    def record(self, timings):
+        if not timings:
+            return
+        with self._lock:
+            for name, seconds in timings.durations.items():
+                if name not in self.durations:
+                    self.durations[name] = Histogram(DURATION_BUCKETS_MS)
+                self.durations[name].add(seconds * 1000)
+            for name, value in timings.counts.items():
+                if name not in self.counts:
+                    self.counts[name] = Histogram(COUNT_BUCKETS)
+                self.counts[name].add(value)
+            self.sampled += 1
+            is_log = self.log_every and self.sampled % self.log_every == 0
+        if is_log and self.log_function:
+            self.log_function('lookup stats: %s', self.summary())
+
+    def clear(self):
+        with self._lock:
+            self.durations = {}
+            self.counts = {}
+            self.sampled = 0
+
+    def info(self):
+        """
+        :return: histograms of the stage durations (ms) and counts
+        """
+        with self._lock:
+            return {'sample_rate': self.sample_rate,
+                    'sampled': self.sampled,
+                    'durations_ms': {name: histogram.info() for name, histogram
+                                     in sorted(self.durations.items())},
+                    'counts': {name: histogram.info() for name, histogram
+                               in sorted(self.counts.items())}}
+
+    def summary(self):
+        """
+        :return: one line with the count, mean and p95 of each histogram
+        """
+        info = self.info()
+        summary = {'sampled': info['sampled']}
+        for kind in ('durations_ms', 'counts'):
+            for name, histogram in info[kind].items():
+                summary[name] = [histogram['count'],
+                                 round(histogram['mean'], 3),
+                                 histogram['p95']]
+        return json.dumps(summary, sort_keys=True)
+
+
+class _RecordedStage(_Stage):
+    __slots__ = ('stats',)
+
+    def __init__(self, stats, timings, name):
+        super().__init__(timings, name)
+        self.stats = stats
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        self.stats.record(self.timings)
@@ -0,0 +1,144 @@
+"""
+In-process index of the master products, for the product lookup of lookup()
+
+Matches the products of a brand on their non_attribute_words the way the
+former ts_rank query on master_products and product_lookup2() did together:
+a product matches if it shares a word with the query, products of the
+current source come first, then the best ts_rank. Each brand has a small
+inverted index of its products' words, so a lookup touches only the
+products that share a word with the query and never goes to the database.
+
+Unlike the query, words match exactly (no english stemming or stopwords,
+which the post-filter of product_lookup2() already required), the limit
+applies after that filter and ts_rank is computed from the word counts.
+"""
+import math
+import time
+
+from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.postgres_functions import (
+    get_last_ready_sequence_id,
+    get_master_products)
+
+MAX_PRODUCTS = 50  # LIMIT of the former master_products query
+_RANK_WEIGHT = 0.1  # ts_rank weight of the lexemes of an unweighted tsvector
+_ZETA_2 = 1.64493406685  # sum of 1/i^2, ts_rank divides each lexeme's positions by it
+
+
+def word_rank(count):
+    """
+    ts_rank of a query word found count times in a product (before the
+    length normalization)
+    """
+    return sum(_RANK_WEIGHT / (j * j) for j in range(1, count + 1)) / _ZETA_2
+
+
+class BrandProducts:
+    """Products of one brand and the inverted index of their words"""
+    __slots__ = ('products', 'length_norms', 'postings')
+
+    def __init__(self):
+        self.products = []
+        # ts_rank normalization 1: rank / log2(1 + number of words)
+        self.length_norms = []
+        self.postings = {}  # word -> [(product position, word_rank())]
+
+    def add(self, product):
+        position = len(self.products)
+        words = product['non_attribute_words'].split()
+        self.products.append(product)
+        self.length_norms.append(math.log2(len(words) + 1) if words else 1.0)
+        counts = {}
+        for word in words:
+            counts[word] = counts.get(word, 0) + 1
+        for word, count in counts.items():
+            self.postings.setdefault(word, []).append(
+                (position, word_rank(count)))
+
+
+class MasterProductIndex:
+    """
+    Master products of a category by brand_node_id
+    :param sequence_id: last completed pipeline run when the products were read
+    """
+
+    def __init__(self, rows, sequence_id=None):
+        self.sequence_id = sequence_id
+        self.brands = {}
+        for master_product_id, source_id, name, non_attribute_words, \
+                brand_node_id in rows:
+            if brand_node_id not in self.brands:
+                self.brands[brand_node_id] = BrandProducts()
+            self.brands[brand_node_id].add({
+                'master_product_id': master_product_id,
+                'source_id': source_id,
+                'name': name,
+                'non_attribute_words': non_attribute_words or '',
+                'brand_node_id': brand_node_id})
+
+    def __len__(self):
+        return sum(len(brand.products) for brand in self.brands.values())
+
+    def match(self, brand_node_id, source_id, words, limit=MAX_PRODUCTS):
+        """
+        Products of brand_node_id that have one of words in their
+        non_attribute_words: those of source_id first, then by ts_rank
+        :return: list of product dicts (copies, with their 'ts_rank')
+        """
+        brand = self.brands.get(brand_node_id)
+        if brand is None:
+            return []
+        ranks = {}
+        for word in set(words):
+            for position, rank in brand.postings.get(word, ()):
+                ranks[position] = ranks.get(position, 0.0) + rank
+        products = brand.products
+        found = sorted(
+            ((products[position]['source_id'] != source_id,
+              -rank / brand.length_norms[position], position)
+             for position, rank in ranks.items()))
+        return [dict(products[position], ts_rank=-rank)
+                for _, rank, position in found[:limit]]
+
+
+class MasterProducts:
+    """
+    MasterProductIndex of each category. It is loaded on first use and
+    rebuilt when execute_pipeline() completes a run (see refresh()).
+    Processes that didn't run the pipeline check for a newer completed run
+    every MASTER_PRODUCTS_CHECK_SECONDS.
+    """
+
+    def __init__(self):
+        self._indexes = {}  # category_id -> (MasterProductIndex, monotonic time checked)
+
+    def get(self, category_id):
+        """
+        :return: MasterProductIndex of category_id
+        """
+        entry = self._indexes.get(category_id)
+        now = time.monotonic()
+        if entry is not None and \
+                now - entry[1] < config.MASTER_PRODUCTS_CHECK_SECONDS:
+            return entry[0]
+        sequence_id = get_last_ready_sequence_id()
+        if entry is not None and entry[0].sequence_id == sequence_id:
+            self._indexes[category_id] = (entry[0], now)
+            return entry[0]
+        return self.refresh(category_id, sequence_id)
+
+    def refresh(self, category_id, sequence_id=None):
+        """
+        Reload the master products of category_id
+        :param sequence_id: last completed pipeline run (read if not given)
+        :return: MasterProductIndex
+        """
+        if sequence_id is None:
+            sequence_id = get_last_ready_sequence_id()
+        index = MasterProductIndex(get_master_products(category_id),
+                                   sequence_id)
+        self._indexes[category_id] = (index, time.monotonic())
+        return index
+
+    def clear(self):
+        self._indexes = {}
@@ -0,0 +1,60 @@
+"""
+Word-level trie for substituting multi-word dictionary entries with their
+ngram token (e.g., "red blend" -> "red_blend", see get_nlp_ngrams())
+"""
+import re
+
+# words, runs of other non-space chars, and single spaces
+_TOKEN = re.compile(r'\w+|[^\w ]+| ')
+_END = None  # trie key of the target of the ngram ending at a node
+
+
+class NgramTrie:
+    """
+    :param ngrams: {target_text: source_text}, e.g., {'red_blend': 'red blend'}
+    """
+
+    def __init__(self, ngrams):
+        self.root = {}
+        for target, source in ngrams.items():
+            tokens = _TOKEN.findall(source or '')
+            if not tokens:
+                continue
+            node = self.root
+            for token in tokens:
+                node = node.setdefault(token, {})
+            # the first of duplicate sources wins, like the original replace loop
+            node.setdefault(_END, target)
+
+    def substitute(self, text):
+        """
+        Replace ngram sources in text with their targets in one left to
+        right pass, longest match first, only on whole words
+        """
+        if not self.root:
+            return text
+        tokens = _TOKEN.findall(text)
+        out = []
+        i = 0
+        while i < len(tokens):
+            node = self.root.get(tokens[i])
+            if node is None:
+                out.append(tokens[i])
+                i += 1
+                continue
+            match, match_end = None, i
+            j = i + 1
+            while True:
+                if _END in node:
+                    match, match_end = node[_END], j
+                if j == len(tokens) or tokens[j] not in node:
+                    break
+                node = node[tokens[j]]
+                j += 1
+            if match is None:
+                out.append(tokens[i])
+                i += 1
+            else:
+                out.append(match)
+                i = match_end
+        return ''.join(out)
@@ -0,0 +1,181 @@
+"""
+Text normalizer for dictionary entries and lookup sentences
+
+normalize_text() produces the same text as the original cleanup_string()
+regex chain, together with the tokens and stopword positions that
+remove_stopwords() computes from it. The patterns are compiled once and each
+rewrite only runs when the string contains the character it needs (most
+product names and review sentences have no '.', '-', ',' or "'s"), so a
+typical string is lowercased, scanned once for punctuation and split once.
+normalize_query() wraps the result in the NormalizedQuery that the lookup
+functions pass down, so a sentence is only normalized once per lookup.
+"""
+import re
+from collections import namedtuple
+
+from application.db_extension.dictionary_lookup import config
+from application.logging import logger
+
+_PERIOD_AFTER_NUMBER = re.compile(r'\d+\.(?!\d)')
+_NUMBER_AND_PERIOD = re.compile(r'(\d+)\.')
+# special case of $123-$234 (or $123 - $234)
+_NUMBER_RANGE = re.compile(r'(.*\d)(?:\s*\-\s*)(\$?\d.*)')
+# "J.J." or "J. J." -> "JJ"
+_INITIALS = re.compile(r'(.)\.\s?(.)[\.$]')
+# ". " -> " " like "J. Lohr" -> "J Lohr"; or "st. " -> "st "
+_PERIOD_AND_SYMBOL = re.compile(r'\.[\W$]')
+_COMMAS_IN_NUMBERS = re.compile(r'(?:\d)(,)(?:\d)(.*\d)(,)(\d.*)')
+_PERIOD_IN_WORD = re.compile(r'([a-z]+)\.([a-z]+)')
+_PUNCTUATION = re.compile(r'([^\s\.\$\w])+')
+# text that attribute_lookup()'s cleanup leaves as it is
+_PLAIN = re.compile(r'(?:[a-z0-9]+(?: [a-z0-9]+)*)?')
+
+
+class NormalizedText(namedtuple('NormalizedText',
+                                ['text', 'tokens', 'stopword_indexes'])):
+    """
+    text: cleaned string (same as cleanup_string())
+    tokens: words of the text after '$' -> 'dollar' and '&' -> 'and'
+    stopword_indexes: set of the positions of stopwords in tokens
+    """
+    __slots__ = ()
+
+    @property
+    def without_stopwords(self):
+        """Same as remove_stopwords(text)[0]"""
+        return ' '.join(word for i, word in enumerate(self.tokens)
+                        if i not in self.stopword_indexes)
+
+
+class NormalizedQuery(namedtuple('NormalizedQuery',
+                                 ['text', 'words', 'stopword_indexes'])):
+    """
+    A sentence as dictionary_lookup.lookup() sees it, built once by the
+    caller (see normalize_query()) and passed down instead of the string
+    text: sentence looked up (also its cache key)
+    words: tuple of the words of the text
+    stopword_indexes: frozenset of the positions of stopwords in words
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Query of an already cleaned text, with the stopword positions
+        remove_stopwords() finds in it
+        """
+        words = tuple(text.split())
+        stopwords = set(config.LOOKUP_STOPWORDS)
+        stopword_indexes = frozenset(
+            i for i, word in enumerate(words)
+            if word.replace('$', 'dollar').replace('&', 'and') in stopwords)
+        return cls(text, words, stopword_indexes)
+
+    @property
+    def cache_key(self):
+        return self.text
+
+    @property
+    def is_plain(self):
+        """
+        True if the text is only lowercase ascii words without stopwords,
+        which prepare_attribute_lookup_sentence() would leave unchanged
+        """
+        return not self.stopword_indexes and \
+            _PLAIN.fullmatch(self.text) is not None
+
+
+def space_before_period_after_number(text):
+    """
+    Same as the original add_space_before_period_and_number(): every number
+    ending a sentence ("12.") gets a space before its period, and so does each
+    other "<digits>." ending with the same digits, since the original
+    replaced all occurrences of the matched text
+    """
+    numbers = {m.group(0)[:-1] for m in _PERIOD_AFTER_NUMBER.finditer(text)}
+    if not numbers:
+        return text
+
+    def replace(m):
+        digits = m.group(1)
+        if any(digits.endswith(number) for number in numbers):
+            return digits + ' .'
+        return m.group(0)
+
+    return _NUMBER_AND_PERIOD.sub(replace, text)
+
+
+def clean_text(input_str, check_synonyms=False):
+    """
+    Normalize a string for dictionary lookup (implementation of cleanup_string())
+    """
+    # Make sure it's a string and convert if not
+    input_str = str(input_str)
+
+    text = input_str.replace('?', ' ?')
+    if '.' in text:
+        text = space_before_period_after_number(text)
+
+    # Remove last char if common noise
+    text = text.rstrip('/,.')
+
+    if '-' in text:
+        text = _NUMBER_RANGE.sub(r'\1 to \2', text)
+        text = text.replace('-', ' ')
+    text = text.lower()
+
+    # remove single quote for possessives - this is due to limitations/differences in data_dictionary in postgres
+    text = text.replace("'s", 's')
+
+    # "mini recursion" of replace_with_nlp_synonyms to handle 2nd order replacement requirements
+    # Also substitute ngrams (e.g., "just in" -> "just_in"
+    if check_synonyms:
+        from application.db_extension.dictionary_lookup.utils import (
+            replace_with_nlp_ngrams,
+            replace_with_nlp_synonyms)
+        text = replace_with_nlp_synonyms(replace_with_nlp_synonyms(text))
+        text = replace_with_nlp_ngrams(text).lower()
+
+    if '.' in text:
+        text = _INITIALS.sub(r'\1\2 ', text)
+    if '.' in text:
+        text = _PERIOD_AND_SYMBOL.sub(' ', text)
+    if ',' in text:
+        # Remove comma if surrounded by numbers
+        text = _COMMAS_IN_NUMBERS.sub(r'\1\2', text)
+    if '.' in text:
+        # Remove period if surrounded by alpha chars
+        text = _PERIOD_IN_WORD.sub(r'\1 \2', text)
+
+    # remove remaining punctuation and multiple spaces/whitespaces left behind
+    text = ' '.join(_PUNCTUATION.sub(' ', text).split())
+
+    if text == '':
+        logger.debug('Add to nlp_ngrams: %s', input_str)
+        text = input_str.lower()  # Fallback if stripped of everything
+    return text
+
+
+def normalize_text(input_str, check_synonyms=False):
+    """
+    cleanup_string() and remove_stopwords() in one call
+    :return: NormalizedText
+    """
+    text = clean_text(input_str, check_synonyms=check_synonyms)
+    # convert punctuation to hashable symbols
+    tokens = text.replace('$', 'dollar').replace('&', 'and').split()
+    stopwords = set(config.LOOKUP_STOPWORDS)
+    stopword_indexes = {i for i, word in enumerate(tokens)
+                        if word in stopwords}
+    return NormalizedText(text, tokens, stopword_indexes)
+
+
+def normalize_query(input_str, check_synonyms=False):
+    """
+    normalize_text() of a sentence, without its stopwords, as a NormalizedQuery
+    """
+    normalized = normalize_text(input_str, check_synonyms=check_synonyms)
+    return NormalizedQuery(normalized.without_stopwords,
+                           tuple(word for i, word in enumerate(normalized.tokens)
+                                 if i not in normalized.stopword_indexes),
+                           frozenset())
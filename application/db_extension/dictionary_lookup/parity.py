@@ -0,0 +1,79 @@
+"""
+Parity report of the attribute_lookup() engines: the attribute_lookup2 stored
+procedure and the in-memory dictionary lookup (ATTRIBUTE_LOOKUP_ENGINE)
+"""
+import time
+from collections import Counter
+
+
+def attribute_key(attribute):
+    return attribute.get('code'), attribute.get('node_id')
+
+
+def diff_attributes(postgres_attributes, memory_attributes):
+    """
+    Compare the attributes of one sentence by (code, node_id)
+    :return: {'missing': only found by postgres,
+              'extra': only found in memory,
+              'moved': found by both at different positions}
+    """
+    postgres = {attribute_key(a): a for a in postgres_attributes}
+    memory = {attribute_key(a): a for a in memory_attributes}
+    moved = []
+    for key in postgres.keys() & memory.keys():
+        if (postgres[key].get('start'), postgres[key].get('end')) != \
+                (memory[key].get('start'), memory[key].get('end')):
+            moved.append({'postgres': postgres[key], 'memory': memory[key]})
+    return {'missing': [postgres[key] for key in postgres.keys() - memory.keys()],
+            'extra': [memory[key] for key in memory.keys() - postgres.keys()],
+            'moved': moved}
+
+
+def compare_attribute_lookups(sentences, source_id=1,
+                              brand_treatment='exclude', attribute_code=False,
+                              max_examples=100):
+    """
+    Run both attribute_lookup() engines over sentences (needs the database)
+    :return: report (JSON serializable)
+    """
+    from application.db_extension.routines import (
+        memory_attribute_lookup,
+        postgres_attribute_lookup,
+        prepare_attribute_lookup_sentence)
+
+    report = {'sentences': 0, 'identical': 0, 'different': 0,
+              'postgres_seconds': 0.0, 'memory_seconds': 0.0,
+              'postgres_attributes': 0, 'memory_attributes': 0,
+              'missing': Counter(), 'extra': Counter(), 'moved': Counter(),
+              'examples': []}
+    for sentence in sentences:
+        prepared = prepare_attribute_lookup_sentence(sentence)
+        if not prepared.text:
+            continue
+        start_time = time.perf_counter()
+        postgres = postgres_attribute_lookup(prepared, brand_treatment,
+                                             attribute_code)
+        report['postgres_seconds'] += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        memory = memory_attribute_lookup(prepared, source_id, brand_treatment,
+                                         attribute_code)
+        report['memory_seconds'] += time.perf_counter() - start_time
+
+        report['sentences'] += 1
+        report['postgres_attributes'] += len(postgres)
+        report['memory_attributes'] += len(memory)
+        diff = diff_attributes(postgres, memory)
+        if not any(diff.values()):
+            report['identical'] += 1
+            continue
+        report['different'] += 1
+        for kind in ('missing', 'extra'):
+            report[kind].update(a.get('code') for a in diff[kind])
+        report['moved'].update(m['postgres'].get('code') for m in diff['moved'])
+        if len(report['examples']) < max_examples:
+            report['examples'].append(dict(diff, sentence=sentence,
+                                           prepared=prepared.text))
+    for kind in ('missing', 'extra', 'moved'):
+        # attribute code -> count of differences
+        report[kind] = dict(report[kind].most_common())
+    return report
@@ -120,42 +120,49 @@ def get_units_and_category_names(category_id=DEFAULT_CATEGORY_ID):
                                  trigger_language_response)
 
 
-@cache.memoize()
-def lookup_master_products(source_id, category_id, brand_node_id, extra_words):
-    query_str = " | ".join(extra_words)  # "bob | vineyard"
+def get_last_ready_sequence_id(source_id=None):
+    """
+    :param source_id: None for the last run of any source
+    :return: id of the last pipeline run of the source that completed
+        successfully (None if there is none)
+    """
+    if source_id is None:
+        return fetchall("SELECT max(id) FROM pipeline_sequence "
+                        "WHERE state='ready';")[0][0]
+    q = """SELECT max(id) FROM pipeline_sequence
+           WHERE source_id=%s AND state='ready';"""
+    return fetchall(q, (source_id,))[0][0]
+
 
-    q = '''SELECT ts_rank(non_attribute_words_vector, keywords, 1),
+def get_master_products(category_id=DEFAULT_CATEGORY_ID):
+    """
+    Master products of a category that product_lookup2() can match (see
+    master_products.py)
+    :return: rows of (master_product_id, source_id, name, non_attribute_words, brand_node_id)
+    """
+    q = '''SELECT mp.id master_product_id,
                   mp.source_id,
-                  mp.id master_product_id, 
                   mp.name,
                   mp.non_attribute_words,
-                  mp.non_attribute_words_vector,
                   mp.brand_node_id
-           FROM master_products mp, to_tsquery('english', %s) keywords
-           WHERE brand_node_id=%s 
-             AND mp.category_id=%s 
+           FROM master_products mp
+           WHERE mp.category_id=%s
              AND mp.source_id>-1
-             AND non_attribute_words_vector @@ keywords
-           ORDER BY source_id=%s DESC, ts_rank(non_attribute_words_vector, keywords, 1) DESC
-    LIMIT 50'''
-
-    rows = fetchall(q, (query_str, brand_node_id, category_id, source_id))
-    return [dict(row) for row in rows]
+             AND mp.brand_node_id IS NOT NULL
+           ORDER BY mp.id'''
+    return fetchall(q, (category_id,))
 
 
-@cache.memoize()
-def get_brands_for_source_and_category(source_id, category_id):
-    # We will use this to determine whether a brand is being sold by the source
-    if not source_id or not category_id:
-        return []
-
-    # Get list of node ids for brand for max sequence for source
-    q = ''' SELECT pav.value_node_id node_id FROM pipeline_attribute_values pav, domain_attributes da 
-            WHERE sequence_id = (select max(id) from pipeline_sequence WHERE id=pav.sequence_id) AND 
+def get_source_brand_node_ids(source_id, sequence_id,
+                              category_id=DEFAULT_CATEGORY_ID):
+    """
+    :return: node ids of the brands of the products of a pipeline run
+    """
+    q = ''' SELECT DISTINCT pav.value_node_id node_id FROM pipeline_attribute_values pav, domain_attributes da
+            WHERE pav.sequence_id=%s AND
             source_id=%s AND category_id=%s AND pav.attribute_id=da.id AND da.code='brand';'''
-
-    rows = fetchall(q, (source_id, category_id))
-    return set([row[0] for row in rows])
+    rows = fetchall(q, (sequence_id, source_id, category_id))
+    return [row[0] for row in rows]
 
 
 @cache.memoize()
@@ -269,13 +276,22 @@ def get_attributes(category_id=DEFAULT_CATEGORY_ID):
     return output, all_att_names
 
 
-def get_dict_items_from_sql(category_id=DEFAULT_CATEGORY_ID):
-    """
-    Return raw SQL data for future processing in convert_to_dict_lookup
-    :param category_id:
-    :return:
-    """
-    q = """
+# Per-row hash of everything the dictionary lookup reads from a domain_dictionary row
+DICT_ITEM_HASH_SQL = """hashtext(concat_ws('|', dd.id, dd.attribute_id, dd.entity_id,
+                                         dd.text_value,
+                                         dd.source_entity_content->>'base',
+                                         da.code))"""
+
+DICT_ITEMS_FROM_SQL = """
+        FROM domain_dictionary dd, domain_taxonomy_nodes dtn, domain_attributes da
+        WHERE dd.entity_id = dtn.id
+        -- AND dd.entity_type = 'node'
+        AND dtn.attribute_id = da.id
+        AND da.category_id=%s
+"""
+
+
+DICT_ITEMS_SQL = """
         SELECT dd.id,
            dd.category_id,
            dd.attribute_id,
@@ -283,12 +299,17 @@ def get_dict_items_from_sql(category_id=DEFAULT_CATEGORY_ID):
            dd.text_value,
            dd.source_entity_content->>'base' base_value,
            da.code attribute_code
-        FROM domain_dictionary dd, domain_taxonomy_nodes dtn, domain_attributes da
-        WHERE dd.entity_id = dtn.id
-        -- AND dd.entity_type = 'node'
-        AND dtn.attribute_id = da.id
-        AND da.category_id=%s
+    """ + DICT_ITEMS_FROM_SQL
+
+
+def get_dict_items_from_sql(category_id=DEFAULT_CATEGORY_ID, ids=None):
     """
+    Return raw SQL data for future processing in convert_to_dict_lookup
+    :param category_id:
+    :param ids: only return rows with these domain_dictionary ids
+    :return:
+    """
+    q = DICT_ITEMS_SQL
 
     # Remove brand restrictions for now
     '''  AND CASE 
@@ -296,10 +317,57 @@ def get_dict_items_from_sql(category_id=DEFAULT_CATEGORY_ID):
           THEN dtn.id IN (SELECT distinct(value_node_id) FROM pipeline_attribute_values) ELSE 1=1 
         END;'''
 
-    rows = fetchall(q, (category_id,))
+    if ids is not None:
+        rows = fetchall(q + 'AND dd.id = ANY(%s)', (category_id, list(ids)))
+    else:
+        rows = fetchall(q, (category_id,))
     return rows
 
 
+def iter_dict_items_from_sql(category_id=DEFAULT_CATEGORY_ID, batch_size=10000):
+    """
+    Stream the rows of get_dict_items_from_sql() from a server-side cursor,
+    so a full dictionary build never holds the whole result set
+    :param batch_size: rows fetched per round trip
+    :return: iterator of rows
+    """
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            DICT_ITEMS_SQL, (category_id,))
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+
+def get_dict_items_fingerprint(category_id=DEFAULT_CATEGORY_ID):
+    """
+    Cheap summary of the dictionary rows: (row count, max id, sum of row hashes).
+    It changes whenever a row is added, removed or edited
+    """
+    q = f"""
+        SELECT count(*), coalesce(max(dd.id), 0), coalesce(sum({DICT_ITEM_HASH_SQL}), 0)
+    """ + DICT_ITEMS_FROM_SQL
+    row = fetchall(q, (category_id,))[0]
+    return int(row[0]), int(row[1]), int(row[2])
+
+
+def get_dict_item_hashes(category_id=DEFAULT_CATEGORY_ID):
+    """
+    Return {domain_dictionary id: row hash} used to find changed rows
+    """
+    q = f"""
+        SELECT dd.id, {DICT_ITEM_HASH_SQL}
+    """ + DICT_ITEMS_FROM_SQL
+    return {row[0]: row[1] for row in fetchall(q, (category_id,))}
+
+
+def fingerprint_from_hashes(hashes):
+    """Same value as get_dict_items_fingerprint() computed from get_dict_item_hashes()"""
+    return len(hashes), max(hashes, default=0), sum(hashes.values())
+
+
 def fetch_entities_without_vectors(category_id=DEFAULT_CATEGORY_ID):
     q = """
         SELECT dd.id, dd.text_value 
@@ -1,9 +1,17 @@
 import collections
+import itertools
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
 
 from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.lookup_stats import (
+    NO_TIMINGS)
+from application.db_extension.dictionary_lookup.normalizer import (
+    normalize_text)
 from application.logging import logger
 
 from application.db_extension.dictionary_lookup.postgres_functions import (
@@ -12,96 +20,256 @@ from application.db_extension.dictionary_lookup.utils import (
     get_starting_chr_bigrams)
 
 
+# Words counted for idf (the token_pattern of the TfidfVectorizer idf used to be fitted with)
 TOKEN_PATTERN = r'(?u)\b[\w\.]+\b'
+_TOKEN_RE = re.compile(TOKEN_PATTERN)
+
+FIELDNAMES = ('id',
+              'category_id',
+              'attribute_id',
+              'entity_id',
+              'text_value',
+              'base_value',
+              'attribute_code',
+              )
+
+
+def convert_row(row):
+    """
+    Normalize the text of a domain_dictionary row
+    :param row: row values in FIELDNAMES order
+    :return: entity dict
+    """
+    row = dict(zip(FIELDNAMES, row))
+    orig_str = row['text_value']
+    row['original_text_value'] = orig_str
+    # Use the value from postgres if it's there (should always be there)
+    # We also remove stopwords in lookup function
+    row['text_value'] = normalize_text(row['text_value']).without_stopwords
+    if row['text_value'] == '':
+        logger.debug('Add to nlp_ngrams: %s', orig_str)
+        row['text_value'] = orig_str
+    row['words'] = row['text_value'].split()
+    row['word_count'] = len(row['words'])
+    return row
 
 
 def convert_to_dict_lookup(data,
                            existing_entries=None,
                            log_function=logger.info):
-    from application.db_extension.dictionary_lookup.utils import cleanup_string, remove_stopwords
-
     if not existing_entries:
         existing_entries = set()
 
-    def _convert(row):
-        orig_str = row['text_value']
-        row['original_text_value'] = orig_str
-        # Use the value from postgres if it's there (should always be there)
-        cleaned_string = cleanup_string(row['text_value'])
-        row['text_value'], _ = remove_stopwords(cleaned_string)   # We also remove in lookup function
-        # row['text_value'] = cleaned_string
-        if row['text_value'] == '':
-            print("Add to nlp_ngrams: ", orig_str)
-            # logger.debug("Add to nlp_ngrams: ", orig_str)
-            row['text_value'] = orig_str
-        row['words'] = row['text_value'].split()
-        row['word_count'] = len(row['words'])
-        return row
-
     log_function('got data from database, starting convert process...')
-    fieldnames = ('id',
-                  'category_id',
-                  'attribute_id',
-                  'entity_id',
-                  'text_value',
-                  'base_value',
-                  'attribute_code',
-                  )
     # remove already existing rows from the list:
     log_function('{} rows to convert'.format(len(data)))
     for i, row in enumerate(data):
         if not i % 10000:
             log_function('{} rows converted, id={}'.format(i, row['id']))
-        data[i] = _convert(dict(zip(fieldnames, row)))
+        data[i] = convert_row(row)
     return data
 
 
-def process_dictionary(entities, log_function=logger.info):
-    entities_text = [entity['text_value'] for entity in entities]
-    vectorizer = TfidfVectorizer(ngram_range=(1, 1), norm=None, use_idf=True,
-                                 sublinear_tf=True, token_pattern=TOKEN_PATTERN)
-    vectorizer.fit_transform(entities_text)
-    idf = vectorizer.idf_
-    idf_dict = dict(zip(vectorizer.get_feature_names(), idf))
+def document_words(text):
+    """
+    Distinct words of an entity text counted for its document frequency,
+    tokenized like TfidfVectorizer(token_pattern=TOKEN_PATTERN)
+    """
+    return set(_TOKEN_RE.findall(text.lower()))
+
+
+def count_document_frequencies(entities):
+    """
+    :return: Counter of the number of entities each word is in
+    """
+    document_frequencies = collections.Counter()
+    for entity in entities:
+        document_frequencies.update(document_words(entity['text_value']))
+    return document_frequencies
+
+
+def idf_from_document_frequencies(document_frequencies, document_count):
+    """
+    Smoothed idf, the same values TfidfVectorizer(use_idf=True) fits:
+    ln((1 + n) / (1 + df)) + 1
+    :return: (word -> idf in word order, array of the idf values)
+    """
+    words = sorted(document_frequencies)
+    df = np.array([document_frequencies[word] for word in words],
+                  dtype=np.float64)
+    idf = np.log((document_count + 1) / (df + 1)) + 1
+    return dict(zip(words, idf)), idf
+
+
+def convert_batch(rows):
+    """
+    Everything a full build needs from a batch of rows, computed in one pass
+    (in a build process when there is a pool)
+    :param rows: row value tuples
+    :return: (entities, document frequencies, chr ngram -> ids of the batch)
+    """
+    entities = [convert_row(row) for row in rows]
+    return (entities, count_document_frequencies(entities),
+            create_ngrams(entities, {}))
+
+
+def build_processes():
+    """
+    :return: number of processes to convert the rows of a full build with.
+        Only a non daemonic process can start a pool: a rebuild in a celery
+        worker converts the rows in the worker itself (still streamed), the
+        pool is used by tools/build_dictionary_snapshot.py
+    """
+    if multiprocessing.current_process().daemon:
+        logger.info('daemonic process, converting the dictionary rows without '
+                    'a process pool (see tools/build_dictionary_snapshot.py)')
+        return 1
+    return config.DICTIONARY_BUILD_PROCESSES or os.cpu_count() or 1
+
+
+def convert_batches(batches, processes):
+    """
+    convert_batch() each batch, in a pool of processes when there is more
+    than one batch. Results come back in order and only a few batches are in
+    flight at a time, so the rows keep streaming from the database cursor
+    instead of being read all at once.
+    """
+    batches = iter(batches)
+    first_batches = list(itertools.islice(batches, 2))
+    if processes <= 1 or len(first_batches) < 2:
+        for batch in itertools.chain(first_batches, batches):
+            yield convert_batch(batch)
+        return
+
+    with ProcessPoolExecutor(processes) as executor:
+        pending = collections.deque()
+        for batch in itertools.chain(first_batches, batches):
+            pending.append(executor.submit(convert_batch, batch))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def convert_and_index(data, log_function=logger.info, timings=NO_TIMINGS,
+                      processes=None, batch_size=None):
+    """
+    Convert the domain_dictionary rows of a full build, count the document
+    frequency of each word and build the chr ngram index in the same pass
+    :param data: iterable of rows (e.g. streamed by iter_dict_items_from_sql())
+    :param timings: LookupTimings the fetch and normalize phases are added to
+    :return: (entities in row order, document frequencies, inverted index)
+    """
+    if processes is None:
+        processes = build_processes()
+    if batch_size is None:
+        batch_size = config.DICTIONARY_BUILD_BATCH_SIZE
+
+    def fetch_batches():
+        rows = iter(data)
+        while True:
+            with timings.stage('fetch'):
+                batch = [tuple(row)
+                         for row in itertools.islice(rows, batch_size)]
+            if not batch:
+                return
+            yield batch
+
+    log_function(f'converting dictionary rows with {processes} processes')
+    entities = []
+    document_frequencies = collections.Counter()
+    inverted_index = {}
+    converted = convert_batches(fetch_batches(), processes)
+    while True:
+        with timings.stage('normalize'):
+            batch = next(converted, None)
+        if batch is None:
+            break
+        batch_entities, batch_frequencies, batch_index = batch
+        with timings.stage('index'):
+            entities.extend(batch_entities)
+            document_frequencies.update(batch_frequencies)
+            for chr_ngram, ids in batch_index.items():
+                inverted_index.setdefault(chr_ngram, []).extend(ids)
+        log_function('{} rows converted'.format(len(entities)))
+    return entities, document_frequencies, inverted_index
 
-    # Get a cutoff for common words that we will use to determine whether it will satisfy the ngram intersection
-    # for entities, or in the case of very common ngrams we will want a second ngram to match as well.
-    # This is to deal with problems like 10,000 instances of 'chateau'. It also helps us avoid poor brand matches
-    cutoff_factor = config.LOOKUP_IDF_CUTOFF_FACTOR  # most common percentile of words
-    cutoff_idf = np.percentile(idf, cutoff_factor)
+
+def process_dictionary(entities, log_function=logger.info,
+                       document_frequencies=None, timings=NO_TIMINGS):
+    """
+    :param document_frequencies: of convert_and_index(), counted from the
+        entities if not given
+    :param timings: LookupTimings the idf, scoring and ordering phases are
+        added to
+    """
+    with timings.stage('idf'):
+        if document_frequencies is None:
+            document_frequencies = count_document_frequencies(entities)
+        idf_dict, idf = idf_from_document_frequencies(document_frequencies,
+                                                      len(entities))
+
+        # Get a cutoff for common words that we will use to determine whether it will satisfy the ngram intersection
+        # for entities, or in the case of very common ngrams we will want a second ngram to match as well.
+        # This is to deal with problems like 10,000 instances of 'chateau'. It also helps us avoid poor brand matches
+        cutoff_factor = config.LOOKUP_IDF_CUTOFF_FACTOR  # most common percentile of words
+        cutoff_idf = np.percentile(idf, cutoff_factor)
 
     # Add max theoretical score = idf * BIGRAM_BONUS * PERFECT_BONUS
     # Also determine whether entity requires non-common ngrams to match later
     # Then sort and save dict with entity_id as key
-    for entity in entities:
+    with timings.stage('score'):
+        for entity in entities:
+            score_entity(entity, idf_dict, cutoff_idf,
+                         log_function=log_function)
 
-        words = entity['words']
-        max_score = 0
-        insufficient_ngrams = []
-        for word in words:
-            if not idf_dict.get(word, None):
-                log_function(
-                    f"Could not get word: {word} for entity {entity['text_value']}")
-                continue
-            max_score += idf_dict[word]
-            ngram = get_starting_chr_bigrams([word])[0]
-            if idf_dict[word] < cutoff_idf:
-                insufficient_ngrams.append(ngram)
+    with timings.stage('order'):
+        sorted_entities = sorted(
+            entities, key=lambda k: k['max_idf'], reverse=True)
+        ordered_entities_dict, entities_text_id_dict = index_entities(
+            sorted_entities)
+
+    # Save dictionaries
+    log_function('saving dictionaries')
+
+    return idf_dict, ordered_entities_dict, entities_text_id_dict, cutoff_idf
 
-        # Make sure we didn't exclude everything!
-        if len(insufficient_ngrams) == len(words):
-            insufficient_ngrams = []
-        # convert to set for fast lookup
-        entity['insufficient_ngrams'] = set(insufficient_ngrams)
 
-        # Set max theoretical idf (we aren't currently using this - used maybe for early exit)
-        entity['max_idf'] = max_score * config.LOOKUP_PERFECT_BONUS
-        entity['max_idf'] *= (1 + len(words) *
-                              config.LOOKUP_NGRAM_BONUS) if len(words) > 1 else 1
+def score_entity(entity, idf_dict, cutoff_idf, log_function=logger.info):
+    """
+    Set max_idf and insufficient_ngrams of the entity
+    """
+    words = entity['words']
+    max_score = 0
+    insufficient_ngrams = []
+    for word in words:
+        if not idf_dict.get(word, None):
+            log_function(
+                f"Could not get word: {word} for entity {entity['text_value']}")
+            continue
+        max_score += idf_dict[word]
+        ngram = get_starting_chr_bigrams([word])[0]
+        if idf_dict[word] < cutoff_idf:
+            insufficient_ngrams.append(ngram)
+
+    # Make sure we didn't exclude everything!
+    if len(insufficient_ngrams) == len(words):
+        insufficient_ngrams = []
+    # convert to set for fast lookup
+    entity['insufficient_ngrams'] = set(insufficient_ngrams)
+
+    # Set max theoretical idf (we aren't currently using this - used maybe for early exit)
+    entity['max_idf'] = max_score * config.LOOKUP_PERFECT_BONUS
+    entity['max_idf'] *= (1 + len(words) *
+                          config.LOOKUP_NGRAM_BONUS) if len(words) > 1 else 1
+    return entity
 
-    sorted_entities = sorted(
-        entities, key=lambda k: k['max_idf'], reverse=True)
 
+def index_entities(sorted_entities):
+    """
+    :param sorted_entities: entities sorted by max_idf
+    :return: (ordered_entities_dict, entities_text_id_dict)
+    """
     ordered_entities_dict = collections.OrderedDict()
     entities_text_id_dict = {}
     for entity in sorted_entities:
@@ -123,11 +291,60 @@ def process_dictionary(entities, log_function=logger.info):
             else:  # is set
                 entities_text_id_dict[entity['text_value']].append(
                     entity['id'])
+    return ordered_entities_dict, entities_text_id_dict
 
-    # Save dictionaries
-    log_function('saving dictionaries')
 
-    return idf_dict, ordered_entities_dict, entities_text_id_dict, cutoff_idf
+def apply_dictionary_delta(dictionary, added_entities, removed_ids,
+                           cutoff_idf, log_function=logger.info):
+    """
+    Apply changed domain_dictionary rows to a compiled dictionary without
+    refitting idf. Words that are already known keep their idf; new words get
+    the (smoothed) idf TfidfVectorizer would give them for the current
+    document frequency. Edited rows are passed both as removed and added.
+    :param dictionary: CompiledDictionary
+    :param added_entities: new rows, already converted with convert_to_dict_lookup()
+    :param removed_ids: domain_dictionary ids to drop
+    :param cutoff_idf: common word idf cutoff of the last full build
+    :return: (CompiledDictionary, entities_text_id_dict)
+    """
+    removed_ids = set(removed_ids) | {e['id'] for e in added_entities}
+    entities = [e for e in dictionary.to_entities()
+                if e['id'] not in removed_ids]
+
+    idf_dict = dict(zip(dictionary.words, dictionary.idf.tolist()))
+    # Words are counted the way a full build counts them (document_words()), so words the
+    # token pattern leaves out keep no idf, as after a rebuild
+    new_words = {word for entity in added_entities
+                 for word in document_words(entity['text_value'])
+                 if word not in idf_dict}
+    if new_words:
+        document_count = len(entities) + len(added_entities)
+        df = collections.Counter(
+            word for entity in entities + added_entities
+            for word in document_words(entity['text_value'])
+            if word in new_words)
+        for word in new_words:
+            idf_dict[word] = np.log((1 + document_count) / (1 + df[word])) + 1
+        log_function(f'{len(new_words)} new words in dictionary delta')
+
+    for entity in added_entities:
+        score_entity(entity, idf_dict, cutoff_idf, log_function=log_function)
+    sorted_entities = sorted(entities + added_entities,
+                             key=lambda k: k['max_idf'], reverse=True)
+    _, entities_text_id_dict = index_entities(sorted_entities)
+
+    # Carry the ngram index over and only update the changed rows
+    inverted_index = {}
+    for chr_ngram in dictionary.ngram_postings.keys:
+        ids = dictionary.ids[dictionary.ngram_postings.get(chr_ngram)].tolist()
+        inverted_index[chr_ngram] = [i for i in ids if i not in removed_ids]
+    inverted_index = create_ngrams(added_entities, inverted_index)
+
+    from application.db_extension.dictionary_lookup.compiled_dictionary import (
+        CompiledDictionary)
+    dictionary = CompiledDictionary.from_entities(
+        idf_dict, sorted_entities, inverted_index)
+    return dictionary, entities_text_id_dict
 
 
 # INVERTED INDEX FUNCTION
@@ -0,0 +1,233 @@
+"""
+Versioned, memory-mappable snapshot of the compiled lookup dictionary
+
+File layout:
+    magic (8 bytes) | format version (uint32) | header length (uint32)
+    header (JSON: dictionary version, build info, array directory)
+    arrays (raw little-endian buffers, each aligned to ALIGNMENT bytes)
+
+Arrays are loaded with np.frombuffer() over a read-only mmap, so loading is
+O(header) and every process that maps the same file shares its pages through
+the OS page cache.
+"""
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.compiled_dictionary import (
+    CompiledDictionary,
+    PostingLists,
+    StringColumn,
+    pack_strings,
+    unpack_strings)
+
+SNAPSHOT_MAGIC = b'M3DICT\x00\x00'
+SNAPSHOT_FORMAT_VERSION = 4
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sII')
+
+
+def snapshot_path(category_id):
+    return Path(config.DICTIONARY_SNAPSHOT_DIR) / \
+        f'dictionary_lookup_{category_id}.v{SNAPSHOT_FORMAT_VERSION}.snapshot'
+
+
+@contextmanager
+def snapshot_lock(path):
+    """
+    Exclusive lock of the snapshot at ``path``, held while updating it so
+    processes sharing the snapshot don't rebuild the dictionary at once
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(f'{path}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _dictionary_arrays(dictionary, entities_text_id_dict):
+    arrays = {
+        'idf': dictionary.idf,
+        'ids': dictionary.ids,
+        'entity_ids': dictionary.entity_ids,
+        'attribute_ids': dictionary.attribute_ids,
+        'attribute_code_idx': dictionary.attribute_code_idx,
+        'word_offsets': dictionary.word_offsets,
+        'word_tokens': dictionary.word_tokens,
+        'max_idf': dictionary.max_idf,
+        'row_hashes': dictionary.row_hashes,
+        'id_order': dictionary.id_order,
+        'word_rows': dictionary.word_rows,
+        'token_initials': dictionary.token_initials,
+    }
+    arrays['words'], arrays['words_offsets'] = pack_strings(dictionary.words)
+    for name in ('original_text', 'base_values'):
+        column = getattr(dictionary, name)
+        arrays[name] = column.data
+        arrays[f'{name}_offsets'] = column.offsets
+        arrays[f'{name}_nulls'] = column.nulls
+    for name in ('ngram_postings', 'insufficient_postings', 'code_postings'):
+        postings = getattr(dictionary, name)
+        arrays[f'{name}_keys'], arrays[f'{name}_keys_offsets'] = \
+            pack_strings(postings.keys)
+        arrays[f'{name}_offsets'] = postings.offsets
+        arrays[f'{name}_rows'] = postings.rows
+
+    # Exact match dict: text -> id, or text -> [ids] for ambiguous texts
+    texts = list(entities_text_id_dict)
+    values = [entities_text_id_dict[text] for text in texts]
+    arrays['exact_texts'], arrays['exact_texts_offsets'] = pack_strings(texts)
+    arrays['exact_is_list'] = np.array(
+        [isinstance(v, list) for v in values], dtype=np.uint8)
+    exact_ids = [v if isinstance(v, list) else [v] for v in values]
+    arrays['exact_offsets'] = np.zeros(len(exact_ids) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in exact_ids], out=arrays['exact_offsets'][1:])
+    arrays['exact_ids'] = np.array([i for v in exact_ids for i in v],
+                                   dtype=np.int64)
+    return arrays
+
+
+def write_snapshot(dictionary, entities_text_id_dict, path, **build_info):
+    """
+    Write the compiled dictionary to ``path`` (atomically)
+    :param dictionary: CompiledDictionary
+    :param entities_text_id_dict: exact match dict (text -> id or [ids])
+    :param path: destination file
+    :param build_info: extra JSON-serializable values stored in the header
+    :return: dictionary version (hash of the snapshot contents)
+    """
+    arrays = _dictionary_arrays(dictionary, entities_text_id_dict)
+    directory = {}
+    offset = 0
+    digest = hashlib.sha1()
+    for name, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        arrays[name] = arr
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        directory[name] = {'dtype': arr.dtype.newbyteorder('<').str,
+                           'offset': offset, 'count': len(arr)}
+        digest.update(name.encode('utf8'))
+        digest.update(arr.tobytes())
+        offset += arr.nbytes
+    digest.update(json.dumps(dictionary.attribute_codes).encode('utf8'))
+
+    version = digest.hexdigest()[:16]
+    now = datetime.now()
+    header = {'version': version,
+              'built_at': now.isoformat(),
+              'built_timestamp': now.timestamp(),
+              'attribute_codes': dictionary.attribute_codes,
+              'arrays': directory}
+    header.update(build_info)
+    header_bytes = json.dumps(header).encode('utf8')
+    data_start = -(-(_PREAMBLE.size + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_PREAMBLE.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION,
+                                   len(header_bytes)))
+            f.write(header_bytes)
+            for name, arr in arrays.items():
+                f.seek(data_start + directory[name]['offset'])
+                f.write(arr.astype(directory[name]['dtype'], copy=False)
+                        .tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return version
+
+
+def read_snapshot_header(path):
+    with open(path, 'rb') as f:
+        magic, format_version, header_length = _PREAMBLE.unpack(
+            f.read(_PREAMBLE.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a dictionary snapshot')
+        if format_version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f'{path} has snapshot format {format_version}, '
+                             f'expected {SNAPSHOT_FORMAT_VERSION}')
+        header = json.loads(f.read(header_length).decode('utf8'))
+    header['data_start'] = -(-(_PREAMBLE.size + header_length) //
+                             ALIGNMENT) * ALIGNMENT
+    return header
+
+
+def read_snapshot(path):
+    """
+    Memory-map a snapshot written by write_snapshot()
+    :return: (CompiledDictionary, entities_text_id_dict, header)
+    """
+    header = read_snapshot_header(path)
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        if not spec['count']:
+            arrays[name] = np.zeros(0, dtype=spec['dtype'])
+            continue
+        arrays[name] = np.frombuffer(buffer, dtype=spec['dtype'],
+                                     count=spec['count'],
+                                     offset=header['data_start'] +
+                                     spec['offset'])
+
+    def postings(name):
+        return PostingLists(
+            unpack_strings(arrays[f'{name}_keys'],
+                           arrays[f'{name}_keys_offsets']),
+            arrays[f'{name}_offsets'], arrays[f'{name}_rows'])
+
+    dictionary = CompiledDictionary(
+        words=unpack_strings(arrays['words'], arrays['words_offsets']),
+        idf=arrays['idf'],
+        ids=arrays['ids'],
+        entity_ids=arrays['entity_ids'],
+        attribute_ids=arrays['attribute_ids'],
+        attribute_codes=header['attribute_codes'],
+        attribute_code_idx=arrays['attribute_code_idx'],
+        word_offsets=arrays['word_offsets'],
+        word_tokens=arrays['word_tokens'],
+        max_idf=arrays['max_idf'],
+        original_text=StringColumn(arrays['original_text'],
+                                   arrays['original_text_offsets'],
+                                   arrays['original_text_nulls']),
+        base_values=StringColumn(arrays['base_values'],
+                                 arrays['base_values_offsets'],
+                                 arrays['base_values_nulls']),
+        ngram_postings=postings('ngram_postings'),
+        insufficient_postings=postings('insufficient_postings'),
+        row_hashes=arrays['row_hashes'],
+        id_order=arrays['id_order'],
+        word_rows=arrays['word_rows'],
+        token_initials=arrays['token_initials'],
+        code_postings=postings('code_postings'))
+
+    texts = unpack_strings(arrays['exact_texts'],
+                           arrays['exact_texts_offsets'])
+    exact_offsets = arrays['exact_offsets'].tolist()
+    exact_ids = arrays['exact_ids'].tolist()
+    entities_text_id_dict = {}
+    for i, (text, is_list) in enumerate(
+            zip(texts, arrays['exact_is_list'].tolist())):
+        ids = exact_ids[exact_offsets[i]:exact_offsets[i + 1]]
+        entities_text_id_dict[text] = ids if is_list else ids[0]
+    return dictionary, entities_text_id_dict, header
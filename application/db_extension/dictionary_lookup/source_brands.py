@@ -0,0 +1,87 @@
+"""
+Brands sold by each source, for human lookups
+
+A brand the source doesn't sell only matches a human query if it is spelled
+exactly (see get_row_candidate() and check_top_matches()). The brand node ids
+of the last completed pipeline run of a source are held as a bitset over node
+ids, built once per pipeline run instead of being queried for each lookup.
+"""
+import time
+
+import numpy as np
+
+from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.postgres_functions import (
+    get_last_ready_sequence_id,
+    get_source_brand_node_ids)
+
+
+class BrandBitset:
+    """
+    Set of brand node ids stored as one bit per node id
+    :param sequence_id: pipeline run the brands were read from
+    """
+    __slots__ = ('bits', 'count', 'sequence_id')
+
+    def __init__(self, node_ids, sequence_id=None):
+        node_ids = np.unique(np.fromiter(
+            (node_id for node_id in node_ids if node_id is not None),
+            dtype=np.int64))
+        node_ids = node_ids[node_ids >= 0]
+        flags = np.zeros(node_ids[-1] + 1 if len(node_ids) else 0, dtype=bool)
+        flags[node_ids] = True
+        self.bits = np.packbits(flags).tobytes()
+        self.count = len(node_ids)
+        self.sequence_id = sequence_id
+
+    def __contains__(self, node_id):
+        i = node_id >> 3
+        return 0 <= i < len(self.bits) and \
+            bool(self.bits[i] & (0x80 >> (node_id & 7)))
+
+    def __len__(self):
+        return self.count
+
+
+class SourceBrands:
+    """
+    BrandBitset of each source. It is loaded on first use and rebuilt when
+    execute_pipeline() completes a run of the source (see refresh()).
+    Processes that didn't run the pipeline check for a newer completed run
+    every SOURCE_BRANDS_CHECK_SECONDS.
+    """
+
+    def __init__(self):
+        self._brands = {}  # source_id -> (BrandBitset, monotonic time checked)
+
+    def get(self, source_id):
+        """
+        :return: BrandBitset of the brands source_id sells
+        """
+        entry = self._brands.get(source_id)
+        now = time.monotonic()
+        if entry is not None and \
+                now - entry[1] < config.SOURCE_BRANDS_CHECK_SECONDS:
+            return entry[0]
+        sequence_id = get_last_ready_sequence_id(source_id)
+        if entry is not None and entry[0].sequence_id == sequence_id:
+            self._brands[source_id] = (entry[0], now)
+            return entry[0]
+        return self.refresh(source_id, sequence_id)
+
+    def refresh(self, source_id, sequence_id=None):
+        """
+        Rebuild the brands of source_id from its pipeline run sequence_id
+        (by default, the last completed one)
+        :return: BrandBitset
+        """
+        if sequence_id is None:
+            sequence_id = get_last_ready_sequence_id(source_id)
+        node_ids = get_source_brand_node_ids(source_id, sequence_id) \
+            if sequence_id is not None else []
+        brands = BrandBitset(node_ids, sequence_id)
+        self._brands[source_id] = (brands, time.monotonic())
+        return brands
+
+    def clear(self):
+        self._brands = {}
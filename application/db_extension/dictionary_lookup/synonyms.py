@@ -0,0 +1,121 @@
+"""
+Synonym rewriting with an Aho-Corasick automaton over the nlp_synonyms table
+
+The original rewrite runs one re.sub() per synonym row, in table order, each
+row seeing the output of the previous ones. SynonymRewriter gives the same
+output, but only runs the rows whose source text actually occurs in the
+string: one automaton pass over the string finds them (with the
+must_be_at_beginning / is_whole_word boundaries checked on each hit), and the
+string is only scanned again, for the rows after it, when a row changed it.
+"""
+import re
+
+# Characters other than ASCII letters that re.IGNORECASE matches with an ASCII letter
+_IGNORECASE_FOLD = {0x130: 'i', 0x131: 'i', 0x17f: 's', 0x212a: 'k'}
+_ASCII_FOLD = {c: chr(c + 32) for c in range(ord('A'), ord('Z') + 1)}
+_ASCII_FOLD.update(_IGNORECASE_FOLD)
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+_WORD = re.compile(r'\w')
+
+
+def _is_word(text, i):
+    return 0 <= i < len(text) and _WORD.match(text, i) is not None
+
+
+class SynonymRewriter:
+    """
+    Compiled nlp_synonyms table
+    :param rows: rows of get_nlp_synonyms() (in table order)
+    """
+
+    def __init__(self, rows):
+        self.rules = []
+        # rules the automaton can't find (regex sources, non ASCII text): always tried
+        self.unindexed = []
+        # trie: goto[state] = {char: state}; output[state] = [(rule index, source length)]
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for i, row in enumerate(rows):
+            self.rules.append({'regex': re.compile(row['rg'], flags=re.I),
+                               'target': row['target_text'],
+                               'at_beginning': bool(row['must_be_at_beginning']),
+                               'whole_word': bool(row['is_whole_word'])})
+            source = row['source_text']
+            if not source or any(ord(c) > 127 for c in source) or \
+                    _REGEX_SPECIAL.intersection(source):
+                self.unindexed.append(i)
+            else:
+                self._add(source.translate(_ASCII_FOLD), i)
+        self._link()
+
+    def _add(self, source, rule):
+        state = 0
+        for c in source:
+            next_state = self.goto[state].get(c)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][c] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append((rule, len(source)))
+
+    def _link(self):
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for c, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and c not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(c, 0)
+                self.output[next_state] = self.output[next_state] + \
+                    self.output[self.fail[next_state]]
+
+    def find(self, text, after=-1):
+        """
+        :return: sorted indexes (> after) of the rules that can match text
+        """
+        found = {i for i in self.unindexed if i > after}
+        folded = text.translate(_ASCII_FOLD)
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for end, c in enumerate(folded, 1):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for rule, length in output[state]:
+                if rule <= after or rule in found:
+                    continue
+                start = end - length
+                at_beginning = self.rules[rule]['at_beginning']
+                whole_word = self.rules[rule]['whole_word']
+                # pattern is r'^source\b', r'\bsource\b' or r'source'
+                if at_beginning and start:
+                    continue
+                if (at_beginning or whole_word) and \
+                        _is_word(text, end - 1) == _is_word(text, end):
+                    continue
+                if whole_word and not at_beginning and \
+                        _is_word(text, start) == _is_word(text, start - 1):
+                    continue
+                found.add(rule)
+        return sorted(found)
+
+    def rewrite(self, text):
+        """
+        Apply every synonym row to text, in table order
+        (same as one pass of the original re.sub() loop)
+        """
+        candidates = self.find(text)
+        while candidates:
+            rule = candidates.pop(0)
+            rewritten = self.rules[rule]['regex'].sub(
+                self.rules[rule]['target'], text)
+            if rewritten != text:
+                text = rewritten
+                # the new text can contain sources of the following rows
+                candidates = self.find(text, after=rule)
+        return text
@@ -0,0 +1,38 @@
+"""
+Micro-benchmark of normalize_text() against the regex chain it replaced
+
+    python -m application.db_extension.dictionary_lookup.tests.bench_normalizer [repeat]
+"""
+import sys
+import timeit
+
+from application.db_extension.dictionary_lookup.normalizer import normalize_text
+from application.db_extension.dictionary_lookup.tests.test_normalizer import (
+    corpus,
+    fuzz_corpus,
+    reference_cleanup_string)
+from application.db_extension.dictionary_lookup.utils import remove_stopwords
+
+
+def reference(sentences):
+    for sentence in sentences:
+        remove_stopwords(reference_cleanup_string(sentence))
+
+
+def normalizer(sentences):
+    for sentence in sentences:
+        normalize_text(sentence)
+
+
+def main(repeat=5):
+    for name, sentences in (('corpus', corpus() * 50),
+                            ('fuzz', fuzz_corpus(5000))):
+        for function in (reference, normalizer):
+            best = min(timeit.repeat(lambda: function(sentences),
+                                     number=1, repeat=repeat))
+            print(f'{name:8} {function.__name__:12} '
+                  f'{best / len(sentences) * 1e6:8.2f} us/sentence')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
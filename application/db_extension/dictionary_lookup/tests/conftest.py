@@ -0,0 +1,76 @@
+import zlib
+
+import pytest
+from flask import Flask
+
+# postgres_functions reads the default category when it is imported
+_import_app = Flask(__name__)
+_import_app.config['DEFAULT_CATEGORY_ID'] = 1
+with _import_app.app_context():
+    from application.db_extension.dictionary_lookup import config, lookup
+    from application.db_extension.dictionary_lookup.postgres_functions import (
+        fingerprint_from_hashes)
+
+FIELDNAMES = ('id', 'category_id', 'attribute_id', 'entity_id', 'text_value',
+              'base_value', 'attribute_code')
+
+ENTITIES = [
+    (1, 1, 1, 101, 'Cabernet Sauvignon', None, 'varietals'),
+    (2, 1, 1, 102, 'Sauvignon Blanc', None, 'varietals'),
+    (3, 1, 1, 103, 'Pinot Noir', None, 'varietals'),
+    (4, 1, 1, 104, 'Chardonnay', None, 'varietals'),
+    (5, 1, 1, 105, 'Merlot', None, 'varietals'),
+    (6, 1, 1, 106, 'Pinot Grigio', None, 'varietals'),
+    (7, 1, 2, 201, 'Napa Valley', None, 'region'),
+    (8, 1, 2, 202, 'Sonoma Coast', None, 'region'),
+    (9, 1, 2, 203, 'Russian River Valley', None, 'region'),
+    (10, 1, 2, 204, 'Bordeaux', None, 'region'),
+    (11, 1, 3, 301, 'Silver Oak', None, 'brand'),
+    (12, 1, 3, 302, 'Kendall Jackson', None, 'brand'),
+    (13, 1, 3, 303, 'Duckhorn Vineyards', None, 'brand'),
+    (14, 1, 4, 401, 'Full Bodied', None, 'body'),
+    (15, 1, 4, 402, 'Light Bodied', None, 'body'),
+    (16, 1, 5, 501, 'Red Wine', None, 'type'),
+    (17, 1, 5, 502, 'White Wine', None, 'type'),
+]
+
+class Row(tuple):
+    """Stands in for a database row: iterable and indexable by column name"""
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = FIELDNAMES.index(key)
+        return tuple.__getitem__(self, key)
+
+
+def get_rows(category_id, ids=None):
+    return [Row(row) for row in ENTITIES if ids is None or row[0] in ids]
+
+
+def get_hashes(category_id):
+    # same range as postgres hashtext()
+    return {row[0]: zlib.crc32(repr(row).encode('utf8')) - 2 ** 31
+            for row in ENTITIES}
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.config['DEFAULT_CATEGORY_ID'] = 1
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def dictionary_lookup(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(config, 'DICTIONARY_SNAPSHOT_DIR', str(tmp_path))
+    monkeypatch.setattr(lookup, 'get_dict_items_from_sql', get_rows)
+    monkeypatch.setattr(lookup, 'iter_dict_items_from_sql', get_rows)
+    monkeypatch.setattr(lookup, 'get_dict_item_hashes', get_hashes)
+    monkeypatch.setattr(lookup, 'get_dict_items_fingerprint',
+                        lambda category_id: fingerprint_from_hashes(
+                            get_hashes(category_id)))
+    lookup.dictionary_lookup.update_dictionary_lookup_data(
+        log_function=lambda *args: None, force=True)
+    lookup.dictionary_lookup.result_cache.clear()
+    return lookup.dictionary_lookup
@@ -0,0 +1,92 @@
+import pytest
+
+from application.caching import cache
+from application.db_extension import routines
+from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.parity import diff_attributes
+
+
+@pytest.fixture
+def memory_engine(monkeypatch, dictionary_lookup):
+    monkeypatch.setattr(config, 'ATTRIBUTE_LOOKUP_ENGINE', 'memory')
+
+    def no_database(*args, **kwargs):
+        raise AssertionError('attribute_lookup2 called')
+
+    monkeypatch.setattr(routines, 'postgres_attribute_lookup', no_database)
+    monkeypatch.setattr(routines.db, 'session', None, raising=False)
+    return dictionary_lookup
+
+
+def codes(attributes):
+    return sorted((a['code'], a['node_id']) for a in attributes)
+
+
+def test_brand_treatment(memory_engine):
+    sentence = 'Silver Oak Cabernet Sauvignon'
+    assert codes(routines.attribute_lookup.uncached(
+        sentence, brand_treatment='include')) == [('brand', 301),
+                                                  ('varietals', 101)]
+    assert codes(routines.attribute_lookup.uncached(
+        sentence, brand_treatment='exclude')) == [('varietals', 101)]
+
+
+def test_attribute_code(memory_engine):
+    sentence = 'Duckhorn Vineyards Merlot, Napa Valley'
+    assert codes(routines.attribute_lookup.uncached(
+        sentence, brand_treatment='include', attribute_code='brand')) == [
+        ('brand', 303)]
+    assert codes(routines.attribute_lookup.uncached(
+        sentence, attribute_code='region')) == [('region', 201)]
+    assert routines.attribute_lookup.uncached(
+        sentence, attribute_code='brand') == []
+
+
+def test_batch_matches_single_lookups(memory_engine):
+    sentences = ['Silver Oak Cabernet Sauvignon', 'Pinot Noir',
+                 'Silver Oak Cabernet Sauvignon', 'nothing to find here']
+    results = routines.attribute_lookup_many(sentences,
+                                             brand_treatment='include')
+    assert results == [routines.attribute_lookup.uncached(
+        sentence, brand_treatment='include') for sentence in sentences]
+    assert results[3] == []
+
+
+def test_batch_reuses_cached_results(app, dictionary_lookup, monkeypatch):
+    cache.init_app(app, config={'CACHE_TYPE': 'SimpleCache'})
+    queries = []
+    merlot = {'code': 'varietals', 'node_id': 105, 'start': 0, 'end': 0}
+
+    class Session:
+        def execute(self, q, params):
+            queries.append(params['sentences'])
+            return [(i, {'attributes': [merlot]})
+                    for i, _ in enumerate(params['sentences'], 1)]
+
+    monkeypatch.setattr(routines.db, 'session', Session(), raising=False)
+    sentences = ['Merlot', 'Napa Merlot', 'Merlot']
+    assert routines.attribute_lookup_many(sentences) == [[merlot]] * 3
+    assert routines.attribute_lookup_many(sentences) == [[merlot]] * 3
+    assert routines.attribute_lookup_many(['Napa Merlot', 'Sonoma Merlot'])
+    # the second batch is served by the cache, the third queries only its miss
+    assert [sorted(sentences) for sentences in queries] == [
+        ['merlot', 'napa merlot'], ['sonoma merlot']]
+
+
+def test_unknown_settings(memory_engine, monkeypatch):
+    with pytest.raises(ValueError):
+        routines.attribute_lookup.uncached('merlot', brand_treatment='only')
+    monkeypatch.setattr(config, 'ATTRIBUTE_LOOKUP_ENGINE', 'mysql')
+    with pytest.raises(ValueError):
+        routines.attribute_lookup.uncached('merlot')
+
+
+def test_diff_attributes():
+    merlot = {'code': 'varietals', 'node_id': 105, 'start': 2, 'end': 2}
+    napa = {'code': 'region', 'node_id': 201, 'start': 3, 'end': 4}
+    oak = {'code': 'brand', 'node_id': 301, 'start': 0, 'end': 1}
+    diff = diff_attributes([merlot, napa], [dict(merlot, start=1, end=1), oak])
+    assert diff['missing'] == [napa]
+    assert diff['extra'] == [oak]
+    assert [m['memory']['start'] for m in diff['moved']] == [1]
+    assert not any(diff_attributes([merlot], [merlot]).values())
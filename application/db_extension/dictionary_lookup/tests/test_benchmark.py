@@ -0,0 +1,44 @@
+import json
+
+from application.db_extension.dictionary_lookup.benchmark import (
+    dump_rows,
+    generate_product_names,
+    generate_review_sentences,
+    generate_rows,
+    load_rows,
+    run_benchmark)
+
+
+def test_generated_rows_are_reproducible():
+    rows = generate_rows(500, seed=3)
+    assert rows == generate_rows(500, seed=3)
+    assert rows != generate_rows(500, seed=4)
+    assert {row['attribute_code'] for row in rows} >= {
+        'brand', 'region', 'varietals'}
+    assert len({row['id'] for row in rows}) == len(rows)
+
+
+def test_dump_and_load_rows(tmp_path):
+    rows = generate_rows(100)
+    path = str(tmp_path / 'rows.json')
+    dump_rows(rows, path)
+    loaded = load_rows(path)
+    assert loaded == rows
+    assert loaded[0]['text_value'] == rows[0][4]
+
+
+def test_run_benchmark():
+    rows = generate_rows(400)
+    report = run_benchmark(rows, {
+        'product_names': generate_product_names(rows, 10),
+        'review_sentences': generate_review_sentences(rows, 10),
+    })
+    assert report['build']['rows'] == len(rows)
+    assert report['build']['entities'] > 0
+    for name in ('product_names', 'review_sentences'):
+        for mode in ('fuzzy_off', 'fuzzy_on'):
+            timings = report['lookups'][name][mode]
+            assert timings['queries'] == 10
+            assert timings['p50_ms'] <= timings['p95_ms'] <= timings['p99_ms']
+            assert timings['matched_attributes'] > 0
+    json.dumps(report)
@@ -0,0 +1,101 @@
+from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.compiled_dictionary import (
+    CompiledDictionary,
+    code_postings_key)
+
+
+def make_entity(entity_id, text, max_idf, insufficient_ngrams=(),
+                attribute_code='region'):
+    words = text.split()
+    return {'id': entity_id, 'entity_id': entity_id, 'attribute_id': 1,
+            'attribute_code': attribute_code, 'text_value': text,
+            'original_text_value': text, 'base_value': None, 'words': words,
+            'word_count': len(words),
+            'insufficient_ngrams': set(insufficient_ngrams),
+            'max_idf': max_idf}
+
+
+def test_ngram_postings_are_sorted_distinct_and_filtered():
+    # rows in max_idf order: 30, 10, 20
+    entities = [make_entity(30, 'chateau margaux', 9.0),
+                make_entity(10, 'chateau chalon', 8.0, ['cha']),
+                make_entity(20, 'margaux', 7.0)]
+    inverted_index = {'cha': [10, 10, 30], 'mar': [20, 30]}
+    dictionary = CompiledDictionary.from_entities(
+        {'chateau': 1.0, 'margaux': 2.0, 'chalon': 3.0}, entities,
+        inverted_index)
+    assert dictionary.ngram_postings.get('cha').tolist() == [0]
+    assert dictionary.ngram_postings.get('mar').tolist() == [0, 2]
+    # the insufficient ngrams are still known for to_entities()
+    assert dictionary.to_entities()[1]['insufficient_ngrams'] == {'cha'}
+
+
+def test_code_postings():
+    # rows: 0 brand, 1 region, 2 brand
+    entities = [make_entity(1, 'chateau margaux', 9.0,
+                            attribute_code='brand'),
+                make_entity(2, 'chablis', 8.0),
+                make_entity(3, 'chateau latour', 7.0, attribute_code='brand')]
+    dictionary = CompiledDictionary.from_entities(
+        {'chateau': 1.0, 'margaux': 2.0, 'chablis': 3.0, 'latour': 4.0},
+        entities, {'cha': [3, 2, 1], 'lat': [3]})
+    brand, region = dictionary.attribute_code_indexes(['brand', 'region'])
+    postings = dictionary.code_postings
+    assert postings.get(code_postings_key(brand, 'cha')).tolist() == [0, 2]
+    assert postings.get(code_postings_key(region, 'cha')).tolist() == [1]
+    assert postings.get(code_postings_key(brand, 'lat')).tolist() == [2]
+    assert code_postings_key(region, 'lat') not in postings
+
+
+def test_rows_with_initial_and_tokens():
+    entities = [make_entity(1, 'chateau margaux', 9.0),
+                make_entity(2, 'chablis', 8.0),
+                make_entity(3, 'margaux', 7.0)]
+    dictionary = CompiledDictionary.from_entities(
+        {'chateau': 1.0, 'margaux': 2.0, 'chablis': 3.0}, entities, {})
+    assert dictionary.rows_with_initial('c').tolist() == [0, 1]
+    assert dictionary.rows_with_initial('m').tolist() == [0, 2]
+    assert dictionary.rows_with_initial('x').tolist() == []
+    tokens = dictionary.encode(['margaux', 'chablis'])
+    assert dictionary.rows_with_tokens(tokens).tolist() == [0, 1, 2]
+    assert dictionary.rows_with_tokens([]).tolist() == []
+
+
+def test_build_lazy_indexes():
+    entities = [make_entity(1, 'chateau margaux', 9.0),
+                make_entity(2, 'chablis', 8.0)]
+    dictionary = CompiledDictionary.from_entities(
+        {'chateau': 1.0, 'margaux': 2.0, 'chablis': 3.0}, entities, {})
+    dictionary.build_lazy_indexes()
+    assert dictionary._fuzzy_index is not None
+    assert dictionary._initial_postings is not None
+    assert dictionary._token_postings is not None
+    assert dictionary.rows_with_initial('c').tolist() == [0, 1]
+    assert dictionary.rows_with_tokens(
+        dictionary.encode(['margaux'])).tolist() == [0]
+
+
+def test_fallback_rows(dictionary_lookup, monkeypatch):
+    words = ['cxbernet', 'merlot']
+    with dictionary_lookup.query_context():
+        dictionary = dictionary_lookup.dictionary
+        tokens = dictionary.encode(words)
+
+        def fallback_texts(is_allow_fuzzy, attr_codes=None):
+            rows = dictionary_lookup.get_bigram_lists(
+                ['cxb'], attr_codes, None, words, tokens, is_allow_fuzzy)
+            return [dictionary.original_text[row] for row in rows]
+
+        # only the entities starting with 'c' that can match a query word
+        assert fallback_texts(False) == []
+        assert fallback_texts(True) == ['Cabernet Sauvignon']
+        assert fallback_texts(True, ['region']) == []
+        monkeypatch.setattr(dictionary_lookup, 'get_fuzzy_matches',
+                            lambda *args: [{token: 90}
+                                           for token in range(len(
+                                               dictionary.words))])
+        # every entity with a word starting with 'c' can match, up to the cap
+        assert fallback_texts(True) == \
+            ['Sonoma Coast', 'Cabernet Sauvignon', 'Chardonnay']
+        monkeypatch.setattr(config, 'LOOKUP_FALLBACK_MAX_ROWS', 2)
+        assert fallback_texts(True) == ['Sonoma Coast', 'Cabernet Sauvignon']
@@ -0,0 +1,80 @@
+from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.lookup import UNMATCHABLE
+
+
+def exact_spans(dictionary_lookup, query, disallow_brand=False,
+                is_single_brand=True, attr_codes=()):
+    words_in_query = query.split()
+    with dictionary_lookup.query_context():
+        query_tokens = dictionary_lookup.dictionary.encode(words_in_query)
+        spans = dictionary_lookup.find_exact_spans(
+            words_in_query, query_tokens, disallow_brand, is_single_brand,
+            list(attr_codes))
+    return [(span['text'], [word['query_indx']
+                            for word in span['matched_words']])
+            for span in spans]
+
+
+def test_claims_exact_entries(dictionary_lookup):
+    assert exact_spans(
+        dictionary_lookup, 'silver oak cabernet sauvignon napa valley 2015') \
+        == [('Silver Oak', [0, 1]), ('Cabernet Sauvignon', [2, 3]),
+            ('Napa Valley', [4, 5])]
+
+
+def test_longest_entry_first(dictionary_lookup):
+    assert exact_spans(dictionary_lookup, 'russian river valley pinot noir') \
+        == [('Russian River Valley', [0, 1, 2]), ('Pinot Noir', [3, 4])]
+
+
+def test_overlapping_entries_are_left_to_scoring(dictionary_lookup):
+    assert exact_spans(dictionary_lookup, 'cabernet sauvignon blanc') == []
+    assert exact_spans(dictionary_lookup,
+                       'merlot cabernet sauvignon blanc red wine') == \
+        [('Red Wine', [4, 5])]
+
+
+def test_single_words_are_left_to_scoring(dictionary_lookup):
+    assert exact_spans(dictionary_lookup, 'merlot bordeaux') == []
+
+
+def test_skips_extracted_words(dictionary_lookup):
+    assert exact_spans(dictionary_lookup,
+                       'napa %s valley red wine' % UNMATCHABLE) == \
+        [('Red Wine', [3, 4])]
+
+
+def test_brands_and_attr_codes(dictionary_lookup):
+    query = 'silver oak kendall jackson pinot noir'
+    assert exact_spans(dictionary_lookup, query, is_single_brand=False) == \
+        [('Silver Oak', [0, 1]), ('Kendall Jackson', [2, 3]),
+         ('Pinot Noir', [4, 5])]
+    # only one brand: the scoring picks it
+    assert exact_spans(dictionary_lookup, query) == [('Pinot Noir', [4, 5])]
+    assert exact_spans(dictionary_lookup, 'silver oak pinot noir',
+                       disallow_brand=True) == [('Pinot Noir', [2, 3])]
+    assert exact_spans(dictionary_lookup, 'silver oak pinot noir',
+                       attr_codes=['brand']) == [('Silver Oak', [0, 1])]
+
+
+def test_lookup_with_and_without_exact_spans(dictionary_lookup, monkeypatch):
+    query = 'silver oak cabernet sauvignon napa valley 2015'
+    monkeypatch.setattr(config, 'LOOKUP_EXACT_SPANS', True)
+    attributes, _, extra_words = dictionary_lookup.lookup_uncached(1, query)
+    assert sorted((attr['code'], attr['start'], attr['end'])
+                  for attr in attributes) == \
+        [('brand', 0, 1), ('region', 4, 5), ('varietals', 2, 3)]
+    assert extra_words == ['2015']
+    monkeypatch.setattr(config, 'LOOKUP_EXACT_SPANS', False)
+    scored, _, scored_extra_words = dictionary_lookup.lookup_uncached(1, query)
+    assert sorted(map(sorted, (attr.items() for attr in scored))) == \
+        sorted(map(sorted, (attr.items() for attr in attributes)))
+    assert scored_extra_words == extra_words
+
+
+def test_exact_spans_are_off_by_default(dictionary_lookup, monkeypatch):
+    calls = []
+    monkeypatch.setattr(dictionary_lookup, 'find_exact_spans',
+                        lambda *args: calls.append(args) or [])
+    dictionary_lookup.lookup_uncached(1, 'silver oak napa valley')
+    assert calls == [] and not config.LOOKUP_EXACT_SPANS
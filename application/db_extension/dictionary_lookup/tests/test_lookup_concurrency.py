@@ -0,0 +1,104 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from application.db_extension.dictionary_lookup import fuzzy_index
+
+SENTENCES = [
+    'silver oak cabernet sauvignon napa valley',
+    'full bodied red wine from bordeaux',
+    'kendall jackson chardonnay',
+    'pinot noir russian river valley',
+    'duckhorn vineyards merlot',
+    'light bodied white wine sauvignon blanc',
+    'sonoma coast pinot grigio',
+    'cabernet sauvignon merlot blend',
+]
+
+LOOKUP_OPTIONS = [{}, {'is_allow_fuzzy': True},
+                  {'is_single_brand': False, 'attr_codes': ['varietals']}]
+
+
+def run_in_threads(app, function, times=32):
+    def run(_):
+        with app.app_context():
+            return function()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        return list(pool.map(run, range(times)))
+
+
+def test_concurrent_lookups_match_serial(app, dictionary_lookup):
+    def lookup_all():
+        return [dictionary_lookup.lookup_uncached(1, sentence, **options)
+                for sentence in SENTENCES for options in LOOKUP_OPTIONS]
+
+    expected = lookup_all()
+    assert any(attributes for attributes, _, _ in expected)
+    assert all(result == expected
+               for result in run_in_threads(app, lookup_all))
+
+
+def test_concurrent_fuzzy_lookups(app, dictionary_lookup, monkeypatch):
+    sentences = ['cabernet sauvignn', 'pinot nior', 'sonoma caost merlto',
+                 'kendal jackson chardonay', 'bordeux', 'silver oka']
+
+    def lookup_all():
+        return [dictionary_lookup.lookup_uncached(1, sentence,
+                                                  is_allow_fuzzy=True)
+                for sentence in sentences]
+
+    expected = lookup_all()
+    assert dictionary_lookup.dictionary.fuzzy_index._cache['bordeux']
+    # a small probe cache is cleared over and over while threads use it
+    monkeypatch.setattr(fuzzy_index, 'FUZZY_CACHE_SIZE', 3)
+    dictionary_lookup.dictionary.fuzzy_index._cache.clear()
+    assert all(result == expected
+               for result in run_in_threads(app, lookup_all))
+    assert len(dictionary_lookup.dictionary.fuzzy_index._cache) <= 3
+
+
+def test_concurrent_cached_lookups(app, dictionary_lookup):
+    def lookup_all():
+        return [dictionary_lookup.lookup(1, sentence) for sentence in SENTENCES]
+
+    expected = [dictionary_lookup.lookup_uncached(1, sentence)
+                for sentence in SENTENCES]
+    assert all(result == expected
+               for result in run_in_threads(app, lookup_all, times=16))
+    info = dictionary_lookup.result_cache.info()
+    assert info['hits'] + info['misses'] == 16 * len(SENTENCES)
+    assert info['size'] == len(SENTENCES)
+
+
+def test_query_keeps_its_dictionary(dictionary_lookup):
+    dictionary = dictionary_lookup.dictionary
+    entities_text_id_dict = dictionary_lookup.entities_text_id_dict
+    with dictionary_lookup.query_context():
+        dictionary_lookup.publish_dictionary(None, {})
+        assert dictionary_lookup.dictionary is dictionary
+        assert dictionary_lookup.entities_text_id_dict is entities_text_id_dict
+        # a lookup started inside a query uses the dictionary of that query
+        attributes, _, _ = dictionary_lookup.lookup(1, 'pinot noir')
+        assert [a['node_id'] for a in attributes] == [103]
+    assert dictionary_lookup.dictionary is None
+
+
+def test_query_state_is_per_thread(dictionary_lookup):
+    seen = {}
+    barrier = threading.Barrier(2)
+
+    def run(name, words):
+        with dictionary_lookup.query_context() as context:
+            context.word_lemmas = dict(zip(words, words))
+            barrier.wait()
+            seen[name] = dictionary_lookup.word_lemma_dictionary_for_query
+
+    threads = [threading.Thread(target=run, args=('a', ['merlot'])),
+               threading.Thread(target=run, args=('b', ['bordeaux']))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert seen == {'a': {'merlot': 'merlot'}, 'b': {'bordeaux': 'bordeaux'}}
+    assert dictionary_lookup.context is None
+    assert dictionary_lookup.word_lemma_dictionary_for_query == {}
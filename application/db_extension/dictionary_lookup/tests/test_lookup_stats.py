@@ -0,0 +1,72 @@
+import json
+
+from application.db_extension.dictionary_lookup.lookup_stats import (
+    NO_TIMINGS,
+    Histogram,
+    LookupStats)
+
+
+def test_histogram():
+    histogram = Histogram((1, 10, 100))
+    for value in (0.5, 1, 5, 50, 500):
+        histogram.add(value)
+    info = histogram.info()
+    assert info['count'] == 5
+    assert info['max'] == 500
+    assert info['buckets'] == [[1, 2], [10, 1], [100, 1], [None, 1]]
+    assert info['p50'] == 10
+    assert info['p99'] is None
+
+
+def test_not_sampled():
+    stats = LookupStats(sample_rate=0)
+    timings = stats.start()
+    assert timings is NO_TIMINGS
+    with timings.stage('lookup'):
+        timings.count('candidates', 3)
+    stats.record(timings)
+    with stats.stage('cleanup_string'):
+        pass
+    assert stats.info()['sampled'] == 0
+
+
+def test_sampled():
+    stats = LookupStats(sample_rate=1)
+    for _ in range(3):
+        timings = stats.start()
+        with timings.stage('lookup'):
+            with timings.stage('score_candidates'):
+                timings.count('candidates', 2)
+            with timings.stage('score_candidates'):
+                timings.count('candidates', 3)
+        stats.record(timings)
+    info = stats.info()
+    assert info['sampled'] == 3
+    assert sorted(info['durations_ms']) == ['lookup', 'score_candidates']
+    assert info['durations_ms']['lookup']['count'] == 3
+    assert info['counts']['candidates']['buckets'] == [[5, 3]]
+    assert json.loads(stats.summary())['candidates'] == [3, 5.0, 5]
+    stats.clear()
+    assert stats.info()['sampled'] == 0
+
+
+def test_log_every():
+    logged = []
+    stats = LookupStats(sample_rate=1, log_every=2,
+                        log_function=lambda *args: logged.append(args))
+    for _ in range(5):
+        with stats.stage('cleanup_string'):
+            pass
+    assert len(logged) == 2
+
+
+def test_lookup_records_stages(dictionary_lookup, monkeypatch):
+    monkeypatch.setattr(dictionary_lookup, 'stats', LookupStats(sample_rate=1))
+    dictionary_lookup.lookup_uncached(1, 'silver oak cabernet sauvignn')
+    dictionary_lookup.lookup_uncached(1, 'napa valley')
+    info = dictionary_lookup.stats.info()
+    assert info['sampled'] == 2
+    assert {'lookup', 'remove_stopwords', 'find_exact_match', 'extraction'} \
+        <= set(info['durations_ms'])
+    assert info['durations_ms']['get_bigram_lists']['count'] == 1
+    assert info['counts']['entities']['count'] == 2
@@ -0,0 +1,70 @@
+from application.db_extension.dictionary_lookup import config, master_products
+from application.db_extension.dictionary_lookup.master_products import (
+    MasterProductIndex,
+    MasterProducts)
+
+# (master_product_id, source_id, name, non_attribute_words, brand_node_id)
+PRODUCTS = [
+    (1, 7, 'Silver Oak Alexander Valley', 'alexander', 301),
+    (2, 8, 'Silver Oak Bob Vineyard', 'bob vineyard', 301),
+    (3, 7, 'Silver Oak Bob Vineyard Reserve', 'bob vineyard reserve', 301),
+    (4, 8, 'Silver Oak Bob', 'bob', 301),
+    (5, 7, 'Kendall Jackson Bob', 'bob', 302),
+    (6, 7, 'Silver Oak', None, 301),
+]
+
+
+def test_match():
+    index = MasterProductIndex(PRODUCTS)
+    assert len(index) == 6
+
+    def match(words, source_id=7, **kwargs):
+        return [product['master_product_id']
+                for product in index.match(301, source_id, words, **kwargs)]
+
+    # only products sharing a word, those of the source first, then by rank
+    assert match(['bob', 'vineyard']) == [3, 2, 4]
+    assert match(['bob', 'vineyard'], source_id=8) == [2, 4, 3]
+    assert match(['bob', 'bob']) == [3, 4, 2]
+    assert match(['bob', 'vineyard'], limit=2) == [3, 2]
+    assert match(['cabernet']) == []
+    assert index.match(999, 7, ['bob']) == []
+    product = index.match(302, 7, ['bob'])[0]
+    assert product['name'] == 'Kendall Jackson Bob' and product['ts_rank'] > 0
+    # results are copies
+    product['non_attribute_words'] = ''
+    assert index.match(302, 7, ['bob'])[0]['non_attribute_words'] == 'bob'
+
+
+def test_master_products(monkeypatch):
+    sequences = [10]
+    loads = []
+
+    def get_products(category_id):
+        loads.append(category_id)
+        return PRODUCTS
+
+    monkeypatch.setattr(master_products, 'get_last_ready_sequence_id',
+                        lambda: sequences[-1])
+    monkeypatch.setattr(master_products, 'get_master_products', get_products)
+    products = MasterProducts()
+    assert products.get(1) is products.get(1)
+    assert loads == [1]
+    sequences.append(11)
+    monkeypatch.setattr(config, 'MASTER_PRODUCTS_CHECK_SECONDS', 0)
+    index = products.get(1)
+    assert products.get(1) is index
+    assert loads == [1, 1]
+    products.refresh(1)
+    assert loads == [1, 1, 1]
+
+
+def test_lookup_finds_products(dictionary_lookup, monkeypatch):
+    monkeypatch.setattr(dictionary_lookup.master_products, 'get',
+                        lambda category_id: MasterProductIndex(PRODUCTS))
+    _, product_ids, _ = dictionary_lookup.lookup_uncached(
+        7, 'silver oak bob vineyard', check_for_products=True)
+    assert product_ids == [3, 2, 4]
+    _, product_ids, _ = dictionary_lookup.lookup_uncached(
+        7, 'silver oak bob vineyard')
+    assert product_ids == []
@@ -0,0 +1,77 @@
+import pytest
+
+from application.db_extension.dictionary_lookup import config, utils
+from application.db_extension.dictionary_lookup.ngrams import NgramTrie
+
+NGRAMS = {
+    'red_blend': 'red blend',
+    'red_blend_reserve': 'red blend reserve',
+    'just_in': 'just in',
+    'pinot_noir': 'pinot noir',
+    'noir_de_noirs': 'noir de noirs',
+    'st_emilion': 'st. emilion',
+    'empty': '',
+}
+
+
+@pytest.fixture
+def trie():
+    return NgramTrie(NGRAMS)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a red blend please', 'a red_blend please'),
+    # longest match wins
+    ('red blend reserve 2015', 'red_blend_reserve 2015'),
+    ('red blend reserved', 'red_blend reserved'),
+    # whole words only
+    ('hired blend', 'hired blend'),
+    ('red blends', 'red blends'),
+    ('just inside', 'just inside'),
+    # punctuation next to a word
+    ('red blend, cheap', 'red_blend, cheap'),
+    ('(red blend)', '(red_blend)'),
+    ('st. emilion red', 'st_emilion red'),
+    # leftmost match first, one pass
+    ('pinot noir de noirs', 'pinot_noir de noirs'),
+    ('just in red blend just in', 'just_in red_blend just_in'),
+    # spaces are kept as they are
+    ('red  blend', 'red  blend'),
+    ('  red blend ', '  red_blend '),
+    ('', ''),
+])
+def test_substitute(trie, text, expected):
+    assert trie.substitute(text) == expected
+
+
+def test_substituted_text_is_not_matched_again():
+    trie = NgramTrie({'a_b': 'a b', 'x': 'a_b c'})
+    assert trie.substitute('a b c') == 'a_b c'
+
+
+def test_first_duplicate_source_wins():
+    trie = NgramTrie({'red_blend': 'red blend', 'redblend': 'red blend'})
+    assert trie.substitute('red blend') == 'red_blend'
+
+
+def test_empty_trie():
+    assert NgramTrie({}).substitute('red blend') == 'red blend'
+
+
+def test_trie_is_kept_between_checks(monkeypatch):
+    reads = []
+
+    def get_nlp_ngrams():
+        # a fresh dict each time, like the memoized query
+        reads.append(1)
+        return dict(NGRAMS)
+
+    monkeypatch.setattr(utils, 'get_nlp_ngrams', get_nlp_ngrams)
+    monkeypatch.setattr(utils, '_ngram_trie', (None, None, None))
+    trie = utils.get_ngram_trie()
+    assert utils.replace_with_nlp_ngrams('a red blend') == 'a red_blend'
+    assert utils.get_ngram_trie() is trie
+    assert len(reads) == 1
+    monkeypatch.setattr(config, 'NLP_TABLES_CHECK_SECONDS', 0)
+    assert utils.get_ngram_trie() is trie
+    assert len(reads) == 2
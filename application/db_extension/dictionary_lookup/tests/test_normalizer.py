@@ -0,0 +1,109 @@
+import random
+import re
+from pathlib import Path
+
+import pytest
+
+from application.db_extension.dictionary_lookup.normalizer import (
+    NormalizedQuery,
+    clean_text,
+    normalize_query,
+    normalize_text)
+from application.db_extension.dictionary_lookup.utils import remove_stopwords
+
+CORPUS_PATH = Path(__file__).parent / 'data' / 'normalizer_corpus.txt'
+FUZZ_ALPHABET = "aAbcxyzé12390 .,-?$&'s/;:()!\t\n"
+
+
+def add_space_before_period_and_number(text):
+    rg = r'\d+\.(?!\d)'
+    matches = re.finditer(rg, text)
+    for m in matches:
+        text_found = m.group(0)
+        text = text.replace(text_found, text_found.replace('.', ' .'))
+
+    return text
+
+
+def reference_cleanup_string(input_str):
+    """The regex chain normalize_text() replaces (without the synonym substitution)"""
+    input_str = str(input_str)
+    cleaned_string = input_str.replace('?', ' ?')
+    cleaned_string = add_space_before_period_and_number(cleaned_string)
+    cleaned_string = cleaned_string.rstrip('/,.')
+    cleaned_string = re.sub(r'(.*\d)(?:\s*\-\s*)(\$?\d.*)',
+                            r'\1 to \2', cleaned_string)
+    cleaned_string = cleaned_string.replace('-', ' ').lower()
+    cleaned_string = re.sub(r'\'s', r's', cleaned_string)
+    cleaned_string = re.sub(r'(.)\.\s?(.)[\.$]', r'\1\2 ', cleaned_string)
+    cleaned_string = re.sub(r'\.[\W$]', ' ', cleaned_string)
+    cleaned_string = re.sub(
+        r'(?:\d)(,)(?:\d)(.*\d)(,)(\d.*)', r'\1\2', cleaned_string)
+    cleaned_string = re.sub(r'([a-z]+)\.([a-z]+)', r'\1 \2', cleaned_string)
+    cleaned_string = re.sub(r'([^\s\.\$\w])+', ' ', cleaned_string)
+    cleaned_string = re.sub(r'\s+', ' ', cleaned_string).strip()
+    if cleaned_string == '':
+        cleaned_string = input_str.lower()
+    return cleaned_string
+
+
+def corpus():
+    return CORPUS_PATH.read_text(encoding='utf8').split('\n')
+
+
+def fuzz_corpus(count=20000, seed=13):
+    rnd = random.Random(seed)
+    return [''.join(rnd.choice(FUZZ_ALPHABET)
+                    for _ in range(rnd.randint(0, 24)))
+            for _ in range(count)]
+
+
+@pytest.mark.parametrize('sentences', [corpus(), fuzz_corpus()],
+                         ids=['corpus', 'fuzz'])
+def test_same_output_as_regex_chain(sentences):
+    for sentence in sentences:
+        expected = reference_cleanup_string(sentence)
+        assert clean_text(sentence) == expected, sentence
+
+        without_stopwords, stopword_indexes = remove_stopwords(expected)
+        normalized = normalize_text(sentence)
+        assert normalized.text == expected, sentence
+        assert normalized.stopword_indexes == stopword_indexes, sentence
+        assert normalized.without_stopwords == without_stopwords, sentence
+
+
+def test_tokens_and_stopwords():
+    normalized = normalize_text('The Prisoner Red, a $40 blend & more')
+    assert normalized.tokens == ['the', 'prisoner', 'red', 'a', 'dollar40',
+                                 'blend', 'more']
+    assert normalized.stopword_indexes == {0, 3}
+    assert normalized.without_stopwords == 'prisoner red dollar40 blend more'
+
+
+@pytest.mark.parametrize('sentences', [corpus(), fuzz_corpus()],
+                         ids=['corpus', 'fuzz'])
+def test_normalized_query(sentences):
+    def prepare(text):
+        # prepare_attribute_lookup_sentence() before NormalizedQuery
+        text = re.sub('[^A-Za-z0-9$]+', ' ', text).lstrip()
+        return normalize_text(text).without_stopwords
+
+    for sentence in sentences:
+        query = normalize_query(sentence)
+        without_stopwords = normalize_text(sentence).without_stopwords
+        assert query.text == without_stopwords, sentence
+        assert query == NormalizedQuery.from_text(without_stopwords), sentence
+        if query.is_plain:
+            assert prepare(query.text) == query.text, sentence
+
+
+def test_query_from_text():
+    query = NormalizedQuery.from_text('the prisoner $40 & more')
+    assert query.words == ('the', 'prisoner', '$40', '&', 'more')
+    # '&' -> 'and' is a stopword too, as in remove_stopwords()
+    assert query.stopword_indexes == {0, 3} == \
+        remove_stopwords('the prisoner $40 & more')[1]
+    assert not query.is_plain
+    assert not NormalizedQuery.from_text('napa  valley').is_plain
+    assert NormalizedQuery.from_text('napa valley 2015').is_plain
+    assert query.cache_key == 'the prisoner $40 & more'
@@ -0,0 +1,85 @@
+import types
+
+import pytest
+
+from application.db_extension.dictionary_lookup import config, process_dictionary
+from application.db_extension.dictionary_lookup.lookup_stats import (
+    LookupTimings)
+from application.db_extension.dictionary_lookup.process_dictionary import (
+    TOKEN_PATTERN,
+    apply_dictionary_delta,
+    build_processes,
+    convert_and_index,
+    convert_row,
+    count_document_frequencies,
+    create_ngrams,
+    idf_from_document_frequencies)
+
+ROWS = [
+    (1, 1, 1, 101, 'Cabernet Sauvignon', None, 'varietals'),
+    (2, 1, 1, 102, 'Sauvignon Blanc', None, 'varietals'),
+    (3, 1, 2, 201, 'Napa Valley', None, 'region'),
+    (4, 1, 2, 202, 'Russian River Valley', None, 'region'),
+    (5, 1, 3, 301, 'Silver Oak', None, 'brand'),
+    (6, 1, 3, 302, 'St. Francis 1.5L', None, 'brand'),
+    (7, 1, 3, 303, 'The', None, 'brand'),
+    (8, 1, 4, 401, 'Full Bodied', None, 'body'),
+    (9, 1, 5, 501, 'Red Wine', None, 'type'),
+]
+
+
+def test_idf_matches_tfidf_vectorizer():
+    text = pytest.importorskip('sklearn.feature_extraction.text')
+    entities = [convert_row(row) for row in ROWS]
+    vectorizer = text.TfidfVectorizer(
+        ngram_range=(1, 1), norm=None, use_idf=True, sublinear_tf=True,
+        token_pattern=TOKEN_PATTERN)
+    vectorizer.fit([entity['text_value'] for entity in entities])
+
+    idf_dict, idf = idf_from_document_frequencies(
+        count_document_frequencies(entities), len(entities))
+    assert list(idf_dict) == sorted(vectorizer.vocabulary_)
+    assert idf.tolist() == vectorizer.idf_.tolist()
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_convert_and_index(processes):
+    timings = LookupTimings()
+    entities, document_frequencies, inverted_index = convert_and_index(
+        ROWS, log_function=lambda *args: None, timings=timings,
+        processes=processes, batch_size=4)
+    expected = [convert_row(row) for row in ROWS]
+    assert entities == expected
+    assert document_frequencies == count_document_frequencies(expected)
+    assert list(inverted_index.items()) == \
+        list(create_ngrams(expected, {}).items())
+    assert {'fetch', 'normalize', 'index'} <= set(timings.durations)
+
+
+def test_build_processes(monkeypatch):
+    monkeypatch.setattr(config, 'DICTIONARY_BUILD_PROCESSES', 3)
+    assert build_processes() == 3
+    # e.g. a celery worker
+    monkeypatch.setattr(process_dictionary.multiprocessing, 'current_process',
+                        lambda: types.SimpleNamespace(daemon=True))
+    assert build_processes() == 1
+
+
+def test_delta_idf_matches_full_build():
+    from application.db_extension.dictionary_lookup.lookup import (
+        build_dictionary)
+
+    def build(rows):
+        return build_dictionary(rows, log_function=lambda *args: None)
+
+    # '!!!' is a word of the entity but not a token of the idf pattern
+    added = [(10, 1, 6, 601, 'Bubbly 2015', None, 'style'),
+             (11, 1, 6, 602, '!!!', None, 'style')]
+    rebuilt, _, _ = build(ROWS + added)
+    dictionary, _, cutoff_idf = build(ROWS)
+    delta, _ = apply_dictionary_delta(
+        dictionary, [convert_row(row) for row in added], [], cutoff_idf,
+        log_function=lambda *args: None)
+    for word in ('bubbly', '2015', '!!!'):
+        assert delta.word_idf(word) == pytest.approx(rebuilt.word_idf(word))
+    assert delta.word_idf('!!!') == 0.0
@@ -0,0 +1,68 @@
+import random
+
+from application.db_extension.dictionary_lookup.lookup import (
+    RankedCandidates)
+
+
+def make_candidate(score, position, query_indexes):
+    return {'final_score': score, 'order_key': (-score, position),
+            'matched_words': [{'query_indx': i} for i in query_indexes]}
+
+
+def test_best_first():
+    ranked = RankedCandidates([make_candidate(1.0, 0, [0]),
+                               make_candidate(3.0, 1, [1]),
+                               make_candidate(0.0, 2, [2]),
+                               make_candidate(3.0, 3, [2])])
+    assert len(ranked) == 3
+    assert [cand['order_key'][1] for cand in ranked.best()] == [1, 3, 0]
+    assert [cand['order_key'][1] for cand in ranked.best(2)] == [1, 3]
+    # best() doesn't remove anything
+    assert len(ranked.best()) == 3
+
+
+def test_consume():
+    a = make_candidate(5.0, 0, [0, 1])
+    b = make_candidate(4.0, 1, [1, 2])
+    c = make_candidate(3.0, 2, [3])
+    d = make_candidate(2.0, 3, [1])
+    ranked = RankedCandidates([a, b, c, d])
+    overlapping = ranked.consume([0, 1])
+    assert overlapping == [b]
+    assert b['order_key'] == (-4.0, 1)
+    assert ranked.best() == [c]
+    b2 = make_candidate(3.0, 1, [2])
+    b2['order_key'] = (-3.0, b['order_key'])
+    ranked.push(b2)
+    # tie on the score: c was 3.0 before the step too, b2 4.0
+    assert ranked.best() == [b2, c]
+    assert ranked.consume([4]) == []
+
+
+def test_same_order_as_rekeying_every_candidate():
+    rng = random.Random(0)
+    candidates = [make_candidate(rng.choice([1.0, 2.0, 3.0]), i,
+                                 rng.sample(range(8), 2)) for i in range(60)]
+    ranked = RankedCandidates(candidates)
+    expected = list(candidates)
+    for step in range(4):
+        position = step * 2
+        overlapping = ranked.consume([position])
+        rescored = []
+        for cand in expected:
+            positions = [w['query_indx'] for w in cand['matched_words']]
+            if position in positions:
+                continue
+            cand['order_key'] = (-cand['final_score'], cand['order_key'])
+            rescored.append(cand)
+        for cand in overlapping:
+            new_cand = make_candidate(
+                rng.choice([1.0, 2.0, 3.0]), None,
+                [i for i in (w['query_indx'] for w in cand['matched_words'])
+                 if i != position])
+            new_cand['order_key'] = (-new_cand['final_score'],
+                                     cand['order_key'])
+            ranked.push(new_cand)
+            rescored.append(new_cand)
+        expected = sorted(rescored, key=lambda cand: cand['order_key'])
+        assert ranked.best() == expected
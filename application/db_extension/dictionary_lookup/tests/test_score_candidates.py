@@ -0,0 +1,55 @@
+import copy
+
+import pytest
+
+QUERY = 'silver oak cabernet sauvignon napa valley wine'
+
+
+@pytest.fixture
+def candidates(dictionary_lookup):
+    words_in_query = QUERY.split()
+    with dictionary_lookup.query_context():
+        dictionary = dictionary_lookup.dictionary
+        query_tokens = dictionary.encode(words_in_query)
+        rows = [dictionary.row_for_id(i)
+                for i in dictionary_lookup.entities_text_id_dict.values()]
+        candidates = [dictionary_lookup.get_candidate(
+            words_in_query, query_tokens, row, False, is_allow_fuzzy=True)
+            for row in rows]
+    return [cand for cand in candidates if cand]
+
+
+def score(dictionary_lookup, candidates, **kwargs):
+    with dictionary_lookup.query_context():
+        return dictionary_lookup.score_candidates(
+            QUERY.split(), candidates, ['wine', 'wines'], [], [], **kwargs)
+
+
+def test_scores_together_same_as_one_by_one(dictionary_lookup, candidates):
+    together = score(dictionary_lookup, copy.deepcopy(candidates))
+    one_by_one = [scored for cand in copy.deepcopy(candidates)
+                  for scored in score(dictionary_lookup, [cand])]
+    one_by_one.sort(key=lambda cand: -cand['final_score'])
+    assert [cand['text'] for cand in together] == \
+        [cand['text'] for cand in one_by_one]
+    assert together == one_by_one
+    assert [cand['text'] for cand in together[:2]] == \
+        ['Cabernet Sauvignon', 'Napa Valley']
+
+
+def test_explain(dictionary_lookup, candidates):
+    scored = score(dictionary_lookup, copy.deepcopy(candidates))
+    explained_candidates = copy.deepcopy(candidates)
+    explained = score(dictionary_lookup, explained_candidates, explain=True)
+    assert [cand['final_score'] for cand in explained] == \
+        [cand['final_score'] for cand in scored]
+    for cand in explained:
+        assert all('adjusted_idf' in word for word in
+                   cand['matched_words'] + cand['unmatched_words'])
+    disqualified = [cand for cand in explained_candidates
+                    if cand not in explained]
+    assert disqualified
+    for cand in disqualified:
+        assert cand['final_score'] == -1
+        assert sum(key.startswith(('brand_', 'all_low_', 'found_', 'one_'))
+                   for key in cand) == 1
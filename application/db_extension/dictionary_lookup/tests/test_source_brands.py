@@ -0,0 +1,86 @@
+from application.db_extension.dictionary_lookup import config, source_brands
+from application.db_extension.dictionary_lookup.master_products import (
+    MasterProductIndex)
+from application.db_extension.dictionary_lookup.source_brands import (
+    BrandBitset,
+    SourceBrands)
+
+
+def test_brand_bitset():
+    brands = BrandBitset([301, 7, 8, 301, None], sequence_id=3)
+    assert len(brands) == 3
+    assert 7 in brands and 8 in brands and 301 in brands
+    assert 0 not in brands and 9 not in brands and 302 not in brands
+    assert 10 ** 9 not in brands and -1 not in brands
+    assert 1 not in BrandBitset([])
+
+
+def test_source_brands(monkeypatch):
+    sequences = {7: 10}
+    queries = []
+
+    def get_node_ids(source_id, sequence_id):
+        queries.append((source_id, sequence_id))
+        return [301, 302] if sequence_id == 10 else [303]
+
+    monkeypatch.setattr(source_brands, 'get_last_ready_sequence_id',
+                        sequences.get)
+    monkeypatch.setattr(source_brands, 'get_source_brand_node_ids',
+                        get_node_ids)
+    brands = SourceBrands()
+    assert 301 in brands.get(7)
+    assert brands.get(7) is brands.get(7)
+    assert len(brands.get(8)) == 0
+    # a new pipeline run is seen once the check interval has passed
+    sequences[7] = 11
+    assert 301 in brands.get(7)
+    monkeypatch.setattr(config, 'SOURCE_BRANDS_CHECK_SECONDS', 0)
+    assert 303 in brands.get(7)
+    assert queries == [(7, 10), (7, 11)]
+    # the process running the pipeline refreshes right away
+    monkeypatch.setattr(config, 'SOURCE_BRANDS_CHECK_SECONDS', 300)
+    assert 301 in brands.refresh(7, 10)
+    assert 301 in brands.get(7)
+
+
+def test_human_lookups_get_the_source_brands(dictionary_lookup, monkeypatch):
+    given = []
+
+    def check_top_matches(matched_entities, source_brand_list):
+        given.append(source_brand_list)
+        return matched_entities
+
+    monkeypatch.setattr(dictionary_lookup.source_brands, 'get',
+                        lambda source_id: BrandBitset([301]))
+    monkeypatch.setattr(dictionary_lookup, 'check_top_matches',
+                        check_top_matches)
+    dictionary_lookup.lookup(7, 'silver oak merlot', is_human=True)
+    assert 301 in given[-1]
+    dictionary_lookup.lookup(7, 'silver oak merlot')
+    assert given[-1] == []
+    dictionary_lookup.lookup(7, 'silver oak merlot', is_human=True,
+                             source_brand_list=[302])
+    assert given[-1] == [302]
+
+
+def test_lookup_resolves_the_source_brands_once(dictionary_lookup,
+                                                monkeypatch):
+    calls = []
+    get_source_brand_list = dictionary_lookup.get_source_brand_list
+
+    def counting(*args):
+        calls.append(args)
+        return get_source_brand_list(*args)
+
+    monkeypatch.setattr(dictionary_lookup.source_brands, 'get',
+                        lambda source_id: BrandBitset([301]))
+    monkeypatch.setattr(dictionary_lookup.master_products, 'get',
+                        lambda category_id: MasterProductIndex([]))
+    monkeypatch.setattr(dictionary_lookup, 'get_source_brand_list', counting)
+    dictionary_lookup.lookup(7, 'silver oak merlot', is_human=True)
+    assert len(calls) == 1
+    dictionary_lookup.lookup(7, 'silver oak merlot', is_human=True,
+                             check_for_products=True)
+    assert len(calls) == 2
+    dictionary_lookup.lookup_uncached(7, 'silver oak merlot', is_human=True)
+    assert len(calls) == 3
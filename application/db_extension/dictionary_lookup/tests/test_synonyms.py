@@ -0,0 +1,116 @@
+import random
+import re
+
+import pytest
+
+from application.db_extension.dictionary_lookup import config, utils
+from application.db_extension.dictionary_lookup.synonyms import SynonymRewriter
+
+SYNONYMS = [
+    # (source_text, target_text, must_be_at_beginning, is_whole_word)
+    ('cabernet sauvignon', 'cabernet_sauvignon', False, True),
+    ('show me some', 'show me', True, False),
+    ('sauv blanc', 'sauvignon blanc', False, True),
+    ('savignon', 'sauvignon', False, False),
+    ('sauvignon blanc', 'sauvignon_blanc', False, True),
+    ('pinot gris', 'pinot grigio', False, True),
+    ('i want', 'want', True, True),
+    ('cab', 'cabernet', False, True),
+    ('zin', 'zinfandel', False, True),
+    ('cheap', 'inexpensive', False, True),
+    ('rosé', 'rose', False, False),
+    ('champ(a|i)gne', 'champagne', False, True),
+    ("'s", 's', False, False),
+    ('bubbly', 'sparkling', False, True),
+    ('blanc', 'white', False, False),
+    ('ss', 's', False, False),
+]
+FUZZ_WORDS = ['cab', 'cabs', 'zin', 'cheap', 'rosé', 'ROSÉ', 'champigne',
+              'sauv', 'blanc', 'savignon', 'pinot', 'gris', 'i', 'want',
+              'show', 'me', 'some', "it's", 'bubbly', 'Cabernet', 'SAUVIGNON',
+              'ſauv', 'blaKnc', 'İ', 'x_cab', 'cab_', '5cab', '-']
+
+
+def rows():
+    out_rows = []
+    for source, target, at_beginning, whole_word in SYNONYMS:
+        pattern = r'^{}\b' if at_beginning else r'\b{}\b' if whole_word \
+            else r'{}'
+        out_rows.append({'source_text': source, 'target_text': target,
+                         'must_be_at_beginning': at_beginning,
+                         'is_whole_word': whole_word,
+                         'rg': pattern.format(source)})
+    return out_rows
+
+
+def reference_rewrite(nlp_synonyms, cleaned_string):
+    for nlps in nlp_synonyms:
+        cleaned_string = re.sub(
+            nlps['rg'], nlps['target_text'], cleaned_string, flags=re.I)
+    return cleaned_string
+
+
+def fuzz_sentences(count=5000, seed=7):
+    rnd = random.Random(seed)
+    return [rnd.choice(['', ' ', '.']).join(
+        rnd.choice(FUZZ_WORDS) for _ in range(rnd.randint(0, 8)))
+        for _ in range(count)]
+
+
+@pytest.mark.parametrize('sentence', [
+    'cab sauv blanc',
+    'show me some cheap cab',
+    'i want savignon blanc',
+    'do i want pinot gris',
+    "it's a cheap champigne",
+    'cabernet sauvignon and sauv blanc',
+    'SHOW ME SOME Rosé',
+    '',
+])
+def test_same_output_as_regex_loop(sentence):
+    nlp_synonyms = rows()
+    assert SynonymRewriter(nlp_synonyms).rewrite(sentence) == \
+        reference_rewrite(nlp_synonyms, sentence)
+
+
+def test_fuzz_same_output_as_regex_loop():
+    nlp_synonyms = rows()
+    rewriter = SynonymRewriter(nlp_synonyms)
+    for sentence in fuzz_sentences():
+        rewritten = reference_rewrite(nlp_synonyms, sentence)
+        assert rewriter.rewrite(sentence) == rewritten, sentence
+        # second pass, as cleanup_string(check_synonyms=True) does
+        assert rewriter.rewrite(rewritten) == \
+            reference_rewrite(nlp_synonyms, rewritten), rewritten
+
+
+def test_only_matching_rules_run():
+    rewriter = SynonymRewriter(rows())
+    sources = [synonym[0] for synonym in SYNONYMS]
+    # rows with regex or non ASCII sources are always tried
+    always = [sources.index('rosé'), sources.index('champ(a|i)gne')]
+    assert rewriter.find('a cheap zin') == sorted(
+        always + [sources.index('cheap'), sources.index('zin')])
+    # whole word and beginning of string boundaries
+    assert rewriter.find('cabs so i want') == always
+
+
+def test_rewriter_is_kept_between_checks(monkeypatch):
+    reads = []
+
+    def get_nlp_synonyms():
+        # a fresh list each time, like the memoized query
+        reads.append(1)
+        return rows()
+
+    monkeypatch.setattr(utils, 'get_nlp_synonyms', get_nlp_synonyms)
+    monkeypatch.setattr(utils, '_synonym_rewriter', (None, None, None))
+    rewriter = utils.get_synonym_rewriter()
+    assert utils.replace_with_nlp_synonyms('cheap zin') == \
+        'inexpensive zinfandel'
+    assert utils.get_synonym_rewriter() is rewriter
+    assert len(reads) == 1
+    # the table is read again after the interval, the same rows keep the rewriter
+    monkeypatch.setattr(config, 'NLP_TABLES_CHECK_SECONDS', 0)
+    assert utils.get_synonym_rewriter() is rewriter
+    assert len(reads) == 2
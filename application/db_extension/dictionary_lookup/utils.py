@@ -5,12 +5,14 @@ import datetime as dt
 import json
 import re
 import html
+import time
 from collections import defaultdict
 from typing import Optional, Union
 from unidecode import unidecode
-from application.caching import cache
 
 from application.db_extension.dictionary_lookup import config
+from application.db_extension.dictionary_lookup.ngrams import NgramTrie
+from application.db_extension.dictionary_lookup.synonyms import SynonymRewriter
 
 from .postgres_functions import (
     get_nlp_synonyms,
@@ -127,107 +129,68 @@ def modify_string_for_context_attribute_if_necessary(cleaned_string, attr_code):
     return cleaned_string
 
 
-def replace_with_nlp_synonyms(cleaned_string):
-    nlp_synonyms = get_nlp_synonyms()
-    for nlps in nlp_synonyms:
-        # pattern = r'^{}\b' if nlps['must_be_at_beginning'] else r'\b{}\b' if nlps['is_whole_word'] else r'{}'
-        # rg = pattern.format(nlps['source_text'])
-        cleaned_string = re.sub(
-            nlps['rg'], nlps['target_text'], cleaned_string, flags=re.I)
-    return cleaned_string.lower()
-
-
-@cache.memoize()
-def replace_with_nlp_ngrams(cleaned_string):
-
-    # TODO: MB commented this out and replaced with simple replace. This regex doesn't seem to work for 'red blend'
-    # ngrams, regex = get_nlp_ngrams_regex()
-    # return regex.sub(lambda mo: ngrams[mo.string[mo.start():mo.end()]], cleaned_string)
-
-    # for nlps in nlp_synonyms:
-    #    # pattern = r'\b{}\b'
-    #    # rg = pattern.format(nlps['source_text'])
-    #    # cleaned_string = re.sub(rg, nlps['target_text'], cleaned_string, flags=re.I)
-    #    # Note: because this is simple replacement, don't need regex and much much faster
-    #    # cleaned_string = cleaned_string.replace(nlps['source_text'], nlps['target_text'])
-    #    cleaned_string = re.sub(r"\b%s\b" % nlps['source_text'], nlps['target_text'], cleaned_string)
-    ngrams = get_nlp_ngrams()
-    for key, val in ngrams.items():
-        cleaned_string = cleaned_string.replace(val, key)
-
-    return cleaned_string
-
-
-def add_space_before_period_and_number(text):
-    rg = r'\d+\.(?!\d)'
-    matches = re.finditer(rg, text)
-    for m in matches:
-        text_found = m.group(0)
-        text = text.replace(text_found, text_found.replace('.', ' .'))
-
-    return text
-
-
-def cleanup_string(input_str, check_synonyms=False):
-    # Make sure it's a string and convert if not
-    input_str = str(input_str)
+_synonym_rewriter = (None, None, None)  # (SynonymRewriter, table version, monotonic time checked)
 
-    cleaned_string = input_str.replace('?', ' ?')
-    cleaned_string = add_space_before_period_and_number(cleaned_string)
 
-    # Remove last char if common noise
-    cleaned_string = cleaned_string.rstrip('/,.')
-
-    # special case of $123-$234 (or $123 - $234)
-    cleaned_string = re.sub(r'(.*\d)(?:\s*\-\s*)(\$?\d.*)',
-                            r'\1 to \2', cleaned_string)
-
-    cleaned_string = cleaned_string.replace('-', ' ').lower()
-
-    # remove single quote for possessives - this is due to limitations/differences in data_dictionary in postgres
-    # if we move dictionary into Python then we can be smarter about how we handle quotes
-    # Note that this assumes we have done similar adjustments when writing to data dictionary
-    cleaned_string = re.sub(r'\'s', r's', cleaned_string)
+def get_synonym_rewriter():
+    """
+    :return: SynonymRewriter of the nlp_synonyms table. The table is only read again every
+        NLP_TABLES_CHECK_SECONDS, and compiled again only when it changed.
+    """
+    global _synonym_rewriter
+    rewriter, version, checked = _synonym_rewriter
+    now = time.monotonic()
+    if rewriter is not None and now - checked < config.NLP_TABLES_CHECK_SECONDS:
+        return rewriter
+    nlp_synonyms = get_nlp_synonyms()
+    new_version = hash(tuple((nlps['rg'], nlps['source_text'], nlps['target_text'])
+                             for nlps in nlp_synonyms))
+    if rewriter is None or new_version != version:
+        rewriter = SynonymRewriter(nlp_synonyms)
+    _synonym_rewriter = (rewriter, new_version, now)
+    return rewriter
 
-    # "mini recursion" of replace_with_nlp_synonyms to handle 2nd order replacement requirements
-    # Also substitute ngrams (e.g., "just in" -> "just_in"
-    # For performance reasons, we don't need to check if we know input data is simple/clean (e.g., product catalog attributes)
-    if check_synonyms:
-        begin_time = dt.datetime.now()
-        cleaned_string = replace_with_nlp_synonyms(
-            replace_with_nlp_synonyms(cleaned_string))
-        #print("nlp_synonyms seconds: ", (dt.datetime.now() - begin_time).total_seconds())
-        begin_time = dt.datetime.now()
-        cleaned_string = replace_with_nlp_ngrams(cleaned_string).lower()
-        #print("nlp_ngrams seconds: ", (dt.datetime.now() - begin_time).total_seconds())
 
-    # Replace "J.J." or "J. J." with "JJ"
-    cleaned_string = re.sub(r'(.)\.\s?(.)[\.$]', r'\1\2 ', cleaned_string)
+def replace_with_nlp_synonyms(cleaned_string):
+    # Same as applying re.sub(nlps['rg'], nlps['target_text'], cleaned_string, flags=re.I) for each row in order
+    return get_synonym_rewriter().rewrite(cleaned_string).lower()
 
-    # Replace ". " with " " like "J. Lohr" -> "J Lohr"; or "st. " with "st "
-    cleaned_string = re.sub(r'\.[\W$]', ' ', cleaned_string)
 
-    # Remove comma if surrounded by numbers
-    cleaned_string = re.sub(
-        r'(?:\d)(,)(?:\d)(.*\d)(,)(\d.*)', r'\1\2', cleaned_string)
+_ngram_trie = (None, None, None)  # (NgramTrie, ngram set version, monotonic time checked)
 
-    # Remove period if surrounded by alpha chars
-    cleaned_string = re.sub(r'([a-z]+)\.([a-z]+)', r'\1 \2', cleaned_string)
 
-    # remove remaining punctuation
-    cleaned_string = re.sub(r'([^\s\.\$\w])+', ' ', cleaned_string)
+def get_ngram_trie():
+    """
+    :return: NgramTrie of get_nlp_ngrams(). The ngrams are only read again every
+        NLP_TABLES_CHECK_SECONDS, and the trie is built again only when they changed.
+    """
+    global _ngram_trie
+    trie, version, checked = _ngram_trie
+    now = time.monotonic()
+    if trie is not None and now - checked < config.NLP_TABLES_CHECK_SECONDS:
+        return trie
+    ngrams = get_nlp_ngrams()
+    new_version = hash(tuple(ngrams.items()))
+    if trie is None or new_version != version:
+        trie = NgramTrie(ngrams)
+    _ngram_trie = (trie, new_version, now)
+    return trie
 
-    # get rid of multiple spaces/whitespaces in case left behind
-    cleaned_string = re.sub('\s+', ' ', cleaned_string).strip()
 
-    if cleaned_string == '':
-        print("ADD to nlp_ngrams: ", input_str)
-        cleaned_string = input_str.lower()  # Fallback if stripped of everything
+def replace_with_nlp_ngrams(cleaned_string):
+    # Substitute ngrams (e.g., "just in" -> "just_in"), longest first, in one pass over the words.
+    # This used to be one str.replace() per ngram (which also replaced inside words) and is now
+    # cheaper than a memoize round trip, so it is not cached anymore
+    return get_ngram_trie().substitute(cleaned_string)
 
-    # if not ''.join(cleaned_string.split()).isalnum():
-    #    raise ValueError(cleaned_string)
 
-    return cleaned_string
+def cleanup_string(input_str, check_synonyms=False):
+    """
+    Normalize a string for dictionary lookup (see normalizer.normalize_text() to also get the tokens
+    and stopword positions in the same call)
+    """
+    from application.db_extension.dictionary_lookup.normalizer import clean_text
+    return clean_text(input_str, check_synonyms=check_synonyms)
 
 
 def check_output_for_extrinsics(output_obj):
@@ -2,6 +2,7 @@ from .models import db, DomainCategory
 from typing import List, Optional
 from flask import current_app
 from application.caching import cache
+import hashlib
 import re
 from funcy import log_durations
 from application.logging import logger
@@ -30,12 +31,19 @@ def filter_tsquery(s):
                                                                          '')
 
 
-@cache.memoize(timeout=60 * 60 * 24 * 7)
+ATTRIBUTE_LOOKUP_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+
+
+@cache.memoize(timeout=ATTRIBUTE_LOOKUP_CACHE_TIMEOUT)
 def attribute_lookup(sentence,
                      source_id=1,
                      brand_treatment='exclude',
                      attribute_code=False):
     """
+    Attributes found in sentence by the attribute_lookup2 stored procedure
+    below, or only by the in-memory dictionary lookup when
+    ATTRIBUTE_LOOKUP_ENGINE is 'memory' (see memory_lookup_arguments())
+
     function attribute_lookup2(p_category_id bigint,
                                p_search_str text,
                                p_predicate_str text,
@@ -70,18 +78,43 @@ def attribute_lookup(sentence,
     Later, we can remove p_predicate_str, p_should_extract_values and
      p_should_restrict_nodes. In the meantime, set p_predicate_str to NULL
       and the others to False.
-        :param sentence:
+        :param sentence: str, or a NormalizedQuery (see
+        prepare_attribute_lookup_sentence())
     :param index:
     :param brand_treatment:
     :param should_restrict_nodes:
     :param predicate:
     :return:
     """
-    # Remove potentially problematic chars
-    sentence = re.sub('[^A-Za-z0-9$]+', ' ', sentence).lstrip()
-    from application.db_extension.dictionary_lookup.utils import cleanup_string, remove_stopwords
-    sentence, _ = remove_stopwords(cleanup_string(sentence))
+    query = prepare_attribute_lookup_sentence(sentence)
+    if get_attribute_lookup_engine() == 'memory':
+        return memory_attribute_lookup(query, source_id, brand_treatment,
+                                       attribute_code)
+
+    attributes = postgres_attribute_lookup(query, brand_treatment,
+                                           attribute_code)
+    if not attributes:
+        from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+        attributes =dictionary_lookup.lookup(source_id, query, attr_codes=[attribute_code])[0]
+    return attributes
+
+
+def get_attribute_lookup_engine():
+    """
+    :return: ATTRIBUTE_LOOKUP_ENGINE setting ('postgres' or 'memory')
+    """
+    from application.db_extension.dictionary_lookup import config
+    engine = config.ATTRIBUTE_LOOKUP_ENGINE
+    if engine not in ('postgres', 'memory'):
+        raise ValueError(f'Unknown ATTRIBUTE_LOOKUP_ENGINE: {engine}')
+    return engine
+
 
+def postgres_attribute_lookup(query, brand_treatment='exclude',
+                              attribute_code=False):
+    """
+    attribute_lookup2 results for a prepared NormalizedQuery (no fallback)
+    """
     q = """SELECT *
            FROM public.attribute_lookup2 (:category_id,
                                           :sentence,
@@ -93,7 +126,7 @@ def attribute_lookup(sentence,
     # want to constrain to current store (which we are populating!)
     rows = db.session.execute(q, {
         'category_id': get_default_category_id(),
-        'sentence': filter_tsquery(sentence),
+        'sentence': filter_tsquery(query.text),
         'brand_treatment': brand_treatment,
         'attribute_code': attribute_code,
     })
@@ -102,33 +135,194 @@ def attribute_lookup(sentence,
         atts = row[0].get('attributes')
         if atts:
             attributes.extend(atts)
-    if not attributes:
+    return attributes
+
+
+def memory_lookup_arguments(brand_treatment='exclude', attribute_code=False):
+    """
+    dictionary_lookup.lookup() arguments with the attribute_lookup2
+    semantics of brand_treatment and attribute_code:
+    brands are only returned with brand_treatment 'include', and only
+    attributes of attribute_code (when given) are returned
+    """
+    if brand_treatment not in ('include', 'exclude'):
+        raise ValueError(f'Unknown brand_treatment: {brand_treatment}')
+    return {'is_disallow_brand': brand_treatment == 'exclude',
+            'attr_codes': [attribute_code] if attribute_code else []}
+
+
+def get_loaded_dictionary_lookup():
+    from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+    if dictionary_lookup.dictionary is None:
+        dictionary_lookup.load_dictionary_lookup_data()
+    return dictionary_lookup
+
+
+def memory_attribute_lookup(query, source_id=1, brand_treatment='exclude',
+                            attribute_code=False):
+    """
+    attribute_lookup() of a prepared NormalizedQuery served by the in-memory dictionary
+    """
+    return get_loaded_dictionary_lookup().lookup(
+        source_id, query,
+        **memory_lookup_arguments(brand_treatment, attribute_code))[0]
+
+
+def prepare_attribute_lookup_sentence(sentence):
+    """
+    :param sentence: str, or a NormalizedQuery that is returned as it is if
+        cleaning it again would not change it
+    :return: NormalizedQuery
+    """
+    from application.db_extension.dictionary_lookup.normalizer import (
+        NormalizedQuery,
+        normalize_query)
+    if isinstance(sentence, NormalizedQuery):
+        if sentence.is_plain:
+            return sentence
+        sentence = sentence.text
+    # Remove potentially problematic chars
+    sentence = re.sub('[^A-Za-z0-9$]+', ' ', sentence).lstrip()
+    from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+    with dictionary_lookup.stats.stage('cleanup_string'):
+        return normalize_query(sentence)
+
+
+def attribute_lookup_many(sentences,
+                          source_id=1,
+                          brand_treatment='exclude',
+                          attribute_code=False):
+    """
+    Batch version of attribute_lookup(): every distinct sentence (str or
+    NormalizedQuery) is cleaned once, attribute_lookup2 runs in one query for
+    the sentences that are not in the cache (see attribute_lookup_cache_key())
+    and those it finds nothing for go through dictionary_lookup.lookup_many()
+    (with the 'memory' engine, the whole batch goes through lookup_many())
+    :return: list of attributes aligned with sentences
+    """
+    prepared = {}
+    for sentence in sentences:
+        if sentence not in prepared:
+            prepared[sentence] = prepare_attribute_lookup_sentence(sentence)
+    unique_sentences = list(set(prepared.values()))
+    if not unique_sentences:
+        return []
+
+    if get_attribute_lookup_engine() == 'memory':
+        results = get_loaded_dictionary_lookup().lookup_many(
+            source_id, unique_sentences, normalize=False,
+            **memory_lookup_arguments(brand_treatment, attribute_code))
+        attributes = {sentence: result[0]
+                      for sentence, result in zip(unique_sentences, results)}
+        return [attributes[prepared[sentence]] for sentence in sentences]
+
+    keys = [attribute_lookup_cache_key(sentence, source_id, brand_treatment,
+                                       attribute_code)
+            for sentence in unique_sentences]
+    attributes = {sentence: found for sentence, found
+                  in zip(unique_sentences, cache.get_many(*keys))
+                  if found is not None}
+    missing = [sentence for sentence in unique_sentences
+               if sentence not in attributes]
+    if missing:
+        found = postgres_attribute_lookup_many(missing, source_id,
+                                               brand_treatment, attribute_code)
+        attributes.update(found)
+        cache.set_many({key: found[sentence]
+                        for sentence, key in zip(unique_sentences, keys)
+                        if sentence in found},
+                       timeout=ATTRIBUTE_LOOKUP_CACHE_TIMEOUT)
+    return [attributes[prepared[sentence]] for sentence in sentences]
+
+
+def attribute_lookup_cache_key(query, source_id=1, brand_treatment='exclude',
+                               attribute_code=False):
+    """
+    Cache key of the attribute_lookup_many() result of a prepared
+    NormalizedQuery
+    """
+    key = '\x00'.join(str(x) for x in (
+        get_default_category_id(), source_id, brand_treatment, attribute_code,
+        query.text))
+    return 'attribute_lookup_many:' + hashlib.md5(key.encode('utf8')).hexdigest()
+
+
+def postgres_attribute_lookup_many(unique_sentences, source_id=1,
+                                   brand_treatment='exclude',
+                                   attribute_code=False):
+    """
+    attribute_lookup2 results of distinct prepared NormalizedQuery objects in
+    one query, with the dictionary_lookup.lookup_many() fallback for those it
+    finds nothing for
+    :return: dict of attributes by sentence
+    """
+    q = """SELECT s.i, a.*
+           FROM unnest(CAST(:sentences AS text[])) WITH ORDINALITY AS s(sentence, i),
+                LATERAL public.attribute_lookup2 (:category_id,
+                                                  s.sentence,
+                                                  :brand_treatment) a;
+        """
+    if attribute_code:
+        q = q.replace(':brand_treatment', ':brand_treatment, :attribute_code')
+    rows = db.session.execute(q, {
+        'category_id': get_default_category_id(),
+        'sentences': [filter_tsquery(s.text) for s in unique_sentences],
+        'brand_treatment': brand_treatment,
+        'attribute_code': attribute_code,
+    })
+    attributes = {sentence: [] for sentence in unique_sentences}
+    for row in rows:
+        atts = row[1].get('attributes')
+        if atts:
+            attributes[unique_sentences[row[0] - 1]].extend(atts)
+
+    not_found = [sentence for sentence in unique_sentences
+                 if not attributes[sentence]]
+    if not_found:
         from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
-        attributes =dictionary_lookup.lookup(source_id, sentence, attr_codes=[attribute_code])[0]
+        results = dictionary_lookup.lookup_many(source_id, not_found,
+                                                normalize=False,
+                                                attr_codes=[attribute_code])
+        for sentence, result in zip(not_found, results):
+            attributes[sentence] = result[0]
     return attributes
 
 
 def python_dictionary_lookup(source_id, sentence, attr_codes=None):
-    from application.db_extension.dictionary_lookup.utils import cleanup_string, remove_stopwords
-    sentence, _ = remove_stopwords(cleanup_string(sentence))
-
+    from application.db_extension.dictionary_lookup.normalizer import normalize_query
     from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+    with dictionary_lookup.stats.stage('cleanup_string'):
+        query = normalize_query(sentence)
+
     if not dictionary_lookup.entities_text_id_dict:
-        dictionary_lookup.update_dictionary_lookup_data()
+        dictionary_lookup.load_dictionary_lookup_data()
 
-    attributes, _, extra_words = dictionary_lookup.lookup(source_id, sentence, attr_codes=attr_codes)
+    attributes, _, extra_words = dictionary_lookup.lookup(source_id, query, attr_codes=attr_codes)
     return {'attributes': attributes, 'extra_words': list(extra_words)}
 
 
 
 def domain_attribute_lookup(sentence, source_id):
-    from application.db_extension.dictionary_lookup.utils import cleanup_string, remove_stopwords
-    sentence, _ = remove_stopwords(cleanup_string(sentence))
-    from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
-    result = attribute_lookup(sentence, source_id=source_id)
+    from application.db_extension.dictionary_lookup.normalizer import normalize_query
+    result = attribute_lookup(normalize_query(sentence), source_id=source_id)
     return {'attributes': result, 'extra_words': []}
 
 
+def domain_attribute_lookup_many(sentences, source_id):
+    """
+    Batch version of domain_attribute_lookup()
+    :return: list of results aligned with sentences
+    """
+    from application.db_extension.dictionary_lookup.normalizer import normalize_query
+    cleaned = {}
+    for sentence in sentences:
+        if sentence not in cleaned:
+            cleaned[sentence] = normalize_query(sentence)
+    results = attribute_lookup_many([cleaned[sentence] for sentence in sentences],
+                                    source_id=source_id)
+    return [{'attributes': result, 'extra_words': []} for result in results]
+
+
 def _domain_attribute_lookup(sentence):
     index = 0
     result = attribute_lookup(sentence)
@@ -1,4 +1,7 @@
+import gc
+
 from celery.schedules import crontab
+from celery.signals import worker_init
 from application.db_extension.models import db
 from .synchronization import start_synchronization, celery
 
@@ -62,5 +65,25 @@ def init_celery(app):
                 return response
     celery.Task = AppContextTask
 
+    @worker_init.connect(weak=False)
+    def preload_dictionary_lookup(**_):
+        # Load the lookup dictionary in the worker parent before the pool forks: the children inherit the
+        # memory mapped snapshot (read only, shared through the page cache) instead of each building their own
+        from application.db_extension.dictionary_lookup import config as lookup_config
+        from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+        if not lookup_config.REFRESH_DICTS_ON_START:
+            return
+        with app.app_context():
+            dictionary_lookup.load_dictionary_lookup_data()
+            # don't share the parent's database connections with the children
+            db.engine.dispose()
+        if dictionary_lookup.dictionary is not None:
+            # the indexes built on first use would otherwise be built again in every child
+            dictionary_lookup.dictionary.build_lazy_indexes()
+        # Move everything loaded so far out of the collector's reach, so collections in the children don't
+        # write to (and copy) the pages of the shared objects (Python 3.7+)
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+
     # run finalize to process decorated tasks
     celery.finalize()
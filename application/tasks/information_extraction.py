@@ -7,6 +7,7 @@ from sqlalchemy.dialects import postgresql
 
 from application.stopwords import STOPWORDS
 from application.db_extension.routines import (domain_attribute_lookup,
+                                               domain_attribute_lookup_many,
                                                get_description_contents_data)
 from application.db_extension.models import (
     db,
@@ -249,19 +250,30 @@ class PipelineExtractor:
         self.pav_bulk_inserter.bulk_insert()
         return {"sequence_id": self.sequence_id}
 
+    def lookup_sentences(self, sentences):
+        """
+        Look up the attributes of all sentences in one batch
+        :return: list of attributes aligned with sentences
+        """
+        results = domain_attribute_lookup_many(
+            [self.remove_stopwords(sentence) for sentence in sentences],
+            self.source_id)
+        return [result['attributes'] for result in results]
+
     def extract_from_reviews(self, content, product_id, track_to=None):
         res: list
-        sentences = split_to_sentences(content)
+        # Let's make sure there's a reasonable amount of content, not just initials or something
+        sentences = [sentence for sentence in split_to_sentences(content)
+                     if len(sentence) > 5]
+        sentences_attributes = self.lookup_sentences(sentences)
         for sctr, sentence in enumerate(sentences):
             res = []
             # logger.debug("pipeline_info_extraction: sentence=" + str(sctr) + ", lenSentence="+ str(len(sentence)))
 
-            # Let's make sure there's a reasonable amount of content, not just initials or something
-            if len(sentence) <= 5:
-                continue
             # print('* {}'.format(sentence))
             result = self.extract_information(
-                sentence, product_id, track_to=track_to)
+                sentence, product_id, track_to=track_to,
+                attributes=sentences_attributes[sctr])
             #
             # logger.debug("pipeline_info_extraction: sentence_idx="+ str(sctr) + ", done extract info")
             res += result
@@ -274,16 +286,17 @@ class PipelineExtractor:
         # logger.debug("pipeline_info_extraction: done get description contents for productid=" + str(product.id))
         res = []
         if content:
-            sentences = split_to_sentences(content)
+            # Let's make sure there's a reasonable amount of content, not just initials or something
+            sentences = [sentence for sentence in split_to_sentences(content)
+                         if len(sentence) > 5]
+            sentences_attributes = self.lookup_sentences(sentences)
 
             # logger.debug("pipeline_info_extraction: prod description contents, numSentences=" + str(len(sentences)))
-            for sentence in sentences:
-                # Let's make sure there's a reasonable amount of content, not just initials or something
-                if len(sentence) <= 5:
-                    continue
+            for sentence, attributes in zip(sentences, sentences_attributes):
                 # print('* {}'.format(sentence))
                 result = self.extract_information(
-                    sentence, product_id, track_to=track_to)
+                    sentence, product_id, track_to=track_to,
+                    attributes=attributes)
                 if result:
                     # logger.debug("pipeline_info_extraction: done inserting sentence for prod description content")
                     res += result
@@ -365,7 +378,18 @@ class PipelineExtractor:
             result.append(res)
         return result
 
-    def extract_information(self, sentence, product_id, extract_name=False, track_to=None):
+    @staticmethod
+    def remove_stopwords(sentence):
+        # Remove the stopwords before sending in sentence. This is to improve lookup performance
+        return ' '.join([word for word in sentence.lower().split() if
+                         word not in STOPWORDS])
+
+    def extract_information(self, sentence, product_id, extract_name=False,
+                            track_to=None, attributes=None):
+        """
+        :param attributes: lookup result for the sentence if it was already
+            looked up in a batch (see lookup_sentences())
+        """
         orig = sentence
         extra_words = []
         # logger.debug("pipeline_info_extraction: _extract_information sentence=" + str(len(sentence)))
@@ -377,9 +401,7 @@ class PipelineExtractor:
             domain_attributes = self.domain_attributes_for_extract
             extract_content = self.extract_content
             domain_attribute_codes = self.domain_attribute_codes
-        # Remove the stopwords before sending in sentence. This is to improve lookup performance
-        sentence = ' '.join([word for word in sentence.lower().split() if
-                             word not in STOPWORDS])
+        sentence = self.remove_stopwords(sentence)
 
         # logger.debug("pipeline_info_extraction: _extract_information num_extract_content=" + str(len(extract_content)))
         # We now do the appropriate filtering of attributes before we call this function
@@ -388,8 +410,9 @@ class PipelineExtractor:
                                                      product_id,
                                                      domain_attributes)
 
-        attrs = domain_attribute_lookup(sentence, self.source_id)['attributes']
-        tmp_attributes += attrs
+        if attributes is None:
+            attributes = domain_attribute_lookup(sentence, self.source_id)['attributes']
+        tmp_attributes += attributes
         tmp_attributes = remove_duplicates(tmp_attributes)
         # We only care about the domain_attributes that were sent in... ignore other "bycatch" attributes that were extracted
         # tmp_attributes = [attr for attr in tmp_attributes if attr['code'] in [attr['code'] for attr in domain_attributes]]
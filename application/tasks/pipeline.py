@@ -7,7 +7,8 @@ from application.db_extension.routines import (validate_pipeline_run,
                                                source_into_pipeline_copy,
                                                seeding_products_func,
                                                assign_themes_to_products,
-                                               pipe_aggregate)
+                                               pipe_aggregate,
+                                               get_default_category_id)
 from application.db_extension.models import db
 from application.db_extension.models import PipelineSequence
 from .information_extraction import PipelineExtractor
@@ -44,8 +45,7 @@ def execute_pipeline(source_id: int,
         If any of the above functions returns an error, then set pipeline_sequence.status="error" and return early.
     """
     from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
-    if not dictionary_lookup.entities_text_id_dict:
-        dictionary_lookup.update_dictionary_lookup_data()
+    dictionary_lookup.load_dictionary_lookup_data()
     logger.info("execute_pipeline: starts, sequence_id=" + str(sequence_id))
     start = datetime.now()
 
@@ -112,6 +112,21 @@ def execute_pipeline(source_id: int,
     set_completion_status(sequence=sequence, source_id=source_id)
     db.session.commit()
 
+    if sequence.state == READY:
+        # Brands sold by the source, used by human lookups
+        try:
+            dictionary_lookup.source_brands.refresh(source_id, sequence_id)
+        except Exception:
+            logger.exception('execute_pipeline: failed to refresh the '
+                             'source brands')
+        # Master products matched by product_lookup2()
+        try:
+            dictionary_lookup.master_products.refresh(
+                get_default_category_id())
+        except Exception:
+            logger.exception('execute_pipeline: failed to refresh the '
+                             'master products')
+
     logger.info(
         f'pipeline_execute: pipeline processing is completed,'
         f' timetaken={datetime.now() - start}')
@@ -1,7 +1,7 @@
 import json
 import re
 from datetime import datetime
-from typing import NamedTuple
+from typing import List, NamedTuple
 from funcy import log_durations
 from sqlalchemy import text
 from sqlalchemy.sql.expression import func
@@ -20,6 +20,7 @@ from application.db_extension.models import (db,
 from application.db_extension.routines import (
     get_default_category_id,
     attribute_lookup,
+    attribute_lookup_many,
     update_price_qoh)
 from application.utils import listify, get_float_number
 from application.logging import logger
@@ -40,6 +41,23 @@ def get_brand(source_id: int, name: str) -> str:
     return brand, brand_node_id
 
 
+def get_brand_many(source_id: int, names: List[str]) -> List[tuple]:
+    """ Batch version of get_brand(): one attribute lookup for all names
+    """
+    results = attribute_lookup_many(
+        [remove_diacritics(name) for name in names],
+        source_id=source_id,
+        brand_treatment='include',
+        attribute_code='brand')
+    brand_list = []
+    for attributes in results:
+        brands = select_brands(attributes)
+        brand = brands and brands[0]['value'] or None
+        brand_node_id = brands and brands[0]['node_id'] or None
+        brand_list.append((brand, brand_node_id))
+    return brand_list
+
+
 def get_brands(source_id: int, unaccented_name: str) -> list:
     # processed = cleanup_string(name, check_synonyms=False)
 
@@ -53,6 +71,10 @@ def get_brands(source_id: int, unaccented_name: str) -> list:
         sentence=unaccented_name,
         brand_treatment='include',
         attribute_code='brand')
+    return select_brands(attributes)
+
+
+def select_brands(attributes: list) -> list:
     brands = filter_brands(attributes)
     if len(brands) > 1:  # what to do if more than one brand returned?
         logger.warning(
@@ -61,18 +83,6 @@ def get_brands(source_id: int, unaccented_name: str) -> list:
     return brands
 
 
-@cache.memoize()
-def get_nlp_ngrams():
-    # TODO deprecated???
-    rows = db.session.execute(
-        """SELECT text_value_processed target_text, 
-                 replace(text_value_processed,'_',' ') source_text
-           FROM domain_dictionary 
-           WHERE is_require_ngram=TRUE
-           ORDER BY char_length(text_value_processed) DESC;""")
-    return [dict(row) for row in rows]
-
-
 @cache.memoize(timeout=60 * 60)
 def get_process_product_attributes():
     rows = db.session.query(
@@ -81,41 +91,6 @@ def get_process_product_attributes():
     return [row[0] for row in rows]
 
 
-def get_nlp_ngrams():
-    logger.info('get_nlp_ngrams')
-    q = """SELECT text_value_processed target_text,
-                   replace(text_value_processed,'_',' ') source_text
-            FROM domain_dictionary WHERE is_require_ngram=TRUE
-            ORDER BY char_length(text_value_processed) DESC"""
-    rows = db.session.execute(q)
-    return {row.target_text: row.source_text for row in rows}
-
-
-@cache.memoize(timeout=200)
-def get_nlp_ngrams_regex():
-    ngrams = get_nlp_ngrams()
-    regex = re.compile("(%s)" % "|".join(map(re.escape, ngrams.keys())))
-    return ngrams, regex
-
-
-@cache.memoize(timeout=200)
-def replace_with_nlp_ngrams(cleaned_string):
-    ngrams, regex = get_nlp_ngrams_regex()
-    return regex.sub(
-        lambda mo: ngrams[mo.string[mo.start():mo.end()]], cleaned_string
-    )
-
-    # for nlps in nlp_synonyms:
-    #    # pattern = r'\b{}\b'
-    #    # rg = pattern.format(nlps['source_text'])
-    #    # cleaned_string = re.sub(rg, nlps['target_text'], cleaned_string, flags=re.I)
-    #    # Note: because this is simple replacement, don't need regex and much much faster
-    #    # cleaned_string = cleaned_string.replace(nlps['source_text'], nlps['target_text'])
-    #    cleaned_string = re.sub(r"\b%s\b" % nlps['source_text'], nlps['target_text'], cleaned_string)
-
-    # return cleaned_string
-
-
 def get_domain_taxonomy_node_id_from_dict(source_id, attribute_code,
                                           attribute_value):
     """
@@ -260,12 +235,18 @@ class Product(NamedTuple):
     flaw: str
 
     @staticmethod
-    def from_raw(source_id: int, product: dict) -> 'Product':
+    def from_raw(source_id: int, product: dict,
+                 brand_lookup: tuple = None) -> 'Product':
+        """
+        :param brand_lookup: (brand, brand_node_id) already looked up for the
+            product name (see from_raw_many())
+        """
         try:
             brand_node_id = None
             brand = product.get('brand')
             if not brand:
-                brand, brand_node_id = get_brand(source_id, product['name'])
+                brand, brand_node_id = brand_lookup or get_brand(
+                    source_id, product['name'])
             _product = {
                 'source_id': source_id,
                 'name': product['name'],
@@ -303,6 +284,23 @@ class Product(NamedTuple):
         else:
             return Product(**_product)
 
+    @staticmethod
+    def from_raw_many(source_id: int, products: List[dict]) -> List['Product']:
+        """
+        Batch version of from_raw(): brands of all products without one are
+        looked up at once
+        """
+        products = list(products)
+        without_brand = [product for product in products
+                         if not product.get('brand')]
+        brands = get_brand_many(source_id,
+                                [product['name'] for product in without_brand])
+        brand_lookups = {id(product): brand
+                         for product, brand in zip(without_brand, brands)}
+        return [Product.from_raw(source_id, product,
+                                 brand_lookup=brand_lookups.get(id(product)))
+                for product in products]
+
     def as_dict(self) -> dict:
         return self._asdict()
 
@@ -386,15 +384,8 @@ class ProductProcessor:
         self.review_bulk_adder.flush()
 
     def replace_with_nlp_ngrams(self, cleaned_string):
-        for nlps in self.nlp_synonyms:
-            # pattern = r'\b{}\b'
-            # rg = pattern.format(nlps['source_text'])
-            # cleaned_string = re.sub(rg, nlps['target_text'], cleaned_string, flags=re.I)
-            # Note: because this is simple replacement, don't need regex and much much faster
-            # cleaned_string = cleaned_string.replace(nlps['source_text'], nlps['target_text'])
-            cleaned_string = re.sub(r"\b%s\b" % nlps['source_text'],
-                                    nlps['target_text'], cleaned_string)
-        return cleaned_string
+        from application.db_extension.dictionary_lookup.utils import replace_with_nlp_ngrams
+        return replace_with_nlp_ngrams(cleaned_string)
 
     def generate_review(self, data):
         domain_reviewer_id = self.drc.get_id_by_name_or_alias(
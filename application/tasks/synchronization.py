@@ -26,8 +26,8 @@ celery = Celery(
 def prepare_products(source_id: int, products: Iterable,
                      full=True) -> List[dict]:
     if full:
-        res = [Product.from_raw(source_id, product).as_dict() for product in
-               products]
+        res = [product.as_dict() for product in
+               Product.from_raw_many(source_id, products)]
     else:
         [p.update({'source_id': source_id}) for p in products]
         res = products
@@ -122,7 +122,7 @@ def get_products_task(_, products: List[dict], source_id: int,
         logger.info('No products scraped for the source_id=%s', source_id)
     else:
         from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
-        dictionary_lookup.update_dictionary_lookup_data()
+        dictionary_lookup.load_dictionary_lookup_data()
     print('#############################')
     print(len(products))
     return prepare_products(source_id, products, full=full)
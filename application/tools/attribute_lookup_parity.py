@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Run the attribute_lookup2 stored procedure and the in-memory dictionary
+lookup over a corpus (one sentence or product name per line) and write the
+differences as JSON, before switching ATTRIBUTE_LOOKUP_ENGINE to 'memory'
+
+    python -m application.tools.attribute_lookup_parity names.txt report.json \
+        --brand-treatment include --attribute-code brand
+"""
+import argparse
+import json
+
+from application import create_app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('corpus', help='text file, one sentence per line')
+    parser.add_argument('output', help='JSON report path')
+    parser.add_argument('--source-id', type=int, default=1)
+    parser.add_argument('--brand-treatment', default='exclude',
+                        choices=('include', 'exclude'))
+    parser.add_argument('--attribute-code', default=False)
+    parser.add_argument('--max-examples', type=int, default=100)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        from application.db_extension.dictionary_lookup.parity import (
+            compare_attribute_lookups)
+        with open(args.corpus) as f:
+            sentences = [line.strip() for line in f if line.strip()]
+        report = compare_attribute_lookups(
+            sentences,
+            source_id=args.source_id,
+            brand_treatment=args.brand_treatment,
+            attribute_code=args.attribute_code,
+            max_examples=args.max_examples)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"{report['identical']} of {report['sentences']} sentences "
+              f"identical, postgres {report['postgres_seconds']:.1f}s, "
+              f"memory {report['memory_seconds']:.1f}s")
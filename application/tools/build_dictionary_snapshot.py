@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+"""
+Rebuild the dictionary lookup data from the database and write the snapshot
+that web and celery workers load on start (see DICTIONARY_SNAPSHOT_DIR)
+
+Run this for full rebuilds: unlike a celery worker, it can convert the rows
+in a pool of DICTIONARY_BUILD_PROCESSES processes (one per CPU by default).
+Workers pick the snapshot up on their next dictionary update.
+"""
+from application import create_app
+
+if __name__ == "__main__":
+    app = create_app()
+    with app.app_context():
+        from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+        from application.db_extension.dictionary_lookup.snapshot import (
+            read_snapshot_header, snapshot_path)
+        from application.db_extension.routines import get_default_category_id
+        dictionary_lookup.update_dictionary_lookup_data(log_function=print,
+                                                        force=True)
+        path = snapshot_path(get_default_category_id())
+        header = read_snapshot_header(path)
+        print(f'{path}: version {header["version"]}, '
+              f'{len(dictionary_lookup.dictionary)} entities')
@@ -24,10 +24,27 @@ def route_lookup_attributes():
 @seller_integration_bp.route('/reload_dictionary')
 def route_reload_dictionary():
     from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
-    dictionary_lookup.update_dictionary_lookup_data()
+    dictionary_lookup.update_dictionary_lookup_data(force=True)
     return jsonify({'msg': 'dictionary reloaded'})
 
 
+@seller_integration_bp.route('/lookup_cache')
+def route_lookup_cache():
+    from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+    info = dictionary_lookup.result_cache.info()
+    info['dictionary_version'] = dictionary_lookup.dictionary_version
+    return jsonify(info)
+
+
+@seller_integration_bp.route('/lookup_stats')
+def route_lookup_stats():
+    from application.db_extension.dictionary_lookup.lookup import dictionary_lookup
+    info = dictionary_lookup.stats.info()
+    if request.args.get('reset'):
+        dictionary_lookup.stats.clear()
+    return jsonify(info)
+
+
 @seller_integration_bp.route(
     '/status'
 )